@@ -1,6 +1,9 @@
+import time
+startup_start = time.perf_counter()
 import torch
 import numpy as np
 import random 
+import copy
 import logging
 logging.getLogger('matplotlib').setLevel(logging.WARNING)
 from Hook_Manager import Hook_Manager
@@ -18,15 +21,10 @@ from Data.Combined_Data import Combined_Data
 # Imports for Data_Splitter
 from importlib import import_module
 
-# Imports for Run_Model
-from Model.CNN_Trainer import CNN_Trainer
-from Model.Unlabeled_Domain_Adaptation_Trainer import Unlabeled_Domain_Adaptation_Trainer
-from Model.MLP_Trainer import MLP_Trainer
-from Model.SVC_RF_Trainer import SVC_RF_Trainer
+# Imports for Run_Model are resolved in Run_Model.run_model, so that only the selected trainer's dependencies (semilearn, timm, torchvision models, sklearn) are loaded
 
-from Model.IRM_CNN_Based_Trainer import IRM_CNN_Based_Trainer
-from Model.IRM_MLP_Based_Trainer import IRM_MLP_Based_Trainer
-from Model.CORAL_Trainer import CORAL_Trainer
+# Seconds spent in each startup stage, printed by print_startup_profile when --profile_startup is set
+startup_profile = {"CNN_EMG imports": time.perf_counter() - startup_start}
 
 class Run_Setup():
     """
@@ -54,6 +52,7 @@ class Run_Setup():
 
     def setup_run(self):
 
+        setup_start = time.perf_counter()
         if self.config_args:
             run = Parse_Config(self.config_args)
         else:
@@ -66,6 +65,7 @@ class Run_Setup():
         
         env = run.set_env()
         self.set_seeds_for_reproducibility(env)
+        startup_profile[f"Setup ({env.utils.__name__.split('.')[-1]})"] = time.perf_counter() - setup_start
 
         return env
 
@@ -141,30 +141,44 @@ class Run_Model():
         self.env = env
         self.num_gestures = env.num_gestures
 
+    def get_trainer_name(self):
+        if self.args.turn_on_unlabeled_domain_adaptation:
+            return "Unlabeled_Domain_Adaptation_Trainer"
+        if self.args.model == "MLP":
+            if self.args.domain_generalization == "IRM":
+                return "IRM_MLP_Based_Trainer"
+            return "MLP_Trainer"
+        if self.args.model in ["SVC", "RF"]:
+            return "SVC_RF_Trainer"
+        if self.args.domain_generalization == "IRM":
+            return "IRM_CNN_Based_Trainer"
+        if self.args.domain_generalization == "CORAL":
+            return "CORAL_Trainer"
+        return "CNN_Trainer"
+
     def run_model(self, X, Y, label):
 
-        if self.args.turn_on_unlabeled_domain_adaptation:
-            model_trainer = Unlabeled_Domain_Adaptation_Trainer(X, Y, label, self.env)
-        else:
-            if self.args.model == "MLP":
-                if self.args.domain_generalization == "IRM":
-                    model_trainer = IRM_MLP_Based_Trainer(X, Y, label, self.env)
-                else:
-                    model_trainer = MLP_Trainer(X, Y, label, self.env)
-            elif self.args.model in ["SVC", "RF"]:
-                model_trainer = SVC_RF_Trainer(X, Y, label, self.env)
-            else:
-                if self.args.domain_generalization == "IRM":
-                    model_trainer = IRM_CNN_Based_Trainer(X, Y, label, self.env)
-                elif self.args.domain_generalization == "CORAL":
-                    model_trainer = CORAL_Trainer(X, Y, label, self.env)
-                else:
-                    model_trainer = CNN_Trainer(X, Y, label, self.env)
+        trainer_name = self.get_trainer_name()
+        import_start = time.perf_counter()
+        trainer_module = import_module(f"Model.{trainer_name}")
+        startup_profile[f"Trainer import ({trainer_name})"] = time.perf_counter() - import_start
+        print_startup_profile(self.args)
 
+        model_trainer = getattr(trainer_module, trainer_name)(X, Y, label, self.env)
         model_trainer.setup_model()
         model_trainer.model_loop()
 
 
+def print_startup_profile(args):
+    """
+    Prints the time spent importing modules and setting up the run (--profile_startup). Data loading is not included.
+    """
+
+    if not args.profile_startup:
+        return
+    profile_str = " | ".join(f"{stage}: {seconds:.2f}s" for stage, seconds in startup_profile.items())
+    print(f"Startup Profile: {profile_str} | Total: {sum(startup_profile.values()):.2f}s")
+
 def main(config_args=None):
 
     hooks = Hook_Manager()
@@ -184,12 +198,52 @@ def main(config_args=None):
     hooks.register_hook("run_model", run_model.run_model)
     hooks.call_hook("run_model", X, Y, label)
 
+    return env
+
+def run_all_folds(config_args):
+    """
+    Runs every leave-one-subject-out fold (--all_folds) in this process. The dataset is loaded once and kept in Combined_Data's cache, so each fold only recomputes its scaler, images, split and model.
+    """
+
+    assert config_args.leave_one_subject_out, "--all_folds runs leave-one-subject-out folds; set --leave_one_subject_out True."
+
+    Combined_Data.cache_loaded_data = True
+    leftout_subject = 1
+    num_subjects = 1
+    while leftout_subject <= num_subjects:
+        fold_args = copy.deepcopy(config_args)
+        fold_args.all_folds = False
+        fold_args.leftout_subject = leftout_subject
+
+        env = main(fold_args)
+        num_subjects = env.utils.num_subjects
+        leftout_subject += 1
+
+    Combined_Data.cache_loaded_data = False
+    Combined_Data.loaded_data_cache.clear()
+
+def preload_data(config_args):
+    """
+    Loads the dataset for config_args into Combined_Data's cache, so that runs forked from this process afterwards share it instead of loading it again.
+    """
+
+    env = Run_Setup(copy.deepcopy(config_args)).setup_run()
+    Combined_Data.cache_loaded_data = True
+    Combined_Data(X_Data(env), Y_Data(env), Label_Data(env), env).load_data()
+
 def use_config(config_args):
     """
     Called by run_CNN_EMG if a config file is passed.
     """
 
-    main(config_args)
+    if config_args.all_folds:
+        run_all_folds(config_args)
+    else:
+        main(config_args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = Parse_Arguments().create_argparse()
+    if args.all_folds:
+        run_all_folds(args)
+    else:
+        main()
\ No newline at end of file
@@ -12,9 +12,29 @@ import numpy as np
 
 import multiprocessing
 
+# Arguments that only change how the loaded data is split, trained on or logged, so runs that differ only in these can share loaded data
+DATA_INDEPENDENT_ARGS = {
+    'config', 'table', 'table_workers', 'table_threads_per_job', 'leftout_subject', 'all_folds',
+    'model', 'domain_generalization', 'coral_feature_covariance', 'epochs', 'learning_rate', 'gpu', 'project_name_suffix',
+    'transfer_learning', 'proportion_transfer_learning_from_leftout_subject', 'reduce_data_for_transfer_learning',
+    'pretrain_and_finetune', 'finetuning_epochs', 'unlabeled_algorithm', 'batch_size', 'eval_batch_size', 'micro_batch_size',
+    'train_metrics', 'train_metrics_every_k', 'profile_train_metrics', 'profile_startup', 'freeze_backbone', 'frozen_backbone_children',
+    'checkpoint_every', 'checkpoint_dir',
+}
+
+def data_cache_key(args):
+    """Key of the data loaded by Combined_Data.load_data for args. The left out subject matters only as the default target normalization subject."""
+    ignored = DATA_INDEPENDENT_ARGS if not args.target_normalize > 0 else DATA_INDEPENDENT_ARGS - {'leftout_subject'}
+    return tuple(sorted((name, repr(value)) for name, value in vars(args).items() if name not in ignored))
+
 class Combined_Data():
     """Wrapper class that repeats a given functions for all the data. 
     """
+
+    # When set (run_CNN_EMG.py with --table_workers), load_data keeps what it loaded in loaded_data_cache so that runs forked
+    # afterwards reuse it copy-on-write instead of reading the dataset again.
+    cache_loaded_data = False
+    loaded_data_cache = {}
     def __init__(self, x_obj, y_obj, label_obj, env):
 
         self.args = env.args
@@ -128,6 +148,18 @@ class Combined_Data():
                         
                         labels_async = pool.map_async(self.utils.getLabels_separateSessions, [(j+1, i) for j in range(self.utils.num_subjects)])
                         labels.extend(labels_async.get())
+                elif hasattr(self.utils, 'getTargetEMGAndExtrema'):
+                    # the target subject is not normalized, so its EMG comes from the same read of its recordings as the extrema
+                    target_subject = self.args.target_normalize_subject
+                    target_emg, mins, maxes = self.utils.getTargetEMGAndExtrema(target_subject, self.args.target_normalize)
+
+                    emg_async = pool.map_async(self.utils.getEMG, [(i+1, mins, maxes, target_subject) for i in range(self.utils.num_subjects) if i+1 != target_subject])
+
+                    emg = emg_async.get() # (SUBJECT, TRIAL, CHANNEL, TIME)
+                    emg.insert(target_subject-1, target_emg)
+
+                    labels_async = pool.map_async(self.utils.getLabels, [(i+1) for i in range(self.utils.num_subjects)])
+                    labels = labels_async.get()
                 else:
                     mins, maxes = self.utils.getExtrema(self.args.target_normalize_subject, self.args.target_normalize)
                     
@@ -169,17 +201,40 @@ class Combined_Data():
 
     def load_data(self):
 
-        if self.exercises:
-            self.load_ninapro()
-            self.process_ninapro()
+        key = data_cache_key(self.args)
+        if key in Combined_Data.loaded_data_cache:
+            self.restore_loaded_data(Combined_Data.loaded_data_cache[key])
         else:
-            self.load_other_datasets()
+            if self.exercises:
+                self.load_ninapro()
+                self.process_ninapro()
+            else:
+                self.load_other_datasets()
 
-            
+            if Combined_Data.cache_loaded_data:
+                Combined_Data.loaded_data_cache[key] = self.get_loaded_data()
 
         assert len(self.X.data[-1]) == len(self.Y.data[-1]), "Number of trials for X and Y do not match."
         assert len(self.Y.data[-1]) == len(self.label.data[-1]), "Number of trials for Y and Labels do not match."
 
+    def get_loaded_data(self):
+        """Everything load_data sets, for loaded_data_cache."""
+        return {
+            "X": {"data": self.X.data, "length": self.X.length, "width": self.X.width},
+            "Y": {"data": self.Y.data},
+            "label": {"data": self.label.data},
+            "num_gestures": self.env.num_gestures,
+            "num_subjects": self.utils.num_subjects,
+        }
+
+    def restore_loaded_data(self, loaded_data):
+        # Shallow copies of the nested lists so that removing subjects (process_ninapro) does not change the cached data
+        for data_obj, name in [(self.X, "X"), (self.Y, "Y"), (self.label, "label")]:
+            for attr, value in loaded_data[name].items():
+                setattr(data_obj, attr, [list(d) if isinstance(d, list) else d for d in value] if attr == "data" else value)
+        self.env.num_gestures = loaded_data["num_gestures"]
+        self.utils.num_subjects = loaded_data["num_subjects"]
+
     def set_values(self, attr, value):
         self.X.set_values(attr, value)
         self.Y.set_values(attr, value)
@@ -79,6 +79,9 @@ class X_Data(Data):
             if self.args.target_normalize > 0:
                 base_foldername_zarr += 'target_normalize_' + str(self.args.target_normalize) + '/'  
 
+        if self.args.causal_filter:
+            base_foldername_zarr += 'causal_filter/'
+
         if self.args.turn_on_rms:
             base_foldername_zarr += 'RMS_input_windowsize_' + str(self.args.rms_input_windowsize) + '/'
         elif self.args.turn_on_spectrogram:
@@ -12,8 +12,43 @@ import Model.ml_metrics_utils as ml_utils
 import numpy as np
 from torch.utils.data import DataLoader
 import multiprocessing
-from sklearn.metrics import confusion_matrix, classification_report
 import wandb
+import os
+import hashlib
+import copy
+
+class CachedBackboneModel(nn.Module):
+    """
+    Frozen backbone prefix and trainable head of a model. forward() only runs the head, on backbone features cached by CNN_Trainer.set_cached_backbone().
+    """
+
+    def __init__(self, backbone, head):
+        super(CachedBackboneModel, self).__init__()
+        self.backbone = backbone
+        self.head = head
+
+    def forward(self, features):
+        return self.head(features)
+
+def split_backbone(model, args):
+    """
+    Splits the top level child modules of model into a backbone of the first args.frozen_backbone_children (all but the last by default) and the head after it.
+
+    Returns:
+        backbone, head, num_frozen: backbone (in eval mode) and head nn.Sequential modules and the number of children in the backbone.
+    """
+
+    children = list(model.children())
+    num_frozen = args.frozen_backbone_children if args.frozen_backbone_children > 0 else len(children) - 1
+    assert 0 < num_frozen < len(children), f"frozen_backbone_children must be between 1 and {len(children) - 1} for {args.model}."
+
+    # Global pooling followed by a linear layer is flattened in forward() rather than by a module
+    backbone_layers, head_layers = [], []
+    for i, child in enumerate(children):
+        if isinstance(child, nn.Linear) and i > 0 and isinstance(children[i-1], nn.AdaptiveAvgPool2d):
+            (backbone_layers if i - 1 < num_frozen else head_layers).append(nn.Flatten(1))
+        (backbone_layers if i < num_frozen else head_layers).append(child)
+    return nn.Sequential(*backbone_layers).eval(), nn.Sequential(*head_layers), num_frozen
 
 class CNN_Trainer(Model_Trainer):
     """
@@ -50,7 +85,10 @@ class CNN_Trainer(Model_Trainer):
         super().set_criterion()
         super().start_pretrain_run()
         super().set_model_to_device()
+        if self.args.freeze_backbone:
+            self.set_cached_backbone()
         super().set_testrun_foldername()
+        super().save_inference_state()
         super().set_gesture_labels()
         super().plot_images()
 
@@ -145,72 +183,64 @@ class CNN_Trainer(Model_Trainer):
     def set_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learning_rate)
 
-    def print_classification_metrics(self):
+    def set_cached_backbone(self):
         """
-        Batches data for test, train, and validation and plots confusion matrix and classification report.
+        Freezes the first args.frozen_backbone_children child modules of the model (all but the last by default), caches their 
+        activations for every data split to disk once and swaps the datasets and loaders to the cached features, so that 
+        pretraining and finetuning epochs only run the remaining layers (head).
+
+        Only supports models whose forward is the composition of their child modules (CNN backbones); this is checked on two validation samples.
         """
 
-        # Test Batch
+        backbone, head, num_frozen = split_backbone(self.model, self.args)
+        for param in backbone.parameters():
+            param.requires_grad = False
+
         self.model.eval()
         with torch.no_grad():
-            test_predictions = []
-            for X_batch, Y_batch in tqdm(self.test_loader, desc="Test Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                outputs = self.model(X_batch)
-                if isinstance(outputs, dict):
-                    outputs = outputs['logits']
-                preds = np.argmax(outputs.cpu().detach().numpy(), axis=1)
-                test_predictions.extend(preds)
-
-        true_labels = np.argmax(self.Y.test.cpu().detach().numpy(), axis=1)
-        test_predictions = np.array(test_predictions)
-
-        # Calculate and print the confusion matrix
-        conf_matrix = confusion_matrix(true_labels, test_predictions)
-        print("Confusion Matrix:")
-        print(conf_matrix)
-
-        print("Classification Report:")
-        print(classification_report(true_labels, test_predictions))
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.test.cpu().detach().numpy(), axis=1), np.array(test_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'test')  
+            X_check = torch.stack([torch.as_tensor(self.resize_transform(x)) for x in self.X.validation[:2]]).to(self.device).to(torch.float32)
+            expected = ml_utils.get_logits(self.model(X_check))
+            if not torch.allclose(head.eval()(backbone(X_check)), expected, rtol=1e-3, atol=1e-4):
+                raise ValueError(f"freeze_backbone is not supported for {self.args.model}: its forward is not the composition of its child modules.")
 
-        torch.cuda.empty_cache()  # Clear cache if needed 
+        partitions = ['train', 'validation', 'test']
+        if self.args.pretrain_and_finetune:
+            partitions.append('train_finetuning')
 
-        # Validation Metrics
-        self.model.eval()
-        with torch.no_grad():
-            validation_predictions = []
-            for X_batch, Y_batch in tqdm(self.val_loader, desc="Validation Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                outputs = self.model(X_batch)
-                if isinstance(outputs, dict):
-                    outputs = outputs['logits']
-                preds = np.argmax(outputs.cpu().detach().numpy(), axis=1)
-                validation_predictions.extend(preds)
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.validation.cpu().detach().numpy(), axis=1), np.array(validation_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'validation')   
-        torch.cuda.empty_cache()
+        cache_foldername = f'frozen_backbone_features/{self.args.dataset}/{self.args.model}_children{num_frozen}/'
+        os.makedirs(cache_foldername, exist_ok=True)
 
-        # Load training in smaller batches for memory purposes
-        torch.cuda.empty_cache()  # Clear cache if needed
+        self.cached_features = {}
+        for partition in partitions:
+            X = getattr(self.X, partition)
+
+            # Fingerprint the split (shape and a strided sample of values) so that different folds/preprocessing never share a cache file
+            fingerprint = hashlib.sha1(str(tuple(X.shape)).encode())
+            fingerprint.update(X.reshape(-1)[::max(1, X.numel() // 100000)].cpu().numpy().tobytes())
+            cache_filename = f'{cache_foldername}{partition}_{fingerprint.hexdigest()[:16]}.pt'
+
+            if os.path.exists(cache_filename):
+                print(f"Loading cached {partition} backbone features from {cache_filename}")
+                self.cached_features[partition] = torch.load(cache_filename)
+                continue
+
+            features = []
+            loader = super().get_eval_loader(self.CustomDataset(X, getattr(self.Y, partition), transform=self.resize_transform))
+            with torch.no_grad():
+                for X_batch, _ in tqdm(loader, desc=f"Caching {partition} backbone features"):
+                    features.append(backbone(X_batch.to(self.device).to(torch.float32)).to(torch.float16).cpu())
+            self.cached_features[partition] = torch.cat(features, dim=0)
+            torch.save(self.cached_features[partition], cache_filename)
+
+        self.model = CachedBackboneModel(backbone, head).to(self.device)
+        self.set_optimizer()
+
+        # Features are already in memory with no per-sample transform, so the loaders need no workers
+        self.train_dataset = self.CustomDataset(self.cached_features['train'], self.Y.train)
+        self.train_loader = DataLoader(self.train_dataset, batch_size=self.batch_size, shuffle=True, pin_memory=True, drop_last=self.args.force_regression)
+        self.val_loader = DataLoader(self.CustomDataset(self.cached_features['validation'], self.Y.validation), batch_size=self.batch_size, pin_memory=True, drop_last=self.args.force_regression)
+        self.test_loader = DataLoader(self.CustomDataset(self.cached_features['test'], self.Y.test), batch_size=self.batch_size, pin_memory=True, drop_last=self.args.force_regression)
 
-        self.model.eval()
-        self.train_loader_unshuffled = DataLoader(self.train_dataset, batch_size=self.batch_size, num_workers=multiprocessing.cpu_count()//8, worker_init_fn=self.utils.seed_worker, pin_memory=True, drop_last=self.args.force_regression)
-        
-        # Train Metrics
-        with torch.no_grad():
-            train_predictions = []
-            for X_batch, Y_batch in tqdm(self.train_loader_unshuffled, desc="Training Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                outputs = self.model(X_batch)
-                if isinstance(outputs, dict):
-                        outputs = outputs['logits']
-                preds = torch.argmax(outputs, dim=1)
-                train_predictions.extend(preds.cpu().detach().numpy())
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.train.cpu().detach().numpy(), axis=1), np.array(train_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'train')
-    
     def finetune_model(self):
         """
         Start a new loop for finetuning. 
@@ -218,19 +248,23 @@ class CNN_Trainer(Model_Trainer):
 
         self.ft_run = wandb.init(name=self.wandb_runname+"_finetune", project=self.project_name) 
         ft_epochs = self.args.finetuning_epochs
-        finetune_dataset = super().CustomDataset(self.X.train_finetuning,self.Y.train_finetuning, transform=self.resize_transform)
+        if self.args.freeze_backbone:
+            finetune_dataset = super().CustomDataset(self.cached_features['train_finetuning'], self.Y.train_finetuning)
+        else:
+            finetune_dataset = super().CustomDataset(self.X.train_finetuning,self.Y.train_finetuning, transform=self.resize_transform)
         finetune_loader = DataLoader(finetune_dataset, batch_size=self.batch_size, shuffle=True, num_workers=multiprocessing.cpu_count()//8, worker_init_fn=self.utils.seed_worker, pin_memory=True, drop_last=self.args.force_regression)
 
         # Initialize metrics for finetuning training and validation
         ft_training_metrics, ft_validation_metrics, ft_testing_metrics = super().get_metrics()
+        ft_train_tracker = ml_utils.TrainingMetricTracker(ft_training_metrics, self.args, len(finetune_loader.sampler), self.num_classes, self.device)
 
         # Finetuning Loop 
-        for epoch in tqdm(range(ft_epochs), desc="Finetuning Epoch"):
+        start_epoch, val_results = super().load_checkpoint("finetune")
+        for epoch in tqdm(range(start_epoch, ft_epochs), desc="Finetuning Epoch"):
             self.model.train()
             train_loss = 0.0
             
-            for ft_train_metric in ft_training_metrics:
-                ft_train_metric.reset()
+            ft_train_tracker.reset()
 
             with tqdm(finetune_loader, desc=f"Finetuning Epoch {epoch+1}/{ft_epochs}", leave=False) as t:
                 for X_batch, Y_batch in t:
@@ -242,88 +276,42 @@ class CNN_Trainer(Model_Trainer):
                         Y_batch_long = torch.argmax(Y_batch, dim=1)
 
                     self.optimizer.zero_grad()
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-                    loss = self.criterion(output,Y_batch_long)
-                    loss.backward()
+                    loss, output = super().accumulate_gradients(X_batch, Y_batch_long, self.criterion, separable=True)
                     self.optimizer.step()
 
                     train_loss += loss.item()
 
-                    for ft_train_metric in ft_training_metrics:
-                        ft_train_metric(output,Y_batch_long)
+                    ft_train_tracker.update(output, Y_batch_long)
 
                     if not self.args.force_regression: 
                         if t.n % 10 == 0:
-                            ft_accuracy_metric = next(metric for metric in ft_training_metrics if metric.name =="Micro_Accuracy")
-
+                            ft_batch_acc = ft_train_tracker.batch_accuracy()
                             t.set_postfix({
                                 "Batch Loss": loss.item(), 
-                                "Batch Acc": ft_accuracy_metric.compute().item()
+                                **({"Batch Acc": ft_batch_acc} if ft_batch_acc is not None else {})
                             })
 
-            # Finetuning Validation
-            self.model.eval()
-            val_loss = 0.0
-
-            for ft_val_metric in ft_validation_metrics:
-                ft_val_metric.reset()
-
-            if not self.args.force_regression:
-                all_val_outputs = []
-                all_val_labels = []
-
-            with torch.no_grad():
-                for X_batch, Y_batch in self.val_loader:
-                    X_batch = X_batch.to(self.device).to(torch.float32)
-                    Y_batch = Y_batch.to(self.device).to(torch.float32)
-                    if self.args.force_regression:
-                        Y_batch_long =Y_batch
-                    else: 
-                        Y_batch_long = torch.argmax(Y_batch, dim=1)
-
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-                    val_loss += self.criterion(output,Y_batch).item()
-
-                    for ft_val_metric in ft_validation_metrics:
-                        if ft_val_metric.name != "Macro_AUROC" and ft_val_metric.name != "Macro_AUPRC":
-                            ft_val_metric(output,Y_batch_long)
-
-                    if not self.args.force_regression:
-                        all_val_outputs.append(output)
-                        all_val_labels.append(Y_batch_long)
+            # Finetuning Validation (single inference pass shared by loss, metrics, TPR@FPR, FPR@TPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, self.criterion, self.args, ft_validation_metrics)
+            val_loss = val_results["loss"]
+            ft_validation_metrics_values = val_results["metrics_values"]
 
             if not self.args.force_regression:
-                all_val_outputs = torch.cat(all_val_outputs, dim=0)
-                all_val_labels = torch.cat(all_val_labels, dim=0)  
-                Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device)
-
-                true_labels =Y_validation_long.cpu().detach().numpy()
-                test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-                conf_matrix = confusion_matrix(true_labels, test_predictions)
+                conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
                 print("Confusion Matrix:")
-                print(conf_matrix)
-
-                finetune_val_macro_auroc_metric = next(metric for metric in ft_validation_metrics if metric.name == "Macro_AUROC")
-                finetune_val_macro_auprc_metric = next(metric for metric in ft_validation_metrics if metric.name == "Macro_AUPRC")
+                print(conf_matrix.cpu().numpy())
 
-                finetune_val_macro_auroc_metric(all_val_outputs,Y_validation_long)
-                finetune_val_macro_auprc_metric(all_val_outputs,Y_validation_long)
+                tpr_results = val_results["tpr_results"]
+                fpr_results = val_results["fpr_results"]
+                confidence_levels = val_results["confidence_levels"]
+                proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Calculate average loss and metrics
             train_loss /= len(finetune_loader)
-            val_loss /= len(self.val_loader)
-            if not self.args.force_regression: 
-                tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_classes)
-                fpr_results = ml_utils.evaluate_model_fpr_at_tpr(self.model, self.val_loader, self.device, self.num_classes)
-                confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            ft_training_metrics_values = {ft_metric.name: ft_metric.compute() for ft_metric in ft_training_metrics}
-            ft_validation_metrics_values = {ft_metric.name: ft_metric.compute() for ft_metric in ft_validation_metrics}
+            ft_training_metrics_values = ft_train_tracker.compute()
+            ft_train_tracker.print_cost_report()
 
             # Print metric values
             print(f"Finetuning Epoch {epoch+1}/{ft_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
@@ -367,37 +355,73 @@ class CNN_Trainer(Model_Trainer):
                 **({f"confidence_level_accuracies/Val Accuracy at {int(confidence_level*100)}% confidence": acc for confidence_level, acc in confidence_levels.items()} if not self.args.force_regression else {}),
                 **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {})
             })
+
+            super().save_checkpoint("finetune", epoch+1, ft_epochs, val_results)
         
         
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'self.model/self.modelParameters_{self.formatted_datetime}.pth')
 
         # Evaluate the self.model on the test set
-        ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.
+        test_results = ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.
         device, self.num_gestures, self.criterion, self.args, ft_testing_metrics)
 
         if not self.args.force_regression:
-            self.print_classification_metrics()
+            self.print_classification_metrics(test_results, val_results)
         self.ft_run.finish() 
 
+    def pretrain_multiple_seeds(self):
+        """
+        Pretraining with --num_seeds copies of the head, side by side on the cached backbone features (--freeze_backbone). The copies
+        start from the same pretrained head layers with the final linear classifier re-initialized from each seed, and each copy is
+        evaluated on the test set with its metrics logged under seed_<seed>/. Each copy is saved with the backbone, as model_<datetime>.pth
+        is without --num_seeds.
+        """
+        backbone, head = self.model.backbone, self.model.head
+
+        def build_head():
+            seed_head = copy.deepcopy(head)
+            [module for module in seed_head.modules() if isinstance(module, nn.Linear)][-1].reset_parameters()
+            return seed_head
+
+        def prepare_batch(X_batch, Y_batch):
+            X_batch = X_batch.to(self.device).to(torch.float32)
+            Y_batch = Y_batch.to(self.device).to(torch.float32)
+            return X_batch, Y_batch, Y_batch if self.args.force_regression else torch.argmax(Y_batch, dim=1)
+
+        def full_state_dict(head_state_dict):
+            seed_head = copy.deepcopy(head)
+            seed_head.load_state_dict(head_state_dict)
+            return CachedBackboneModel(backbone, seed_head).state_dict()
+
+        seed_heads, _ = super().train_multiple_seeds(build_head, prepare_batch, seed_state_dict_fn=full_state_dict)
+
+        _, _, testing_metrics = super().get_metrics()
+        for seed, seed_head in zip(self.model.seeds, seed_heads):
+            ml_utils.evaluate_model_on_test_set(CachedBackboneModel(backbone, seed_head), self.test_loader, self.device, self.num_gestures, self.criterion, self.args, testing_metrics, log_prefix=f"seed_{seed}/")
+
+        self.pretrain_run.finish()
+
     def pretrain_model(self):
         """
         Train and validation loop for the pretraining phase.
         """
 
+        if self.args.num_seeds > 1:
+            self.pretrain_multiple_seeds()
+            return
+
         training_metrics, validation_metrics, testing_metrics = super().get_metrics()
 
-        for epoch in tqdm(range(self.num_epochs), desc="Epoch"):
+        train_tracker = ml_utils.TrainingMetricTracker(training_metrics, self.args, len(self.train_loader.sampler), self.num_classes, self.device)
+
+        start_epoch, val_results = super().load_checkpoint("pretrain")
+        for epoch in tqdm(range(start_epoch, self.num_epochs), desc="Epoch"):
             self.model.train()
             train_loss = 0.0
 
             # Reset training metrics at the start of each epoch
-            for train_metric in training_metrics:
-                train_metric.reset()
-            
-            if not self.args.force_regression:
-                outputs_train_all = []
-                ground_truth_train_all = []
+            train_tracker.reset()
 
             with tqdm(self.train_loader, desc=f"Epoch {epoch+1}/{self.num_epochs}", leave=False) as t:
 
@@ -411,103 +435,41 @@ class CNN_Trainer(Model_Trainer):
                        Y_batch_long = torch.argmax(Y_batch, dim=1)
 
                     self.optimizer.zero_grad()
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-                    loss = self.criterion(output, Y_batch)
-                    loss.backward()
+                    loss, output = super().accumulate_gradients(X_batch, Y_batch, self.criterion, separable=True)
                     self.optimizer.step()
 
-                    if not self.args.force_regression:
-                        outputs_train_all.append(output)
-                        ground_truth_train_all.append(torch.argmax(Y_batch, dim=1))
-
                     train_loss += loss.item()
 
-                    for train_metric in training_metrics:
-                        if train_metric.name != "Macro_AUROC" and train_metric.name != "Macro_AUPRC":
-                            train_metric(output,Y_batch_long)
+                    train_tracker.update(output, Y_batch_long)
 
                     if not self.args.force_regression:
-                        micro_accuracy_metric = next(metric for metric in training_metrics if metric.name == "Micro_Accuracy")
                         if t.n % 10 == 0:
+                            batch_acc = train_tracker.batch_accuracy()
                             t.set_postfix({
                                 "Batch Loss": loss.item(), 
-                                "Batch Acc": micro_accuracy_metric.compute().item()
+                                **({"Batch Acc": batch_acc} if batch_acc is not None else {})
                             })
-                
-                if not self.args.force_regression:
-                    outputs_train_all = torch.cat(outputs_train_all, dim=0).to(self.device)
-                    ground_truth_train_all = torch.cat(ground_truth_train_all, dim=0).to(self.device)
 
-            if not self.args.force_regression: 
-                train_macro_auroc_metric = next(metric for metric in training_metrics if metric.name == "Macro_AUROC")
-                train_macro_auprc_metric = next(metric for metric in training_metrics if metric.name == "Macro_AUPRC")
-
-                train_macro_auroc_metric(outputs_train_all,   ground_truth_train_all)
-                train_macro_auprc_metric(outputs_train_all, ground_truth_train_all)
-
-            # Validation phase
-            self.model.eval()
-            val_loss = 0.0
-
-            for val_metric in validation_metrics:
-                val_metric.reset()
-
-            all_val_outputs = []
-            all_val_labels = []
-
-            with torch.no_grad():
-            
-                for X_batch, Y_batch in self.val_loader:
-                    X_batch = X_batch.to(self.device).to(torch.float32)
-                    Y_batch =Y_batch.to(self.device).to(torch.float32)
-                    if self.args.force_regression:
-                       Y_batch_long =Y_batch
-                    else: 
-                       Y_batch_long = torch.argmax(Y_batch, dim=1)
-
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-
-                    if not self.args.force_regression:
-                        all_val_outputs.append(output)
-                        all_val_labels.append(Y_batch_long)
-                 
-                    val_loss += self.criterion(output,Y_batch).item()
-
-                    for val_metric in validation_metrics:
-                        if val_metric.name != "Macro_AUROC" and val_metric.name != "Macro_AUPRC":
-                            val_metric(output,Y_batch_long)
+            # Validation phase (single inference pass shared by loss, metrics, TPR@FPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, self.criterion, self.args, validation_metrics, fpr_at_tpr=False)
+            val_loss = val_results["loss"]
+            validation_metrics_values = val_results["metrics_values"]
 
             if not self.args.force_regression:
-                all_val_outputs = torch.cat(all_val_outputs, dim=0)
-                all_val_labels = torch.cat(all_val_labels, dim=0)
-                Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device)
-                true_labels =Y_validation_long.cpu().detach().numpy()
-                test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-                conf_matrix = confusion_matrix(true_labels, test_predictions)
+                conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
                 print("Confusion Matrix:")
-                print(conf_matrix)
-
-                val_macro_auroc_metric = next(metric for metric in validation_metrics if metric.name == "Macro_AUROC")
-                val_macro_auprc_metric = next(metric for metric in validation_metrics if metric.name == "Macro_AUPRC")
+                print(conf_matrix.cpu().numpy())
 
-                val_macro_auroc_metric(all_val_outputs,Y_validation_long)
-                val_macro_auprc_metric(all_val_outputs,Y_validation_long)
+                tpr_results = val_results["tpr_results"]
+                confidence_levels = val_results["confidence_levels"]
+                proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Calculate average loss and metrics
             train_loss /= len(self.train_loader)
-            val_loss /= len(self.val_loader)
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            training_metrics_values = {metric.name: metric.compute() for metric in training_metrics}
-            validation_metrics_values = {metric.name: metric.compute() for metric in validation_metrics}
-
-            if not self.args.force_regression:
-                tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_classes)
-                confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
+            training_metrics_values = train_tracker.compute()
+            train_tracker.print_cost_report()
 
             # Print metric values
             print(f"Epoch {epoch+1}/{self.num_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
@@ -556,14 +518,16 @@ class CNN_Trainer(Model_Trainer):
                 **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {}),
             })
 
+            super().save_checkpoint("pretrain", epoch+1, self.num_epochs, val_results)
+
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'model/modelParameters_{self.formatted_datetime}.pth')
 
         # Evaluate performance on test metrics
-        ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.device, self.num_gestures, self.criterion, self.args, testing_metrics)
+        test_results = ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.device, self.num_gestures, self.criterion, self.args, testing_metrics)
 
         if not self.args.force_regression:
-            self.print_classification_metrics()
+            self.print_classification_metrics(test_results, val_results)
         self.pretrain_run.finish()
         
 
@@ -18,7 +18,6 @@ import Model.ml_metrics_utils as ml_utils
 import numpy as np
 from torch.utils.data import DataLoader
 import multiprocessing
-from sklearn.metrics import confusion_matrix, classification_report
 import wandb
 import torch.autograd as autograd
 import torch.nn.functional as F
@@ -139,6 +138,94 @@ class CorrelationAlignmentLoss(nn.Module):
 
         return mean_diff + cov_diff
 
+class PairwiseCorrelationAlignmentLoss(nn.Module):
+    r"""Correlation alignment loss averaged over every pair of domains in a batch.
+
+    By default, each pair is compared by CorrelationAlignmentLoss on the transposed features :math:`(d, n)` of both
+    domains, the larger one randomly downsampled to the size of the smaller one, so means and covariances are taken
+    over the feature dimension (an :math:`n \times n` covariance). This is the loss the CORAL runs were tuned with.
+    Centering is per sample, so each domain's centered features and full :math:`n \times n` covariance are computed once and
+    every pair only gathers the rows and columns of its downsampled samples (drawn with the same randperm calls as before).
+    When all domains have the same size (no downsampling), every pair is computed at once from these covariances.
+
+    With feature_covariance, the mean and covariance of each domain's features are computed once, then the mean and
+    covariance distances of all :math:`D(D-1)/2` domain pairs are built from Gram matrices (batched matmuls) instead of
+    one call per pair. For domains :math:`i, j` with feature means :math:`\mu_i, \mu_j` and covariances :math:`C_i, C_j`
+
+    .. math::
+        l_{ij} = \frac{1}{d}\Vert \mu_i-\mu_j \Vert^2 + \frac{1}{d^2}\Vert C_i-C_j \Vert^2_F
+
+    Since :math:`C_i` is :math:`d \times d` for any number of samples, domains of different sizes are compared without downsampling.
+    This is the usual Deep CORAL covariance, but its scale differs from the default, so the penalty weight is not tuned for it.
+
+    Args:
+        feature_covariance (bool, optional): compare the :math:`d \times d` feature covariances. Defaults to False.
+
+    Inputs:
+        - features (tensor): feature representations of the batch, grouped by domain
+        - domain_sizes (list): number of samples of each domain in the batch, in order
+
+    Shape:
+        - features: :math:`(N, d)` where d means the dimension of input features and :math:`N` is the mini-batch size.
+        - Outputs: scalar, mean of :math:`l_{ij}` over the domain pairs.
+    """
+
+    def __init__(self, feature_covariance=False):
+        super(PairwiseCorrelationAlignmentLoss, self).__init__()
+        self.feature_covariance = feature_covariance
+
+    @staticmethod
+    def pairwise_squared_distances(x):
+        # ||x_i - x_j||^2 = ||x_i||^2 + ||x_j||^2 - 2 <x_i, x_j>
+        gram = x @ x.t()
+        squared_norms = gram.diagonal()
+        return (squared_norms.unsqueeze(0) + squared_norms.unsqueeze(1) - 2 * gram).clamp(min=0)
+
+    def forward(self, features: torch.Tensor, domain_sizes) -> torch.Tensor:
+        num_domains = len(domain_sizes)
+        if num_domains < 2:
+            return features.new_zeros(())
+
+        d = features.shape[1]
+        pairs = torch.triu(torch.ones(num_domains, num_domains, dtype=torch.bool, device=features.device), diagonal=1)
+
+        if not self.feature_covariance:
+            # CorrelationAlignmentLoss on the transposed (d, n) features: per sample means over the features and (n, n) covariances
+            features_per_domains = [f.transpose(0, 1) for f in features.split(domain_sizes, dim=0)]
+            sample_means = [f.mean(0) for f in features_per_domains]
+            sample_covs = [torch.mm((f - m).t(), f - m) / (d - 1) for f, m in zip(features_per_domains, sample_means)]
+
+            if len(set(domain_sizes)) == 1:
+                n = domain_sizes[0]
+                mean_diff = self.pairwise_squared_distances(torch.stack(sample_means)) / n
+                cov_diff = self.pairwise_squared_distances(torch.stack(sample_covs).reshape(num_domains, -1)) / (n * n)
+                return (mean_diff + cov_diff)[pairs].mean()
+
+            loss = 0
+            for domain_i in range(num_domains):
+                for domain_j in range(domain_i + 1, num_domains):
+                    n_i, n_j = domain_sizes[domain_i], domain_sizes[domain_j]
+                    idx_i = torch.randperm(n_i)[:n_j].to(features.device) if n_i > n_j else torch.arange(n_i, device=features.device)
+                    idx_j = torch.randperm(n_j)[:n_i].to(features.device) if n_j > n_i else torch.arange(n_j, device=features.device)
+                    mean_i, mean_j = sample_means[domain_i][idx_i], sample_means[domain_j][idx_j]
+                    cov_i, cov_j = sample_covs[domain_i][idx_i][:, idx_i], sample_covs[domain_j][idx_j][:, idx_j]
+                    loss += (mean_i - mean_j).pow(2).mean() + (cov_i - cov_j).pow(2).mean()
+            return loss / (num_domains * (num_domains - 1) / 2)
+
+        # (D, max domain size, d), zero padded
+        per_domain = nn.utils.rnn.pad_sequence(list(features.split(domain_sizes, dim=0)), batch_first=True)
+        counts = torch.tensor(domain_sizes, dtype=features.dtype, device=features.device).unsqueeze(1)
+        is_sample = torch.arange(per_domain.shape[1], device=features.device).unsqueeze(0) < counts
+
+        means = per_domain.sum(1) / counts.clamp(min=1)
+        centered = (per_domain - means.unsqueeze(1)) * is_sample.unsqueeze(-1)
+        covs = torch.bmm(centered.transpose(1, 2), centered) / (counts - 1).clamp(min=1).unsqueeze(-1)
+
+        mean_diff = self.pairwise_squared_distances(means) / d
+        cov_diff = self.pairwise_squared_distances(covs.reshape(num_domains, -1)) / (d * d)
+
+        return (mean_diff + cov_diff)[pairs].mean()
+
 class CORAL_Trainer(Model_Trainer):
 
     """
@@ -191,7 +278,7 @@ class CORAL_Trainer(Model_Trainer):
             self.pretrain_and_finetune(testing_metrics)
         
     def set_criterion(self):
-        self.criterion = CorrelationAlignmentLoss()
+        self.criterion = PairwiseCorrelationAlignmentLoss(feature_covariance=self.args.coral_feature_covariance)
         self.cross_entropy = nn.CrossEntropyLoss()
 
     def set_model(self):
@@ -220,84 +307,16 @@ class CORAL_Trainer(Model_Trainer):
     def set_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learning_rate)
 
-    def print_classification_metrics(self):
-        """
-        Batches data for test, train, and validation and plots confusion matrix and classification report.
-        """
-
-        # Test Batch
-        self.model.eval()
-        with torch.no_grad():
-            test_predictions = []
-            for X_batch, Y_batch in tqdm(self.test_loader, desc="Test Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                output, _ = self.model(X_batch)
-                if isinstance(output, dict):
-                    output = output['logits']
-                preds = np.argmax(output.cpu().detach().numpy(), axis=1)
-                test_predictions.extend(preds)
-
-        true_labels = np.argmax(self.Y.test.cpu().detach().numpy(), axis=1)
-        test_predictions = np.array(test_predictions)
-
-        # Calculate and print the confusion matrix
-        conf_matrix = confusion_matrix(true_labels, test_predictions)
-        print("Confusion Matrix:")
-        print(conf_matrix)
-
-        print("Classification Report:")
-        print(classification_report(true_labels, test_predictions))
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.test.cpu().detach().numpy(), axis=1), np.array(test_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'test')  
-
-        torch.cuda.empty_cache()  # Clear cache if needed 
-
-        # Validation Metrics
-        self.model.eval()
-        with torch.no_grad():
-            validation_predictions = []
-            for X_batch, Y_batch in tqdm(self.val_loader, desc="Validation Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                output, _ = self.model(X_batch)
-                if isinstance(output, dict):
-                    output = output['logits']
-                preds = np.argmax(output.cpu().detach().numpy(), axis=1)
-
-                validation_predictions.extend(preds)
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.validation.cpu().detach().numpy(), axis=1), np.array(validation_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'validation')   
-        torch.cuda.empty_cache()
-
-        # Load training in smaller batches for memory purposes
-        torch.cuda.empty_cache()  # Clear cache if needed
-
-        self.model.eval()
-        self.train_loader_unshuffled = DataLoader(self.train_dataset, batch_size=self.batch_size, num_workers=multiprocessing.cpu_count()//8, worker_init_fn=self.utils.seed_worker, pin_memory=True, drop_last=self.args.force_regression)
-        
-        # Train Metrics
-        with torch.no_grad():
-            train_predictions = []
-            for X_batch, Y_batch in tqdm(self.train_loader_unshuffled, desc="Training Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                output, _ = self.model(X_batch)
-                if isinstance(output, dict):
-                        output = output['logits']
-                preds = torch.argmax(output, dim=1)
-
-                train_predictions.extend(preds.cpu().detach().numpy())
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.train.cpu().detach().numpy(), axis=1), np.array(train_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'train')
-    
     def pretrain_and_finetune(self, testing_metrics):
         """
         Finish current run and start a new run for finetuning.
         """
 
         # Evaluate performance on test metrics
-        ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.device, self.num_gestures, self.cross_entropy, self.args, testing_metrics)
+        test_results = ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.device, self.num_gestures, self.cross_entropy, self.args, testing_metrics)
 
         if not self.args.force_regression:
-            self.print_classification_metrics()
+            self.print_classification_metrics(test_results, self.validation_results)
             
         self.pretrain_run.finish()
 
@@ -319,15 +338,16 @@ class CORAL_Trainer(Model_Trainer):
 
         # Initialize metrics for finetuning training and validation
         ft_training_metrics, ft_validation_metrics, testing_metrics = super().get_metrics()
+        ft_train_tracker = ml_utils.TrainingMetricTracker(ft_training_metrics, self.args, len(finetune_loader.sampler), self.num_classes, self.device)
 
         # Finetuning Loop 
-        for epoch in tqdm(range(ft_epochs), desc="Finetuning Epoch"):
+        start_epoch, val_results = super().load_checkpoint("finetune")
+        for epoch in tqdm(range(start_epoch, ft_epochs), desc="Finetuning Epoch"):
             self.model.train()
             train_loss = 0.0
             
 
-            for ft_train_metric in ft_training_metrics:
-                ft_train_metric.reset()
+            ft_train_tracker.reset()
 
             with tqdm(finetune_loader, desc=f"Finetuning Epoch {epoch+1}/{ft_epochs}", leave=False) as t:
                 for X_batch, Y_batch in t:
@@ -336,101 +356,42 @@ class CORAL_Trainer(Model_Trainer):
                     Y_batch_long = torch.argmax(Y_batch, dim=1)
 
                     self.optimizer.zero_grad()
-                    output, features = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-
-
-                    output_for_loso = output
-                    feature_for_loso = features
-                    labels_for_loso = Y_batch
-
-                    loss_ce = 0
-                    loss_penalty = 0
-
-                    # calculate cross entropy across 
-                    loss_ce = self.cross_entropy(output_for_loso, labels_for_loso)
-
-                    # no other domains to cross compare with 
-                    loss = loss_ce
-            
-
-                    loss.backward()
+                    # cross entropy only, as there are no other domains to cross compare with
+                    loss, output = super().accumulate_gradients(X_batch, Y_batch, self.cross_entropy, separable=True)
                     self.optimizer.step()
 
                     train_loss += loss.item()
 
-                    for ft_train_metric in ft_training_metrics:
-                        ft_train_metric(output,Y_batch_long)
+                    ft_train_tracker.update(output, Y_batch_long)
 
                     if t.n % 10 == 0:
-                        ft_accuracy_metric = next(metric for metric in ft_training_metrics if metric.name =="Micro_Accuracy")
-
+                        ft_batch_acc = ft_train_tracker.batch_accuracy()
                         t.set_postfix({
                             "Batch Loss": loss.item(), 
-                            "Batch Acc": ft_accuracy_metric.compute().item()
+                            **({"Batch Acc": ft_batch_acc} if ft_batch_acc is not None else {})
                         })
 
 
-            # Finetuning Validation
-            self.model.eval()
-            val_loss = 0.0
-
-            for ft_val_metric in ft_validation_metrics:
-                ft_val_metric.reset()
-
-           
-            all_val_outputs = []
-            all_val_labels = []
-
-
-            with torch.no_grad():
-                for X_batch, Y_batch in self.val_loader:
-                    X_batch = X_batch.to(self.device).to(torch.float32)
-                    Y_batch = Y_batch.to(self.device).to(torch.float32) 
-                    Y_batch_long = torch.argmax(Y_batch, dim=1)
-
-                    output, _ = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-                    val_loss += self.cross_entropy(output,Y_batch).item()
-
-
-                    for ft_val_metric in ft_validation_metrics:
-                        if ft_val_metric.name != "Macro_AUROC" and ft_val_metric.name != "Macro_AUPRC":
-                            ft_val_metric(output,Y_batch_long)
-
-                    all_val_outputs.append(output)
-                    all_val_labels.append(Y_batch_long)
-
-            all_val_outputs = torch.cat(all_val_outputs, dim=0)
-            all_val_labels = torch.cat(all_val_labels, dim=0)  
-            Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device)
+            # Finetuning Validation (single inference pass shared by loss, metrics, TPR@FPR, FPR@TPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, self.cross_entropy, self.args, ft_validation_metrics)
+            val_loss = val_results["loss"]
+            ft_validation_metrics_values = val_results["metrics_values"]
 
-            true_labels =Y_validation_long.cpu().detach().numpy()
-            test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-            conf_matrix = confusion_matrix(true_labels, test_predictions)
+            conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
             print("Confusion Matrix:")
-            print(conf_matrix)
-
-            finetune_val_macro_auroc_metric = next(metric for metric in ft_validation_metrics if metric.name == "Macro_AUROC")
-            finetune_val_macro_auprc_metric = next(metric for metric in ft_validation_metrics if metric.name == "Macro_AUPRC")
-
-            finetune_val_macro_auroc_metric(all_val_outputs,Y_validation_long)
-            finetune_val_macro_auprc_metric(all_val_outputs,Y_validation_long)
+            print(conf_matrix.cpu().numpy())
 
+            tpr_results = val_results["tpr_results"]
+            fpr_results = val_results["fpr_results"]
+            confidence_levels = val_results["confidence_levels"]
+            proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Calculate average loss and metrics
             train_loss /= len(finetune_loader)
-            val_loss /= len(self.val_loader)
-            tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_gestures)
-            fpr_results = ml_utils.evaluate_model_fpr_at_tpr(self.model, self.val_loader, self.device, self.num_gestures)
-            confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
-
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            ft_training_metrics_values = {ft_metric.name: ft_metric.compute() for ft_metric in ft_training_metrics}
-            ft_validation_metrics_values = {ft_metric.name: ft_metric.compute() for ft_metric in ft_validation_metrics}
+            ft_training_metrics_values = ft_train_tracker.compute()
+            ft_train_tracker.print_cost_report()
 
             # Print metric values
             print(f"Finetuning Epoch {epoch+1}/{ft_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
@@ -474,25 +435,62 @@ class CORAL_Trainer(Model_Trainer):
                 **({f"confidence_level_accuracies/Val Accuracy at {int(confidence_level*100)}% confidence": acc for confidence_level, acc in confidence_levels.items()} if not self.args.force_regression else {}),
                 **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {})
             })
+
+            super().save_checkpoint("finetune", epoch+1, ft_epochs, val_results)
         
         
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'self.model/self.modelParameters_{self.formatted_datetime}.pth')
 
         # Evaluate the self.model on the test set
-        ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.
+        test_results = ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.
         device, self.num_gestures, self.cross_entropy, self.args, testing_metrics)
 
-        self.print_classification_metrics()
+        self.print_classification_metrics(test_results, val_results)
         self.ft_run.finish() 
 
 
+    def domain_loss(self, outputs, Y_batch):
+        """Cross entropy averaged over domains plus the correlation alignment penalty, for a batch ordered by domain (RandomDomainSampler)."""
+        output, features = outputs
+        if isinstance(output, dict):
+            output = output['logits']
+
+        prop_per_domain = self.sampler.get_prop_per_domain()
+
+        # seperate into different domains
+        output_per_domains = output.split(prop_per_domain, dim=0)
+        labels_per_domains = Y_batch.split(prop_per_domain, dim=0)
+
+        loss_ce = 0 
+
+        n_domains_per_batch = self.utils.num_subjects - 1
+
+        for domain_i in range(n_domains_per_batch):
+            
+            output_i = output_per_domains[domain_i]
+            labels_i = labels_per_domains[domain_i]
+
+            # calculate cross entropy across domain
+            loss_ce += self.cross_entropy(output_i, labels_i)
+
+        # normalize loss
+        loss_ce /= n_domains_per_batch
+
+        # correlation alignment loss averaged over every pair of domains
+        loss_penalty = self.criterion(features, prop_per_domain)
+
+        return loss_ce + loss_penalty
+
     def train_and_validate(self, training_metrics, validation_metrics):
         """
         Train and validation loop. 
         """
 
-        for epoch in tqdm(range(self.num_epochs), desc="Epoch"):
+        train_tracker = ml_utils.TrainingMetricTracker(training_metrics, self.args, len(self.train_loader.sampler), self.num_classes, self.device)
+
+        start_epoch, val_results = super().load_checkpoint("pretrain")
+        for epoch in tqdm(range(start_epoch, self.num_epochs), desc="Epoch"):
             
             self.model.train()
             
@@ -500,11 +498,7 @@ class CORAL_Trainer(Model_Trainer):
             train_loss = 0.0
 
             # Reset training metrics at the start of each epoch
-            for train_metric in training_metrics:
-                train_metric.reset()
-        
-            outputs_train_all = [] 
-            ground_truth_train_all = []
+            train_tracker.reset()
 
 
             batch_no = 0 
@@ -521,134 +515,41 @@ class CORAL_Trainer(Model_Trainer):
                     Y_batch_long = torch.argmax(Y_batch, dim=1)
 
                     self.optimizer.zero_grad()
-
-                    output, features = self.model(X_batch)
-
-                    if isinstance(output, dict):
-                        output = output['logits']
-
-                    # seperate into different domains
-                    output_per_domains = output.split(prop_per_domain, dim=0)
-                    features_per_domains = features.split(prop_per_domain, dim=0)
-                    labels_per_domains = Y_batch.split(prop_per_domain, dim=0)
-
-                    loss_ce = 0 
-                    loss_penalty = 0
-
-                    n_domains_per_batch = self.utils.num_subjects - 1
-
-                    for domain_i in range(n_domains_per_batch):
-                        
-                        output_i = output_per_domains[domain_i]
-                        labels_i = labels_per_domains[domain_i]
-
-                        # calculate cross entropy across domain
-                        loss_ce += self.cross_entropy(output_i, labels_i)
-                        
-                        # calculate correlation alignment loss with subsequent domains
-                        for domain_j in range(domain_i + 1, n_domains_per_batch):
-                            features_i = features_per_domains[domain_i].transpose(0,1)
-                            features_j = features_per_domains[domain_j].transpose(0,1)
-                            loss_penalty += self.criterion(features_i, features_j)
-
-                    # normalize loss
-                    loss_ce /= n_domains_per_batch
-                    loss_penalty /= n_domains_per_batch * (n_domains_per_batch - 1) / 2
-
-                    loss = loss_ce + loss_penalty
-
-                    loss.backward()
+                    loss, (output, features) = super().accumulate_gradients(X_batch, Y_batch, self.domain_loss, forward_fn=self.model, prop_per_domain=prop_per_domain)
                     self.optimizer.step() 
 
-                    outputs_train_all.append(output)
-                    ground_truth_train_all.append(torch.argmax(Y_batch, dim=1))
-
-
                     train_loss += loss.item()
 
-                    for train_metric in training_metrics:
-                        if train_metric.name != "Macro_AUROC" and train_metric.name != "Macro_AUPRC":
-                            train_metric(output, Y_batch_long)
-                   
-                    micro_accuracy_metric = next(metric for metric in training_metrics if metric.name == "Micro_Accuracy")
+                    train_tracker.update(output, Y_batch_long)
+
                     if t.n % 10 == 0:
+                        batch_acc = train_tracker.batch_accuracy()
                         t.set_postfix({
                             "Batch Loss": loss.item(), 
-                            "Batch Acc": micro_accuracy_metric.compute().item()
+                            **({"Batch Acc": batch_acc} if batch_acc is not None else {})
                         })
                     
                     batch_no += 1
-                outputs_train_all = torch.cat(outputs_train_all, dim=0).to(self.device)
-                ground_truth_train_all = torch.cat(ground_truth_train_all, dim=0).to(self.device)
-
-            train_macro_auroc_metric = next(metric for metric in training_metrics if metric.name == "Macro_AUROC")
-            train_macro_auprc_metric = next(metric for metric in training_metrics if metric.name == "Macro_AUPRC")
-
-            train_macro_auroc_metric(outputs_train_all,   ground_truth_train_all)
-            train_macro_auprc_metric(outputs_train_all, ground_truth_train_all)
-
-
-            # Validation phase
-            self.model.eval()
-            val_loss = 0.0
-
-            for val_metric in validation_metrics:
-                val_metric.reset()
-
-            all_val_outputs = []
-            all_val_labels = []
-
-            with torch.no_grad():
-            
-                for X_batch, Y_batch in self.val_loader:
-                    
-                    X_batch = X_batch.to(self.device).to(torch.float32)
-                    Y_batch = Y_batch.to(self.device).to(torch.float32)
-                    Y_batch_long = torch.argmax(Y_batch, dim=1)
-
-                    output, _ = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-
-                    all_val_outputs.append(output)
-                    all_val_labels.append(Y_batch_long)
-                 
-                    val_loss += self.cross_entropy(output, Y_batch).item()
 
+            # Validation phase (single inference pass shared by loss, metrics, TPR@FPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, self.cross_entropy, self.args, validation_metrics, fpr_at_tpr=False)
+            val_loss = val_results["loss"]
+            validation_metrics_values = val_results["metrics_values"]
 
-                    for val_metric in validation_metrics:
-                        if val_metric.name != "Macro_AUROC" and val_metric.name != "Macro_AUPRC":
-                            val_metric(output,Y_batch_long)
-
-            all_val_outputs = torch.cat(all_val_outputs, dim=0)
-            all_val_labels = torch.cat(all_val_labels, dim=0)
-            Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device)
-            true_labels = Y_validation_long.cpu().detach().numpy()
-            test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-
-    
-            conf_matrix = confusion_matrix(true_labels, test_predictions)
+            conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
             print("Confusion Matrix:")
-            print(conf_matrix)
-
-            val_macro_auroc_metric = next(metric for metric in validation_metrics if metric.name == "Macro_AUROC")
-            val_macro_auprc_metric = next(metric for metric in validation_metrics if metric.name == "Macro_AUPRC")
-
-            val_macro_auroc_metric(all_val_outputs,Y_validation_long)
-            val_macro_auprc_metric(all_val_outputs,Y_validation_long)
+            print(conf_matrix.cpu().numpy())
 
+            tpr_results = val_results["tpr_results"]
+            confidence_levels = val_results["confidence_levels"]
+            proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Calculate average loss and metrics
             train_loss /= len(self.train_loader)
-            val_loss /= len(self.val_loader)
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            training_metrics_values = {metric.name: metric.compute() for metric in training_metrics}
-            validation_metrics_values = {metric.name: metric.compute() for metric in validation_metrics}
-
-            tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_classes)
-            confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
-
+            training_metrics_values = train_tracker.compute()
+            train_tracker.print_cost_report()
 
             # Print metric values
             print(f"Epoch {epoch+1}/{self.num_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
@@ -696,14 +597,19 @@ class CORAL_Trainer(Model_Trainer):
                 **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {}),
             })
 
+            super().save_checkpoint("pretrain", epoch+1, self.num_epochs, val_results)
+
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'model/modelParameters_{self.formatted_datetime}.pth')
 
+        # Last epoch's validation logits, reused for the validation confusion matrix
+        self.validation_results = val_results
+
         # If pretrain and finetune, continue. Otherwise, here.
         if not self.args.pretrain_and_finetune:
 
             if not self.args.force_regression: 
-                self.print_classification_metrics()
+                self.print_classification_metrics(validation_results=self.validation_results)
             self.pretrain_run.finish()
 
 
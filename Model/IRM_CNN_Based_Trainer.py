@@ -16,7 +16,6 @@ import Model.ml_metrics_utils as ml_utils
 import numpy as np
 from torch.utils.data import DataLoader
 import multiprocessing
-from sklearn.metrics import confusion_matrix, classification_report
 import wandb
 import torch.autograd as autograd
 import torch.nn.functional as F
@@ -29,25 +28,41 @@ class InvariancePenaltyLoss(nn.Module):
     labels are :math:`labels_1, labels_2`. Next we calculate cross entropy loss with respect to a dummy classifier
     :math:`w`, resulting in :math:`grad_1, grad_2` . Invariance penalty is then :math:`grad_1*grad_2`.
 
+    If the batch is made of several domains (consecutive chunks of domain_sizes samples), the penalty is computed
+    per domain and averaged. All domains are handled at once: every (half, domain) segment gets its own dummy scale,
+    the segment losses are reduced with index_add and a single autograd.grad returns all :math:`grad_1, grad_2`.
+
     Inputs:
         - y: predictions from model
-        - labels: ground truth
+        - labels: ground truth (class indices or class probabilities)
+        - domain_sizes (optional): number of samples of each domain, in order. Whole batch is one domain by default.
 
     Shape:
         - y: :math:`(N, C)` where C means the number of classes.
-        - labels: :math:`(N, )` where N mean mini-batch size
+        - labels: :math:`(N, )` or :math:`(N, C)` where N mean mini-batch size
     """
 
     def __init__(self):
         super(InvariancePenaltyLoss, self).__init__()
-        self.scale = torch.tensor(1.).requires_grad_()
-
-    def forward(self, y: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
-        loss_1 = F.cross_entropy(y[::2] * self.scale, labels[::2])
-        loss_2 = F.cross_entropy(y[1::2] * self.scale, labels[1::2])
-        grad_1 = autograd.grad(loss_1, [self.scale], create_graph=True)[0]
-        grad_2 = autograd.grad(loss_2, [self.scale], create_graph=True)[0]
-        penalty = torch.sum(grad_1 * grad_2)
+
+    def forward(self, y: torch.Tensor, labels: torch.Tensor, domain_sizes=None) -> torch.Tensor:
+        if domain_sizes is None:
+            domain_sizes = [len(y)]
+        num_domains = len(domain_sizes)
+
+        # Segment of each sample: even/odd position within its domain, then domain
+        sizes = torch.as_tensor(domain_sizes, device=y.device)
+        domain = torch.repeat_interleave(torch.arange(num_domains, device=y.device), sizes)
+        position = torch.arange(len(y), device=y.device) - (torch.cumsum(sizes, dim=0) - sizes)[domain]
+        segment = (position % 2) * num_domains + domain
+
+        scale = torch.ones(2 * num_domains, dtype=y.dtype, device=y.device, requires_grad=True)
+        losses = F.cross_entropy(y * scale[segment].unsqueeze(1), labels, reduction='none')
+        counts = torch.bincount(segment, minlength=2 * num_domains).clamp(min=1)
+        segment_losses = torch.zeros(2 * num_domains, dtype=losses.dtype, device=y.device).index_add(0, segment, losses) / counts
+
+        grads = autograd.grad(segment_losses.sum(), [scale], create_graph=True)[0].view(2, num_domains)
+        penalty = torch.mean(grads[0] * grads[1])
         return penalty
 
 
@@ -196,82 +211,16 @@ class IRM_CNN_Based_Trainer(Model_Trainer):
     def set_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.args.learning_rate)
 
-    def print_classification_metrics(self):
-        """
-        Batches data for test, train, and validation and plots confusion matrix and classification report.
-        """
-
-        # Test Batch
-        self.model.eval()
-        with torch.no_grad():
-            test_predictions = []
-            for X_batch, Y_batch in tqdm(self.test_loader, desc="Test Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                outputs = self.model(X_batch)
-                if isinstance(outputs, dict):
-                    outputs = outputs['logits']
-                preds = np.argmax(outputs.cpu().detach().numpy(), axis=1)
-                test_predictions.extend(preds)
-
-        true_labels = np.argmax(self.Y.test.cpu().detach().numpy(), axis=1)
-        test_predictions = np.array(test_predictions)
-
-        # Calculate and print the confusion matrix
-        conf_matrix = confusion_matrix(true_labels, test_predictions)
-        print("Confusion Matrix:")
-        print(conf_matrix)
-
-        print("Classification Report:")
-        print(classification_report(true_labels, test_predictions))
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.test.cpu().detach().numpy(), axis=1), np.array(test_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'test')  
-
-        torch.cuda.empty_cache()  # Clear cache if needed 
-
-        # Validation Metrics
-        self.model.eval()
-        with torch.no_grad():
-            validation_predictions = []
-            for X_batch, Y_batch in tqdm(self.val_loader, desc="Validation Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                outputs = self.model(X_batch)
-                if isinstance(outputs, dict):
-                    outputs = outputs['logits']
-                preds = np.argmax(outputs.cpu().detach().numpy(), axis=1)
-                validation_predictions.extend(preds)
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.validation.cpu().detach().numpy(), axis=1), np.array(validation_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'validation')   
-        torch.cuda.empty_cache()
-
-        # Load training in smaller batches for memory purposes
-        torch.cuda.empty_cache()  # Clear cache if needed
-
-        self.model.eval()
-        self.train_loader_unshuffled = DataLoader(self.train_dataset, batch_size=self.batch_size, num_workers=multiprocessing.cpu_count()//8, worker_init_fn=self.utils.seed_worker, pin_memory=True, drop_last=self.args.force_regression)
-        
-        # Train Metrics
-        with torch.no_grad():
-            train_predictions = []
-            for X_batch, Y_batch in tqdm(self.train_loader_unshuffled, desc="Training Batch Loading for Confusion Matrix"):
-                X_batch = X_batch.to(self.device).to(torch.float32)
-                outputs = self.model(X_batch)
-                if isinstance(outputs, dict):
-                        outputs = outputs['logits']
-                preds = torch.argmax(outputs, dim=1)
-                train_predictions.extend(preds.cpu().detach().numpy())
-        
-        self.utils.plot_confusion_matrix(np.argmax(self.Y.train.cpu().detach().numpy(), axis=1), np.array(train_predictions), self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, 'train')
-    
     def pretrain_and_finetune(self, testing_metrics):
         """
         Finish current run and start a new run for finetuning.
         """
 
         # Evaluate performance on test metrics
-        ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.device, self.num_gestures, self.cross_entropy, self.args, testing_metrics)
+        test_results = ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.device, self.num_gestures, self.cross_entropy, self.args, testing_metrics)
 
         if not self.args.force_regression:
-            self.print_classification_metrics()
+            self.print_classification_metrics(test_results, self.validation_results)
  
         self.pretrain_run.finish()
 
@@ -292,14 +241,15 @@ class IRM_CNN_Based_Trainer(Model_Trainer):
         )
         # Initialize metrics for finetuning training and validation
         ft_training_metrics, ft_validation_metrics, testing_metrics = super().get_metrics()
+        ft_train_tracker = ml_utils.TrainingMetricTracker(ft_training_metrics, self.args, len(finetune_loader.sampler), self.num_classes, self.device)
 
         # Finetuning Loop 
-        for epoch in tqdm(range(ft_epochs), desc="Finetuning Epoch"):
+        start_epoch, val_results = super().load_checkpoint("finetune")
+        for epoch in tqdm(range(start_epoch, ft_epochs), desc="Finetuning Epoch"):
             self.model.train()
             train_loss = 0.0
             
-            for ft_train_metric in ft_training_metrics:
-                ft_train_metric.reset()
+            ft_train_tracker.reset()
 
             with tqdm(finetune_loader, desc=f"Finetuning Epoch {epoch+1}/{ft_epochs}", leave=False) as t:
                 for X_batch, Y_batch in t:
@@ -331,74 +281,35 @@ class IRM_CNN_Based_Trainer(Model_Trainer):
 
                     train_loss += loss.item()
 
-                    for ft_train_metric in ft_training_metrics:
-                        ft_train_metric(output,Y_batch_long)
+                    ft_train_tracker.update(output, Y_batch_long)
 
                     if t.n % 10 == 0:
-                        ft_accuracy_metric = next(metric for metric in ft_training_metrics if metric.name =="Micro_Accuracy")
-
+                        ft_batch_acc = ft_train_tracker.batch_accuracy()
                         t.set_postfix({
                             "Batch Loss": loss.item(), 
-                            "Batch Acc": ft_accuracy_metric.compute().item()
+                            **({"Batch Acc": ft_batch_acc} if ft_batch_acc is not None else {})
                         })
 
-            # Finetuning Validation
-            self.model.eval()
-            val_loss = 0.0
-
-            for ft_val_metric in ft_validation_metrics:
-                ft_val_metric.reset()
+            # Finetuning Validation (single inference pass shared by loss, metrics, TPR@FPR, FPR@TPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, self.cross_entropy, self.args, ft_validation_metrics)
+            val_loss = val_results["loss"]
+            ft_validation_metrics_values = val_results["metrics_values"]
 
-           
-            all_val_outputs = []
-            all_val_labels = []
-
-            with torch.no_grad():
-                for X_batch, Y_batch in self.val_loader:
-                    X_batch = X_batch.to(self.device).to(torch.float32)
-                    Y_batch = Y_batch.to(self.device).to(torch.float32) 
-                    Y_batch_long = torch.argmax(Y_batch, dim=1)
-
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-                    val_loss += self.cross_entropy(output,Y_batch).item()
-
-                    for ft_val_metric in ft_validation_metrics:
-                        if ft_val_metric.name != "Macro_AUROC" and ft_val_metric.name != "Macro_AUPRC":
-                            ft_val_metric(output,Y_batch_long)
-
-                    all_val_outputs.append(output)
-                    all_val_labels.append(Y_batch_long)
-
-            
-         
-            all_val_outputs = torch.cat(all_val_outputs, dim=0)
-            all_val_labels = torch.cat(all_val_labels, dim=0)  
-            Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device)
-
-            true_labels =Y_validation_long.cpu().detach().numpy()
-            test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-            conf_matrix = confusion_matrix(true_labels, test_predictions)
+            conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
             print("Confusion Matrix:")
-            print(conf_matrix)
-
-            finetune_val_macro_auroc_metric = next(metric for metric in ft_validation_metrics if metric.name == "Macro_AUROC")
-            finetune_val_macro_auprc_metric = next(metric for metric in ft_validation_metrics if metric.name == "Macro_AUPRC")
+            print(conf_matrix.cpu().numpy())
 
-            finetune_val_macro_auroc_metric(all_val_outputs,Y_validation_long)
-            finetune_val_macro_auprc_metric(all_val_outputs,Y_validation_long)
+            tpr_results = val_results["tpr_results"]
+            fpr_results = val_results["fpr_results"]
+            confidence_levels = val_results["confidence_levels"]
+            proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Calculate average loss and metrics
             train_loss /= len(finetune_loader)
-            val_loss /= len(self.val_loader)
-            tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_gestures)
-            fpr_results = ml_utils.evaluate_model_fpr_at_tpr(self.model, self.val_loader, self.device, self.num_gestures)
-            confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            ft_training_metrics_values = {ft_metric.name: ft_metric.compute() for ft_metric in ft_training_metrics}
-            ft_validation_metrics_values = {ft_metric.name: ft_metric.compute() for ft_metric in ft_validation_metrics}
+            ft_training_metrics_values = ft_train_tracker.compute()
+            ft_train_tracker.print_cost_report()
 
             # Print metric values
             print(f"Finetuning Epoch {epoch+1}/{ft_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
@@ -442,33 +353,45 @@ class IRM_CNN_Based_Trainer(Model_Trainer):
                 **({f"confidence_level_accuracies/Val Accuracy at {int(confidence_level*100)}% confidence": acc for confidence_level, acc in confidence_levels.items()} if not self.args.force_regression else {}),
                 **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {})
             })
+
+            super().save_checkpoint("finetune", epoch+1, ft_epochs, val_results)
         
         
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'self.model/self.modelParameters_{self.formatted_datetime}.pth')
 
         # Evaluate the self.model on the test set
-        ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.
+        test_results = ml_utils.evaluate_model_on_test_set(self.model, self.test_loader, self.
         device, self.num_gestures, self.cross_entropy, self.args, testing_metrics)
 
-        self.print_classification_metrics()
+        self.print_classification_metrics(test_results, val_results)
         self.ft_run.finish() 
 
+    def domain_loss(self, output, Y_batch):
+        """Cross entropy plus the invariance penalty averaged over domains, for a batch ordered by domain (RandomDomainSampler)."""
+        # compute cross entropy loss
+        loss_ce = self.cross_entropy(output, Y_batch)
+
+        # compute invariance penalty loss (averaged over domains in one batched pass)
+        loss_penalty = self.criterion(output, Y_batch, self.sampler.get_prop_per_domain())
+
+        # compute final loss
+        return loss_ce + loss_penalty
+
     def train_and_validate(self, training_metrics, validation_metrics):
         """
         Train and validation loop. 
         """
 
-        for epoch in tqdm(range(self.num_epochs), desc="Epoch"):
+        train_tracker = ml_utils.TrainingMetricTracker(training_metrics, self.args, len(self.train_loader.sampler), self.num_classes, self.device)
+
+        start_epoch, val_results = super().load_checkpoint("pretrain")
+        for epoch in tqdm(range(start_epoch, self.num_epochs), desc="Epoch"):
             self.model.train()
             train_loss = 0.0
 
             # Reset training metrics at the start of each epoch
-            for train_metric in training_metrics:
-                train_metric.reset()
-        
-            outputs_train_all = []
-            ground_truth_train_all = []
+            train_tracker.reset()
 
             with tqdm(self.train_loader, desc=f"Epoch {epoch+1}/{self.num_epochs}", leave=False) as t:
                 
@@ -480,112 +403,39 @@ class IRM_CNN_Based_Trainer(Model_Trainer):
                     Y_batch_long = torch.argmax(Y_batch, dim=1)
 
                     self.optimizer.zero_grad()
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-
-                    # compute cross entropy loss
-                    loss_ce = self.cross_entropy(output, Y_batch)
-
-                    # compute invariance penalty loss 
-                    loss_penalty = 0
-                    output_per_domains = output.split(prop_per_domain, dim=0)
-                    labels_per_domains = Y_batch.split(prop_per_domain, dim=0)
-            
-                    n_domains_per_batch = self.utils.num_subjects - 1
-                    for output_per_domain, labels_per_domain in zip(output_per_domains, labels_per_domains):
-                        loss_penalty += self.criterion(output_per_domain, labels_per_domain) / n_domains_per_batch
-
-                    # compute final loss
-                    loss = loss_ce + loss_penalty
-                    loss.backward()
+                    loss, output = super().accumulate_gradients(X_batch, Y_batch, self.domain_loss, prop_per_domain=prop_per_domain)
                     self.optimizer.step()
 
-                    outputs_train_all.append(output)
-                    ground_truth_train_all.append(torch.argmax(Y_batch, dim=1))
-
                     train_loss += loss.item()
 
-                    for train_metric in training_metrics:
-                        if train_metric.name != "Macro_AUROC" and train_metric.name != "Macro_AUPRC":
-                            train_metric(output, Y_batch_long)
-                   
-                    micro_accuracy_metric = next(metric for metric in training_metrics if metric.name == "Micro_Accuracy")
+                    train_tracker.update(output, Y_batch_long)
+
                     if t.n % 10 == 0:
+                        batch_acc = train_tracker.batch_accuracy()
                         t.set_postfix({
                             "Batch Loss": loss.item(), 
-                            "Batch Acc": micro_accuracy_metric.compute().item()
+                            **({"Batch Acc": batch_acc} if batch_acc is not None else {})
                         })
-                
-                outputs_train_all = torch.cat(outputs_train_all, dim=0).to(self.device)
-                ground_truth_train_all = torch.cat(ground_truth_train_all, dim=0).to(self.device)
 
-            train_macro_auroc_metric = next(metric for metric in training_metrics if metric.name == "Macro_AUROC")
-            train_macro_auprc_metric = next(metric for metric in training_metrics if metric.name == "Macro_AUPRC")
+            # Validation phase (single inference pass shared by loss, metrics, TPR@FPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, self.cross_entropy, self.args, validation_metrics, fpr_at_tpr=False)
+            val_loss = val_results["loss"]
+            validation_metrics_values = val_results["metrics_values"]
 
-            train_macro_auroc_metric(outputs_train_all,   ground_truth_train_all)
-            train_macro_auprc_metric(outputs_train_all, ground_truth_train_all)
-
-            # Validation phase
-            self.model.eval()
-            val_loss = 0.0
-
-            for val_metric in validation_metrics:
-                val_metric.reset()
-
-            all_val_outputs = []
-            all_val_labels = []
-
-            with torch.no_grad():
-            
-                for X_batch, Y_batch in self.val_loader:
-                    
-                    X_batch = X_batch.to(self.device).to(torch.float32)
-                    Y_batch = Y_batch.to(self.device).to(torch.float32)
-                    Y_batch_long = torch.argmax(Y_batch, dim=1)
-
-                    output = self.model(X_batch)
-                    if isinstance(output, dict):
-                        output = output['logits']
-
-                    all_val_outputs.append(output)
-                    all_val_labels.append(Y_batch_long)
-                 
-                    # val_loss += self.criterion(output,Y_batch).item()
-                    val_loss += F.cross_entropy(output, Y_batch).item()
-
-                    for val_metric in validation_metrics:
-                        if val_metric.name != "Macro_AUROC" and val_metric.name != "Macro_AUPRC":
-                            val_metric(output,Y_batch_long)
-
-            all_val_outputs = torch.cat(all_val_outputs, dim=0)
-            all_val_labels = torch.cat(all_val_labels, dim=0)
-            Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device)
-            true_labels = Y_validation_long.cpu().detach().numpy()
-            test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-
-           
-            conf_matrix = confusion_matrix(true_labels, test_predictions)
-           
+            conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
             print("Confusion Matrix:")
-            print(conf_matrix)
+            print(conf_matrix.cpu().numpy())
 
-            val_macro_auroc_metric = next(metric for metric in validation_metrics if metric.name == "Macro_AUROC")
-            val_macro_auprc_metric = next(metric for metric in validation_metrics if metric.name == "Macro_AUPRC")
-
-            val_macro_auroc_metric(all_val_outputs,Y_validation_long)
-            val_macro_auprc_metric(all_val_outputs,Y_validation_long)
+            tpr_results = val_results["tpr_results"]
+            confidence_levels = val_results["confidence_levels"]
+            proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Calculate average loss and metrics
             train_loss /= len(self.train_loader)
-            val_loss /= len(self.val_loader)
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            training_metrics_values = {metric.name: metric.compute() for metric in training_metrics}
-            validation_metrics_values = {metric.name: metric.compute() for metric in validation_metrics}
-
-            tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_classes)
-            confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
+            training_metrics_values = train_tracker.compute()
+            train_tracker.print_cost_report()
 
             # Print metric values
             print(f"Epoch {epoch+1}/{self.num_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
@@ -633,14 +483,19 @@ class IRM_CNN_Based_Trainer(Model_Trainer):
                 **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {}),
             })
 
+            super().save_checkpoint("pretrain", epoch+1, self.num_epochs, val_results)
+
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'model/modelParameters_{self.formatted_datetime}.pth')
 
+        # Last epoch's validation logits, reused for the validation confusion matrix
+        self.validation_results = val_results
+
         # If pretrain and finetune, continue. Otherwise, here.
         if not self.args.pretrain_and_finetune:
 
             if not self.args.force_regression: 
-                self.print_classification_metrics()
+                self.print_classification_metrics(validation_results=self.validation_results)
             self.pretrain_run.finish()
 
 
@@ -1,9 +1,9 @@
 from .Model_Trainer import Model_Trainer
+from .IRM_CNN_Based_Trainer import InvariancePenaltyLoss
 import torch
 import torch.nn as nn
 from tqdm import tqdm
 import wandb
-from sklearn.metrics import confusion_matrix, classification_report 
 import Model.ml_metrics_utils as ml_utils
 import numpy as np
 import torch.nn.functional as F
@@ -43,7 +43,7 @@ class IRM_MLP_Based_Trainer(Model_Trainer):
         super().set_pretrain_path()
         super().set_resize_transform()
         super().set_loaders()
-        super().set_criterion()
+        self.set_criterion()
         super().start_pretrain_run()
         super().set_gesture_labels()
         super().set_testrun_foldername()
@@ -64,6 +64,9 @@ class IRM_MLP_Based_Trainer(Model_Trainer):
         return np.vstack(X), np.hstack(Y)
     
     
+    def set_criterion(self):
+        self.criterion = InvariancePenaltyLoss()
+
     def set_model(self):
 
         # PyTorch MLP model
@@ -75,26 +78,35 @@ class IRM_MLP_Based_Trainer(Model_Trainer):
     def set_optimizer(self):
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=0.001)
 
+    def domain_loss(self, output, Y_batch):
+        """Cross entropy plus the invariance penalty averaged over domains, for a batch ordered by domain (RandomDomainSampler)."""
+        # compute cross entropy loss
+        loss_ce = F.cross_entropy(output, Y_batch)
+
+        # compute invariance penalty loss (averaged over domains in one batched pass)
+        loss_penalty = self.criterion(output, Y_batch, self.sampler.get_prop_per_domain())
+
+        # compute final loss
+        return loss_ce + loss_penalty # equally weighted
+
     def model_loop(self):
 
         # PyTorch training loop for MLP
         self.training_metrics, self.validation_metrics = super().get_metrics(testing=False)
 
-        for epoch in tqdm(range(self.num_epochs), desc="Epoch"):
+        train_tracker = ml_utils.TrainingMetricTracker(self.training_metrics, self.args, len(self.train_loader.sampler), self.num_classes, self.device)
+
+        start_epoch, val_results = super().load_checkpoint("pretrain")
+        for epoch in tqdm(range(start_epoch, self.num_epochs), desc="Epoch"):
 
             self.model.train()
  
             # Initialize metrics 
-            for train_metric in self.training_metrics:
-                train_metric.reset()
+            train_tracker.reset()
 
             train_loss = 0.0
 
             with tqdm(self.train_loader, desc=f"Epoch {epoch+1}/{self.num_epochs}", leave=False) as t:
-           
-                ground_truth_train_all = []
-                outputs_all = [] # NOTE: why is this inside the loop for MLP but outside in CNN
-
                 prop_per_domain = self.sampler.get_prop_per_domain()
                 
                 for X_batch, Y_batch in t:
@@ -102,108 +114,39 @@ class IRM_MLP_Based_Trainer(Model_Trainer):
                     Y_batch = torch.argmax(Y_batch, dim=1).to(self.device).to(torch.int64)
 
                     self.optimizer.zero_grad()
-                    output = self.model(X_batch)
-
-                    # compute cross entropy loss
-                    loss_ce = F.cross_entropy(output, Y_batch)
-
-                    # compute invariance penalty loss
-                    loss_penalty = 0
-                    output_per_domains = output.split(prop_per_domain, dim=0)
-                    labels_per_domains = Y_batch.split(prop_per_domain, dim=0)
-
-                    n_domains_per_batch = self.utils.num_subjects - 1
-                    for output_per_domain, labels_per_domain in zip(output_per_domains, labels_per_domains):
-                        loss_penalty += self.criterion(output_per_domain, labels_per_domain) / n_domains_per_batch
-
-                    # compute final loss
-                    loss = loss_ce + loss_penalty # equally weighted
-                    loss.backward()
+                    loss, output = super().accumulate_gradients(X_batch, Y_batch, self.domain_loss, prop_per_domain=prop_per_domain)
                     self.optimizer.step()
 
                     train_loss += loss.item()
-                    for train_metric in self.training_metrics:
-                        if train_metric.name != "Macro_AUROC" and train_metric.name != "Macro_AUPRC":
-                            train_metric(output, Y_batch)
-                    
-                    outputs_all.append(output)
-                    ground_truth_train_all.append(Y_batch)
+                    train_tracker.update(output, Y_batch)
                     
                     if t.n % 10 == 0:
-                        train_micro_acc = next(metric for metric in self.training_metrics if metric.name == "Micro_Accuracy")
-                        t.set_postfix({"Batch Loss": loss.item(), "Batch Acc": train_micro_acc.compute().item()})
+                        batch_acc = train_tracker.batch_accuracy()
+                        t.set_postfix({"Batch Loss": loss.item(), **({"Batch Acc": batch_acc} if batch_acc is not None else {})})
 
                     del X_batch, Y_batch, output
                     torch.cuda.empty_cache()
-                
-                outputs_all = torch.cat(outputs_all, dim=0).to(self.device)
-                ground_truth_train_all = torch.cat(ground_truth_train_all, dim=0).to(self.device)
-
-                train_macro_auroc = next(metric for metric in self.training_metrics if metric.name == "Macro_AUROC")
-                train_macro_auprc = next(metric for metric in self.training_metrics if metric.name == "Macro_AUPRC")
-
-                train_macro_auroc(outputs_all, ground_truth_train_all)
-                train_macro_auprc(outputs_all, ground_truth_train_all)
-
-
-            # Validation
-            self.model.eval()
-
-            for val_metric in self.validation_metrics:
-                val_metric.reset()
-            
-            all_val_outputs = []
-            all_val_labels = []
-
-            val_loss = 0.0
-            with torch.no_grad():
-    
-                for X_batch, Y_batch in self.val_loader:
-                    X_batch = X_batch.view(X_batch.size(0), -1).to(self.device).to(torch.float32)
-                    Y_batch = torch.argmax(Y_batch, dim=1).to(self.device).to(torch.int64)
-
-                    output = self.model(X_batch)
-                    for validation_metric in self.validation_metrics:
-                        validation_metric(output, Y_batch)
-
-                    val_loss += F.cross_entropy(output, Y_batch).item()
-        
-                    all_val_outputs.append(output)
-                    all_val_labels.append(Y_batch)
-
-                    del X_batch, Y_batch
-                    torch.cuda.empty_cache()
-
-            all_val_outputs = torch.cat(all_val_outputs, dim=0).to(self.device)
-            all_val_labels = torch.cat(all_val_labels, dim=0)
 
-            Y_validation_long = torch.argmax(self.Y.validation, dim=1).to(self.device).to(torch.int64)
+            # Validation (single inference pass shared by loss, metrics, TPR@FPR, FPR@TPR and confidence thresholding)
+            val_results = ml_utils.evaluate_loader(self.model, self.val_loader, self.device, F.cross_entropy, self.args, self.validation_metrics)
+            val_loss = val_results["loss"]
+            self.validation_metrics_values = val_results["metrics_values"]
 
-            true_labels = Y_validation_long.cpu().detach().numpy()
-            test_predictions = np.argmax(all_val_outputs.cpu().detach().numpy(), axis=1)
-            conf_matrix = confusion_matrix(true_labels, test_predictions)
+            conf_matrix = ml_utils.bincount_confusion_matrix(val_results["labels"], torch.argmax(val_results["outputs"], dim=1), self.num_classes)
             print("Confusion Matrix:")
-            print(conf_matrix)
+            print(conf_matrix.cpu().numpy())
 
-            val_macro_auroc = next(metric for metric in self.validation_metrics if metric.name == "Macro_AUROC")
-            val_macro_auprc = next(metric for metric in self.validation_metrics if metric.name == "Macro_AUPRC")
-
-            val_macro_auroc(all_val_outputs, Y_validation_long)
-            val_macro_auprc(all_val_outputs, Y_validation_long)
-                
+            tpr_results = val_results["tpr_results"]
+            fpr_results = val_results["fpr_results"]
+            confidence_levels = val_results["confidence_levels"]
+            proportions_above_confidence_threshold = val_results["proportions_above_confidence_threshold"]
 
             # Average the losses and print the metrics
             train_loss /= len(self.train_loader)
-            val_loss /= len(self.val_loader)
-
-            tpr_results = ml_utils.evaluate_model_tpr_at_fpr(self.model, self.val_loader, self.device, self.num_gestures)
-            fpr_results = ml_utils.evaluate_model_fpr_at_tpr(self.model, self.val_loader, self.device, self.num_gestures)
-            confidence_levels, proportions_above_confidence_threshold = ml_utils.evaluate_confidence_thresholding(self.model, self.val_loader, self.device)
 
             # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
-            training_metrics_values = {metric.name: metric.compute() for metric in self.training_metrics}
-            self.validation_metrics_values = {metric.name: metric.compute() for metric in self.validation_metrics}
-
+            training_metrics_values = train_tracker.compute()
+            train_tracker.print_cost_report()
             
             print(f"Epoch {epoch+1}/{self.num_epochs} | Train Loss: {train_loss:.4f} | Val Loss: {val_loss:.4f}")
 
@@ -218,9 +161,6 @@ class IRM_MLP_Based_Trainer(Model_Trainer):
             for confidence_level, accuracy in confidence_levels.items():
                 print(f"Val Accuracy at confidence level >{confidence_level}: {accuracy:.4f}")
 
-            training_metrics_values = {metric.name: metric.compute() for metric in self.training_metrics}
-            self.validation_metrics_values = {metric.name: metric.compute() for metric in self.validation_metrics}
-
             # Log metrics to wandb or any other tracking tool
             wandb.log({
             "train/Loss": train_loss,
@@ -256,6 +196,8 @@ class IRM_MLP_Based_Trainer(Model_Trainer):
             **({f"confidence_level_accuracies/Val Accuracy at {int(confidence_level*100)}% confidence": acc for confidence_level, acc in confidence_levels.items()} if not self.args.force_regression else {}),
             **({f"proportion_above_confidence_threshold/Val Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not self.args.force_regression else {})
         })
+
+            super().save_checkpoint("pretrain", epoch+1, self.num_epochs, val_results)
             
         torch.save(self.model.state_dict(), self.model_filename)
         wandb.save(f'model/modelParameters_{self.formatted_datetime}.pth')
@@ -14,11 +14,55 @@ import numpy as np
 import torch 
 import multiprocessing
 from torch.utils.data import DataLoader
-import random
-import copy
 from torch.utils.data import Sampler
 import math
-
+import random
+import hashlib
+from contextlib import contextmanager
+from sklearn.metrics import classification_report
+import Model.ml_metrics_utils as ml_utils
+from tqdm import tqdm
+
+
+# Arguments that do not change what is trained, so a run restarted with different values still resumes from its checkpoint
+CHECKPOINT_INDEPENDENT_ARGS = {
+    'config', 'table', 'table_workers', 'table_threads_per_job', 'all_folds', 'gpu', 'eval_batch_size',
+    'profile_train_metrics', 'profile_startup', 'checkpoint_every', 'checkpoint_dir',
+}
+
+def checkpoint_args(args):
+    """Training relevant arguments of a run, stored in its checkpoints and hashed into their path."""
+    return {name: repr(value) for name, value in sorted(vars(args).items()) if name not in CHECKPOINT_INDEPENDENT_ARGS}
+
+def _detach_outputs(outputs):
+    return tuple(o.detach() for o in outputs) if isinstance(outputs, tuple) else outputs.detach()
+
+def _cat_outputs(outputs, micro_batches):
+    """Concatenates per micro-batch model outputs (tensors or tuples of tensors) back into the sample order of the batch."""
+    order = torch.cat(micro_batches)
+    def cat(parts):
+        stacked = torch.cat(parts)
+        result = torch.empty_like(stacked)
+        result[order.to(stacked.device)] = stacked
+        return result
+    if isinstance(outputs[0], tuple):
+        return tuple(cat(list(parts)) for parts in zip(*outputs))
+    return cat(outputs)
+
+@contextmanager
+def _frozen_batchnorm_stats(model):
+    """Keeps the BatchNorm running statistics of model unchanged (momentum 0) while train mode still normalizes with batch statistics."""
+    batchnorms = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(m.momentum, None if m.num_batches_tracked is None else m.num_batches_tracked.clone()) for m in batchnorms]
+    for m in batchnorms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(batchnorms, saved):
+            m.momentum = momentum
+            if num_batches_tracked is not None:
+                m.num_batches_tracked.copy_(num_batches_tracked)
 
 
 class Model_Trainer():
@@ -55,8 +99,10 @@ class Model_Trainer():
         self.device = None
         self.testrun_foldername = None
         self.model_filename = None
+        self.checkpoint_args = None # set by get_checkpoint_filename
         self.gesture_labels = None
         self.num_classes = None
+        self.validation_results = None
 
         # Defined in either CNN_Trainer, Classic_Trainer
         if not self.args.turn_on_unlabeled_domain_adaptation:
@@ -356,6 +402,245 @@ class Model_Trainer():
         else:
             self.criterion = nn.CrossEntropyLoss()
 
+    def get_micro_batch_indices(self, batch_size, prop_per_domain=None):
+        """
+        Splits a batch of batch_size samples into index tensors of at most args.micro_batch_size samples.
+        Samples are dealt round-robin across the micro-batches. With prop_per_domain (the sizes of the consecutive domain chunks of the batch),
+        every domain's samples are therefore spread over the micro-batches, even when domains have fewer samples than there are micro-batches.
+        """
+        micro_batch_size = self.args.micro_batch_size
+        if micro_batch_size <= 0 or micro_batch_size >= batch_size:
+            return [torch.arange(batch_size)]
+
+        if prop_per_domain is not None:
+            assert sum(prop_per_domain) == batch_size, f"Domain chunks ({sum(prop_per_domain)} samples) do not cover the batch ({batch_size} samples)."
+
+        num_micro_batches = math.ceil(batch_size / micro_batch_size)
+        micro_batches = [torch.arange(m, batch_size, num_micro_batches) for m in range(num_micro_batches)]
+        assert max(len(idx) for idx in micro_batches) <= micro_batch_size, f"Micro-batch larger than micro_batch_size={micro_batch_size}."
+        return micro_batches
+
+    def accumulate_gradients(self, X_batch, Y_batch, loss_fn, forward_fn=None, prop_per_domain=None, separable=False):
+        """
+        Forward/backward pass for one batch, split into micro-batches (args.micro_batch_size) with accumulated gradients.
+        Returns (loss, outputs) detached, as a single full-batch pass would; the caller zeroes the gradients and steps the optimizer.
+
+        loss_fn(outputs, Y_batch) computes the loss from the model outputs of a batch (tensor or tuple of tensors from forward_fn).
+        separable: the loss is a mean over samples (plain cross entropy / MSE), so every micro-batch is backpropagated with its share of the loss.
+        Otherwise the loss couples the samples of the batch (CORAL/IRM penalties over domains): the outputs of every micro-batch are first
+        computed without grad, the loss and its gradient w.r.t. the outputs are taken on the whole batch, then each micro-batch is run again
+        with grad (same RNG state, so dropout masks match) and backpropagated with its slice of that gradient. This gives the full-batch
+        gradient at the cost of a second forward pass, except for models with BatchNorm (resnet): each micro-batch is normalized with its
+        own batch statistics, so outputs and gradients only approximate a full-batch pass. BatchNorm running statistics are only updated by
+        the second pass.
+        """
+        if forward_fn is None:
+            forward_fn = lambda X: ml_utils.get_logits(self.model(X))
+
+        micro_batches = self.get_micro_batch_indices(X_batch.shape[0], prop_per_domain)
+
+        if len(micro_batches) == 1:
+            outputs = forward_fn(X_batch)
+            loss = loss_fn(outputs, Y_batch)
+            loss.backward()
+            return loss.detach(), _detach_outputs(outputs)
+
+        if separable:
+            loss = 0
+            outputs = []
+            for idx in micro_batches:
+                idx = idx.to(X_batch.device)
+                micro_outputs = forward_fn(X_batch[idx])
+                micro_loss = loss_fn(micro_outputs, Y_batch[idx]) * (len(idx) / X_batch.shape[0])
+                micro_loss.backward()
+                loss += micro_loss.detach()
+                outputs.append(_detach_outputs(micro_outputs))
+            return loss, _cat_outputs(outputs, micro_batches)
+
+        # first pass: outputs of the whole batch without keeping activations
+        rng_states = []
+        outputs = []
+        with torch.no_grad(), _frozen_batchnorm_stats(self.model):
+            for idx in micro_batches:
+                rng_states.append((torch.get_rng_state(), torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None))
+                outputs.append(forward_fn(X_batch[idx.to(X_batch.device)]))
+        outputs = _cat_outputs(outputs, micro_batches)
+
+        # loss on the whole batch and its gradient w.r.t. the outputs
+        leaf_outputs = tuple(o.requires_grad_() for o in outputs) if isinstance(outputs, tuple) else outputs.requires_grad_()
+        loss = loss_fn(leaf_outputs, Y_batch)
+        output_grads = torch.autograd.grad(loss, leaf_outputs)
+
+        # second pass: backpropagate each micro-batch with its slice of the output gradient
+        for idx, (cpu_state, cuda_state) in zip(micro_batches, rng_states):
+            torch.set_rng_state(cpu_state)
+            if cuda_state is not None:
+                torch.cuda.set_rng_state_all(cuda_state)
+            idx = idx.to(X_batch.device)
+            micro_outputs = forward_fn(X_batch[idx])
+            micro_outputs = micro_outputs if isinstance(micro_outputs, tuple) else (micro_outputs,)
+            torch.autograd.backward(micro_outputs, [grad[idx] for grad in output_grads])
+
+        return loss.detach(), _detach_outputs(outputs)
+
+    def get_checkpoint_filename(self, stage):
+        """
+        Checkpoint path for a training stage ("pretrain" or "finetune"), keyed by project, wandb run name and a hash of the training relevant
+        arguments (checkpoint_args), so a restarted run finds it but runs that only differ in arguments missing from the run name (learning rate,
+        batch size, epochs, ...) do not share it. The key is taken from the arguments at the first call.
+        """
+        if self.checkpoint_args is None:
+            self.checkpoint_args = checkpoint_args(self.args)
+        args_hash = hashlib.sha1(repr(self.checkpoint_args).encode()).hexdigest()[:16]
+        return os.path.join(self.args.checkpoint_dir, self.project_name, self.wandb_runname, args_hash, f'{stage}.pt')
+
+    def save_checkpoint(self, stage, epoch, num_epochs, val_results=None):
+        """
+        Saves model, optimizer, scheduler, RNG states, epoch counter and the last validation results every args.checkpoint_every epochs
+        and after the last epoch. Written to a temporary file first so a preemption mid-save keeps the previous checkpoint.
+        """
+        if self.args.checkpoint_every <= 0 or (epoch % self.args.checkpoint_every != 0 and epoch != num_epochs):
+            return
+
+        checkpoint_filename = self.get_checkpoint_filename(stage)
+        checkpoint = {
+            'args': self.checkpoint_args,
+            'model_class': type(self.model).__name__,
+            'epoch': epoch,
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'val_results': val_results,
+            'rng_states': {
+                'python': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+
+        os.makedirs(os.path.dirname(checkpoint_filename), exist_ok=True)
+        torch.save(checkpoint, checkpoint_filename + '.tmp')
+        os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+
+    def load_checkpoint(self, stage):
+        """
+        Restores the state saved by save_checkpoint for this run and stage, if checkpointing is on and a checkpoint exists.
+        Returns the epoch to start from and the last validation results (0 and None without a checkpoint).
+        """
+        checkpoint_filename = self.get_checkpoint_filename(stage)
+        if self.args.checkpoint_every <= 0 or not os.path.exists(checkpoint_filename):
+            return 0, None
+
+        checkpoint = torch.load(checkpoint_filename, map_location=self.device, weights_only=False)
+        if checkpoint.get('args') != self.checkpoint_args or checkpoint.get('model_class') != type(self.model).__name__:
+            mismatched = sorted(name for name in set(self.checkpoint_args) | set(checkpoint.get('args') or {}) if self.checkpoint_args.get(name) != (checkpoint.get('args') or {}).get(name))
+            raise ValueError(f"Refusing to resume from {checkpoint_filename}: it was saved by a different run (arguments {mismatched}, model {checkpoint.get('model_class')} vs {type(self.model).__name__}).")
+        self.model.load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if self.scheduler is not None and checkpoint['scheduler'] is not None:
+            self.scheduler.load_state_dict(checkpoint['scheduler'])
+
+        rng_states = checkpoint['rng_states']
+        random.setstate(rng_states['python'])
+        np.random.set_state(rng_states['numpy'])
+        torch.set_rng_state(rng_states['torch'].cpu())
+        if rng_states['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([state.cpu() for state in rng_states['cuda']])
+
+        print(f"Resuming {stage} from epoch {checkpoint['epoch']} ({checkpoint_filename})")
+        return checkpoint['epoch'], checkpoint['val_results']
+
+    def train_multiple_seeds(self, model_fn, prepare_batch, seed_state_dict_fn=None):
+        """
+        --num_seeds > 1: trains args.num_seeds independently initialized copies of model_fn() (seeds args.seed, args.seed+1, ...) on the
+        same batches of self.train_loader with one StackedSeedModel, so the data pipeline is shared and each step is one vectorized
+        forward/backward (split into micro-batches by accumulate_gradients with --micro_batch_size). The optimizer is the trainer's own
+        (same type and hyperparameters) over the stacked parameters; as every loss term depends on one copy only, each copy gets exactly
+        the gradients of its own run.
+
+        Each epoch every copy is validated on self.val_loader, and its loss and metrics are logged to wandb under seed_<seed>/, along
+        with the mean and standard deviation over seeds (seed_mean/, seed_std/).
+
+        prepare_batch(X_batch, Y_batch) -> (inputs, loss targets, metric targets) on the device, as in the trainer's own loop.
+        seed_state_dict_fn(state_dict) -> state dict saved as model_<datetime>_seed<seed>.pth for the state dict of one copy, so that it
+        can be saved in the format of model_<datetime>.pth (e.g. with the frozen backbone). Defaults to the state dict of the copy.
+        Returns the copies (views sharing the trained weights) and their last validation results, in seed order.
+        """
+        seeds = [self.args.seed + k for k in range(self.args.num_seeds)]
+        self.model = StackedSeedModel(model_fn, seeds).to(self.device)
+        self.optimizer = type(self.optimizer)(self.model.parameters(), **self.optimizer.defaults)
+        seed_models = [self.model.seed_model(k) for k in range(len(seeds))]
+
+        trackers = []
+        for _ in seeds:
+            training_metrics, _ = self.get_metrics(testing=False)
+            trackers.append(ml_utils.TrainingMetricTracker(training_metrics, self.args, len(self.train_loader.sampler), self.num_classes, self.device))
+        _, validation_metrics = self.get_metrics(testing=False)
+
+        def metric_logs(prefix, values):
+            logs = {}
+            for name, value in values.items():
+                if name == 'R2Score_RawValues':
+                    logs.update({f"{prefix}/R2Score_RawValues_{i+1}": v.item() for i, v in enumerate(value)})
+                else:
+                    logs[f"{prefix}/{name}"] = value.item()
+            return logs
+
+        start_epoch, all_val_results = self.load_checkpoint("pretrain")
+        for epoch in tqdm(range(start_epoch, self.num_epochs), desc="Epoch"):
+            self.model.train()
+            train_losses = torch.zeros(len(seeds), device=self.device)
+            for tracker in trackers:
+                tracker.reset()
+
+            with tqdm(self.train_loader, desc=f"Epoch {epoch+1}/{self.num_epochs} ({len(seeds)} seeds)", leave=False) as t:
+                for X_batch, Y_batch in t:
+                    X_batch, Y_loss, Y_metric = prepare_batch(X_batch, Y_batch)
+
+                    self.optimizer.zero_grad()
+                    # seeds moved after the batch dimension, which accumulate_gradients splits into micro-batches
+                    seeds_loss = lambda outputs, Y: sum(self.criterion(outputs[:, k], Y) for k in range(len(seeds)))
+                    _, outputs = self.accumulate_gradients(X_batch, Y_loss, seeds_loss, forward_fn=lambda X: self.model(X).transpose(0, 1), separable=True)
+                    self.optimizer.step()
+
+                    outputs = outputs.transpose(0, 1)
+                    with torch.no_grad():
+                        losses = torch.stack([self.criterion(output, Y_loss) for output in outputs])
+
+                    train_losses += losses.detach()
+                    for tracker, output in zip(trackers, outputs):
+                        tracker.update(output.detach(), Y_metric)
+
+            train_losses = (train_losses / len(self.train_loader)).tolist()
+
+            logs = {"train/Epoch": epoch+1, "train/Learning Rate": self.optimizer.param_groups[0]['lr']}
+            all_val_results = []
+            for seed, seed_model, tracker, train_loss in zip(seeds, seed_models, trackers, train_losses):
+                val_results = ml_utils.evaluate_loader(seed_model, self.val_loader, self.device, self.criterion, self.args, validation_metrics, fpr_at_tpr=False)
+                all_val_results.append(val_results)
+                print(f"Epoch {epoch+1}/{self.num_epochs} | Seed {seed} | Train Loss: {train_loss:.4f} | Val Loss: {val_results['loss']:.4f}")
+
+                logs.update({f"seed_{seed}/train/Loss": train_loss, f"seed_{seed}/validation/Loss": val_results["loss"]})
+                logs.update(metric_logs(f"seed_{seed}/train", tracker.compute()))
+                logs.update(metric_logs(f"seed_{seed}/validation", val_results["metrics_values"]))
+
+            for key in [key for key in logs if key.startswith(f"seed_{seeds[0]}/")]:
+                values = [logs[key.replace(f"seed_{seeds[0]}/", f"seed_{seed}/", 1)] for seed in seeds]
+                logs[key.replace(f"seed_{seeds[0]}/", "seed_mean/", 1)] = float(np.mean(values))
+                logs[key.replace(f"seed_{seeds[0]}/", "seed_std/", 1)] = float(np.std(values))
+            wandb.log(logs)
+
+            self.save_checkpoint("pretrain", epoch+1, self.num_epochs, all_val_results)
+
+        for k, seed in enumerate(seeds):
+            seed_state_dict = self.model.seed_state_dict(k)
+            if seed_state_dict_fn is not None:
+                seed_state_dict = seed_state_dict_fn(seed_state_dict)
+            torch.save(seed_state_dict, self.model_filename.replace('.pth', f'_seed{seed}.pth'))
+
+        return seed_models, all_val_results
+
     def clear_memory(self):
         assert not self.args.turn_on_unlabeled_domain_adaptation, "clear_memory() only for non UDA models"
         # Training loop
@@ -370,6 +655,8 @@ class Model_Trainer():
             wandb_runname += '_transition_classifier'
         if self.args.turn_on_rms:
             wandb_runname += '_rms-'+str(self.args.rms_input_windowsize)
+        if self.args.causal_filter:
+            wandb_runname += '_causal-filter'
         if self.args.leftout_subject != 0:
             if (self.args.force_regression and self.args.dataset == "ninapro-db3") and self.args.leftout_subject == 10:
                 # Subject 10 in DB3 is missing a lot of data. We delete it internally and subject 11 gets shifted to become subject 10. Naming it its the "external" subject number for consistency. 
@@ -466,6 +753,24 @@ class Model_Trainer():
         
         self.model_filename = f'{self.testrun_foldername}model_{self.formatted_datetime}.pth'
 
+    def save_inference_state(self):
+        """
+        Saves what is needed besides the model weights to classify new EMG windows of this fold (run arguments, class counts, scaler and global extrema)
+        next to the model as inference_state_{datetime}.pt. Read by Model.Streaming_Inference.
+        """
+
+        scaler = self.X.scaler
+        inference_state = {
+            'args': vars(self.args),
+            'num_gestures': self.num_gestures,
+            'num_classes': self.num_classes,
+            'scaler_mean': None if scaler is None else torch.from_numpy(scaler.mean_),
+            'scaler_scale': None if scaler is None else torch.from_numpy(scaler.scale_),
+            'global_low_value': None if self.X.global_low_value is None else float(self.X.global_low_value),
+            'global_high_value': None if self.X.global_high_value is None else float(self.X.global_high_value),
+        }
+        torch.save(inference_state, f'{self.testrun_foldername}inference_state_{self.formatted_datetime}.pt')
+
     def set_gesture_labels(self):
 
         if self.args.transition_classifier:
@@ -539,6 +844,49 @@ class Model_Trainer():
         if self.args.pretrain_and_finetune:
             self.plot_finetuning_images()
 
+    def print_classification_metrics(self, test_results=None, validation_results=None):
+        """
+        Plots test, validation and train confusion matrices and prints the test confusion matrix and classification report.
+
+        Args:
+            test_results (dict, optional): ml_utils.evaluate_loader results on the test loader for the current model. Its logits are reused instead of running the test set again.
+            validation_results (dict, optional): same for the validation loader (ex: last epoch's validation pass).
+        """
+
+        partitions = [
+            ('test', self.test_loader.dataset, test_results),
+            ('validation', self.val_loader.dataset, validation_results),
+            ('train', self.train_dataset, None),
+        ]
+
+        for partition_name, dataset, results in partitions:
+            if results is not None:
+                labels = results["labels"]
+                predictions = torch.argmax(results["outputs"], dim=1)
+            else:
+                outputs, labels, _ = ml_utils.run_inference(self.model, self.get_eval_loader(dataset), self.device)
+                labels = torch.argmax(labels, dim=1)
+                predictions = torch.argmax(outputs, dim=1)
+                del outputs
+
+            true_labels = labels.cpu().numpy()
+            predictions_np = predictions.cpu().numpy()
+
+            if partition_name == 'test':
+                conf_matrix = ml_utils.bincount_confusion_matrix(labels, predictions, self.num_classes)
+                print("Confusion Matrix:")
+                print(conf_matrix.cpu().numpy())
+
+                print("Classification Report:")
+                print(classification_report(true_labels, predictions_np))
+
+            self.utils.plot_confusion_matrix(true_labels, predictions_np, self.gesture_labels, self.testrun_foldername, self.args, self.formatted_datetime, partition_name)
+            torch.cuda.empty_cache()
+
+    def get_eval_loader(self, dataset):
+        """Unshuffled loader with large batches (args.eval_batch_size) for no-grad inference after training."""
+        return DataLoader(dataset, batch_size=self.args.eval_batch_size, num_workers=multiprocessing.cpu_count()//8, worker_init_fn=self.utils.seed_worker, pin_memory=True)
+
     def set_num_classes(self):
         if self.args.force_regression:
             num_classes = self.Y.train.shape[1]
@@ -580,10 +928,14 @@ class RandomDomainSampler(Sampler):
     Randomly sample :math:`N` domains, then randomly select :math:`K` samples in each domain to form a mini-batch of
     size :math:`N\times K`.
 
+    Each domain's indices are shuffled once per epoch and cut into consecutive per-batch slices, so an epoch is O(n).
+    Within a batch, samples are laid out domain by domain in a fixed order, so every batch can be split with
+    get_prop_per_domain(). The epoch ends once the smallest domain (relative to its share of the batch) runs out.
+
     Args:
-        data_source: dataset that contains data from multiple domains (each subject's data is concated to itself)
-        data_source (ConcatDataset): dataset that contains data from multiple domains
         batch_size (int): mini-batch size (:math:`N\times K` here)
+        cumulative_sizes (list): cumulative number of windows per domain (each subject's data is concated to itself)
+        num_subjects (int): number of subjects in the dataset (one is left out)
     """
 
     def __init__(self, batch_size: int, cumulative_sizes, num_subjects):
@@ -591,20 +943,20 @@ class RandomDomainSampler(Sampler):
         super(Sampler, self).__init__()
         self.n_domains_in_dataset = num_subjects - 1
         self.n_domains_per_batch = num_subjects - 1 
+        self.batch_size = batch_size
 
-        self.sample_idxes_per_domain = [] 
+        self.domain_ranges = [] 
 
         self.batch_size_per_domain = []
         total_windows = cumulative_sizes[-1]
 
         start = 0
-        # Sort indices for each domain (subject) 
+        # Index range and share of the batch for each domain (subject) 
         for end in cumulative_sizes:
             subject_proportion = math.ceil((end-start) / total_windows * batch_size)
             self.batch_size_per_domain.append(subject_proportion)
 
-            idxes = [idx for idx in range(start, end)] 
-            self.sample_idxes_per_domain.append(idxes) 
+            self.domain_ranges.append((start, end)) 
             start = end
 
       
@@ -616,57 +968,102 @@ class RandomDomainSampler(Sampler):
             self.batch_size_per_domain[max_idx] -= 1
             total_batch_size = sum(self.batch_size_per_domain)
 
-        self.length = len(list(self.__iter__()))
+        # Full batches until a domain has fewer unused samples than its share (at least one, sampled with replacement if needed)
+        self.num_batches = max(1, min((end - start) // size for (start, end), size in zip(self.domain_ranges, self.batch_size_per_domain) if size > 0))
+        self.length = self.num_batches * batch_size
 
     def __iter__(self):
-        sample_idxes_per_domain = copy.deepcopy(self.sample_idxes_per_domain)
-        domain_idxes = [idx for idx in range(self.n_domains_in_dataset)] # a list of all the domains we can pick from
-        final_idxes = []
-        stop_flag = False
-
-        while not stop_flag:
-            # shuffle select for the domain 
-            selected_domains = random.sample(domain_idxes, self.n_domains_per_batch) 
-
-            for domain in selected_domains:
-                sample_idxes = sample_idxes_per_domain[domain]
-                
-                # if not enough, sample with replacement
-                if len(sample_idxes) < self.batch_size_per_domain[domain]:
-                    selected_idxes = np.random.choice(sample_idxes, self.batch_size_per_domain[domain], replace=True)
-                # otherwise, sample without replacement
-                else:
-                    selected_idxes = random.sample(sample_idxes, self.batch_size_per_domain[domain])
-                final_idxes.extend(selected_idxes)
+        batches = np.empty((self.num_batches, self.batch_size), dtype=np.int64)
 
-                # Remove the indices we chose
-                for idx in selected_idxes:
-                    if idx in sample_idxes_per_domain[domain]:
-                        sample_idxes_per_domain[domain].remove(idx)
+        column = 0
+        for (start, end), size in zip(self.domain_ranges, self.batch_size_per_domain):
+            num_needed = self.num_batches * size
 
-                remaining_size = len(sample_idxes_per_domain[domain])
-                if remaining_size < self.batch_size_per_domain[domain]:
-                    stop_flag = True
-        
-        proportion_in_order = []
-        for domain in selected_domains: 
-            proportion_in_order.append(self.batch_size_per_domain[domain])
+            # if not enough, sample with replacement; otherwise, take a prefix of a random permutation
+            if end - start < num_needed:
+                selected_idxes = np.random.randint(start, end, size=num_needed)
+            else:
+                selected_idxes = start + np.random.permutation(end - start)[:num_needed]
 
-        self.curr_prop_per_domain = proportion_in_order
+            batches[:, column:column + size] = selected_idxes.reshape(self.num_batches, size)
+            column += size
 
-        return iter(final_idxes)
+        return iter(batches.reshape(-1).tolist())
 
     def __len__(self):
         return self.length
     
     def get_prop_per_domain(self):
-        return self.curr_prop_per_domain
-
-
+        """Number of samples from each domain in every batch, in the order they appear in the batch."""
+        return list(self.batch_size_per_domain)
 
-        
 
-        
+class StackedSeedModel(nn.Module):
+    """
+    Independently initialized copies of a small model, one per seed, trained side by side. The parameters of the copies are stacked
+    along a leading seed dimension (torch.func.stack_module_state) and all copies run in one vectorized call (torch.func.vmap), so
+    forward returns outputs of shape (num_seeds, batch, ...).
+    """
 
-            
-            
+    def __init__(self, model_fn, seeds):
+        super(StackedSeedModel, self).__init__()
+        self.seeds = list(seeds)
+
+        models = []
+        with torch.random.fork_rng(devices=[]):
+            for seed in self.seeds:
+                torch.manual_seed(seed)
+                models.append(model_fn())
+        params, buffers = torch.func.stack_module_state(models)
+
+        # Parameter/buffer names cannot contain dots, keep the module's names separately
+        self.names = list(params)
+        self.buffer_names = list(buffers)
+        self.params = nn.ParameterList([nn.Parameter(params[name]) for name in self.names])
+        for i, name in enumerate(self.buffer_names):
+            self.register_buffer(f'stacked_buffer_{i}', buffers[name])
+
+        # Stateless copy used as the architecture for torch.func.functional_call; kept out of the submodules so it holds no parameters
+        self.base = [models[0].to('meta')]
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.base[0].train(mode)
+        return self
+
+    def stacked_state(self):
+        buffers = [getattr(self, f'stacked_buffer_{i}') for i in range(len(self.buffer_names))]
+        return dict(zip(self.names, self.params)), dict(zip(self.buffer_names, buffers))
+
+    def forward(self, x):
+        params, buffers = self.stacked_state()
+        def call(params, buffers, x):
+            return ml_utils.get_logits(torch.func.functional_call(self.base[0], (params, buffers), (x,)))
+        return torch.func.vmap(call, in_dims=(0, 0, None), randomness='different')(params, buffers, x)
+
+    def seed_model(self, k):
+        """View of the copy for self.seeds[k] as a regular module (shares the stacked weights, e.g. for evaluate_loader)."""
+        return SeedModelView(self, k)
+
+    def seed_state_dict(self, k):
+        params, buffers = self.stacked_state()
+        return {name: value[k].detach().clone() for name, value in {**params, **buffers}.items()}
+
+
+class SeedModelView(nn.Module):
+    def __init__(self, stacked, k):
+        super(SeedModelView, self).__init__()
+        self.stacked = [stacked]
+        self.k = k
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.stacked[0].train(mode)
+        return self
+
+    def forward(self, x):
+        stacked = self.stacked[0]
+        params, buffers = stacked.stacked_state()
+        params = {name: value[self.k] for name, value in params.items()}
+        buffers = {name: value[self.k] for name, value in buffers.items()}
+        return torch.func.functional_call(stacked.base[0], (params, buffers), (x,))
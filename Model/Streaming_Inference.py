@@ -0,0 +1,300 @@
+"""
+Streaming_Inference.py
+- Classifies a continuous multi-channel EMG stream window by window with a model trained by CNN_Trainer, the way it would run on a live recording.
+- Samples are pushed in chunks, filtered causally with carried state if the run was trained with --causal_filter, and written into a ring buffer
+  of one window; every hop (utils.stepLen samples) the newest window goes through the fold's preprocessing (scaler, RMS, image transform and resize)
+  and the model, and the time from the window's last sample arriving to its decision is recorded.
+- Replay_Source replays a subject loaded by the fold's utils_* module, so streaming can be tested offline on runs trained with --causal_filter.
+  Windows filtered one by one (filtfilt) can not be joined into one stream, so other runs are refused. The replayed windows are not always contiguous in the recording, so the causal filter state carried across a jump differs from the offline one and the windows after
+  it only approximately match the training windows.
+"""
+import argparse
+import collections
+import os
+import re
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision import transforms
+
+import Model.ml_metrics_utils as ml_utils
+from Model.CNN_Trainer import CNN_Trainer, CachedBackboneModel, split_backbone
+from Setup.Parse_Config import Parse_Config
+
+
+def load_inference_state(inference_state_filename):
+    """Loads the inference state saved by Model_Trainer.save_inference_state and returns it with its run arguments as an argparse.Namespace."""
+
+    inference_state = torch.load(inference_state_filename, map_location='cpu', weights_only=False)
+    return inference_state, argparse.Namespace(**inference_state['args'])
+
+def setup_utils(args):
+    """Configures and returns the utils module (and whether it is a Ninapro dataset with exercises) exactly as Setup did for the training run."""
+
+    run = Parse_Config(args)
+    run.set_args()
+    run.setup_for_dataset()
+    run.set_exercise()
+    return run.utils, run.exercises
+
+def load_model(model_filename, inference_state, args, device):
+    """
+    Rebuilds the architecture of the run with CNN_Trainer.set_model and loads the saved model_{datetime}.pth weights into it.
+    Runs with --num_seeds > 1 save no model_{datetime}.pth, only one model_{datetime}_seed{seed}.pth per seed in the same format, so one of those is loaded.
+    """
+
+    if args.model in ['MLP', 'SVC', 'RF'] or args.turn_on_unlabeled_domain_adaptation:
+        raise NotImplementedError("Streaming inference is only implemented for models trained by CNN_Trainer.")
+    if args.force_regression:
+        raise NotImplementedError("Streaming inference is only implemented for classification.")
+    if args.target_normalize > 0:
+        raise NotImplementedError("Streaming inference is not implemented for --target_normalize, which normalizes each gesture of the recording with its own extrema.")
+    if args.num_seeds > 1 and not re.search(r'_seed\d+\.pth$', os.path.basename(model_filename)):
+        raise ValueError(f"Runs with --num_seeds {args.num_seeds} save one model per seed. Set --model_path to one of the model_[DATETIME]_seed[SEED].pth files instead of {model_filename}.")
+
+    # set_model only reads the run arguments and class counts, so the trainer is built without any data
+    trainer = CNN_Trainer.__new__(CNN_Trainer)
+    trainer.args = args
+    trainer.model_name = args.model
+    trainer.num_gestures = inference_state['num_gestures']
+    trainer.num_classes = inference_state['num_classes']
+    trainer.Y = argparse.Namespace(validation=torch.empty(0, inference_state['num_classes']))
+    trainer.set_model()
+    model = trainer.model
+
+    state_dict = torch.load(model_filename, map_location='cpu')
+    if args.freeze_backbone:
+        backbone, head, _ = split_backbone(model, args)
+        model = CachedBackboneModel(backbone, head)
+        model.load_state_dict(state_dict)
+        model = nn.Sequential(model.backbone, model.head)
+    else:
+        model.load_state_dict(state_dict)
+
+    return model.to(device).eval()
+
+def load_replay_windows(utils, args, exercises, subject, session=None):
+    """
+    Returns the EMG windows (WINDOW, CHANNEL, TIME) and one-hot labels of one subject (and session) as loaded for training by Combined_Data.
+
+    Only windows cut from one signal filtered as a whole (filter_mode 'causal') or left unfiltered ('none') are returned: windows filtered separately
+    with filtfilt disagree where they overlap (and FlexWear-HD ones are flipped in time), so replaying them as a stream would not give the same windows.
+    """
+
+    filter_mode = getattr(utils, 'filter_mode', 'zero_phase')
+    if filter_mode not in ('causal', 'none'):
+        raise NotImplementedError(f"Replay needs windows of a continuously filtered or unfiltered signal, not filter_mode '{filter_mode}'. Train with --causal_filter True.")
+
+    if exercises:
+        emg = [torch.as_tensor(utils.getEMG((subject, exercise, args))) for exercise in args.exercises]
+        labels = [torch.as_tensor(utils.getLabels((subject, exercise, args))) for exercise in args.exercises]
+        return torch.cat(emg, dim=0), torch.cat(labels, dim=0)
+    if session is not None:
+        return torch.as_tensor(utils.getEMG_separateSessions((subject, session))), torch.as_tensor(utils.getLabels_separateSessions((subject, session)))
+    return torch.as_tensor(utils.getEMG(subject)), torch.as_tensor(utils.getLabels(subject))
+
+def latency_summary(latencies):
+    """Returns the p50, p99 and max of latencies (seconds) in milliseconds."""
+
+    if len(latencies) == 0:
+        return {'p50_ms': float('nan'), 'p99_ms': float('nan'), 'max_ms': float('nan')}
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    return {'p50_ms': p50, 'p99_ms': p99, 'max_ms': np.max(latencies) * 1000}
+
+
+class Replay_Source():
+    """
+    Replays windows loaded by a utils_* module as the continuous stream they were cut from.
+
+    Within a recording, consecutive windows overlap by all but their first step samples, so the stream is the first step samples of every window
+    followed by the rest of the last one, and streamed window k is exactly window k as long as the windows were cut from one signal that was
+    not filtered window by window (see load_replay_windows). Windows spanning the boundary of two recordings (repetitions,
+    gestures or exercises) mix both, as a live recording would. Datasets whose windows are balanced or subsampled jump between parts of the
+    recording the same way, and a causal filter run over the stream carries its state across these jumps, which filtering offline does not.
+
+    Args:
+        windows: EMG windows (WINDOW, CHANNEL, TIME), filtered by the utils module unless its filter_mode is 'none'
+        labels: one-hot labels (WINDOW, CLASS)
+        step: hop between consecutive windows in samples
+        chunk_size: number of samples read at once
+        fs: sampling rate in Hz. If given, samples are released at the rate they were recorded and read() returns every sample that arrived since the last read (at least chunk_size). Otherwise chunks are released as fast as they are read.
+    """
+
+    def __init__(self, windows, labels, step, chunk_size, fs=None):
+        assert step <= windows.shape[-1], "Replay needs windows that overlap or touch (stepLen <= wLenTimesteps)."
+
+        windows = windows.to(torch.float32).numpy()
+        self.stream = np.concatenate((windows[:, :, :step].transpose(1, 0, 2).reshape(windows.shape[1], -1), windows[-1, :, step:]), axis=1)
+        self.window_labels = torch.as_tensor(labels).argmax(dim=1).numpy()
+        self.chunk_size = chunk_size
+        self.fs = fs
+        self.position = 0
+        self.start_time = None
+
+    def __len__(self):
+        return self.stream.shape[1]
+
+    def read(self):
+        """Returns the next chunk (CHANNEL, TIME) and the time its last sample arrived, or None once the stream is exhausted."""
+
+        if self.position >= len(self):
+            return None
+
+        end = min(self.position + self.chunk_size, len(self))
+        if self.fs is None:
+            arrival_time = time.perf_counter()
+        else:
+            if self.start_time is None:
+                self.start_time = time.perf_counter()
+            delay = self.start_time + end / self.fs - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            end = min(max(end, int((time.perf_counter() - self.start_time) * self.fs)), len(self))
+            arrival_time = self.start_time + end / self.fs
+
+        chunk = self.stream[:, self.position:end]
+        self.position = end
+        return chunk, arrival_time
+
+
+class Streaming_Classifier():
+    """
+    Classifies every window of a stream pushed in chunks.
+
+    Samples are filtered by stream_filter (if any) and written into a ring buffer of one window. Each time step new samples complete a window, a copy
+    is queued; after a chunk is written, the queued windows are classified. At most max_pending windows are queued per chunk (the oldest are dropped
+    and counted), which bounds the work done per chunk and therefore the decision latency when the model can not keep up with the stream.
+
+    Args:
+        model: model returned by load_model
+        utils: utils module returned by setup_utils
+        inference_state: inference state returned by load_inference_state
+        args: run arguments returned by load_inference_state
+        num_channels, window_length, step: shape of the windows the model was trained on and hop between them in samples
+        device: device the model is on
+        max_pending: maximum number of windows classified per chunk
+        stream_filter: Causal_Filter applied to every chunk before it is windowed, for runs trained with --causal_filter on unfiltered streams
+    """
+
+    def __init__(self, model, utils, inference_state, args, num_channels, window_length, step, device, max_pending=1, stream_filter=None):
+        self.model = model
+        self.stream_filter = stream_filter
+        self.utils = utils
+        self.args = args
+        self.device = device
+        self.window_length = window_length
+        self.step = step
+
+        self.scaler_mean = None if inference_state['scaler_mean'] is None else inference_state['scaler_mean'].numpy()
+        self.scaler_scale = None if inference_state['scaler_scale'] is None else inference_state['scaler_scale'].numpy()
+        if self.scaler_mean is not None:
+            assert len(self.scaler_mean) == num_channels * window_length, f"Scaler was fit on windows of {len(self.scaler_mean)} values, not {num_channels}x{window_length}."
+
+        image_size = 32 if args.model == 'vit_tiny_patch2_32' else 224
+        self.resize = transforms.Resize((image_size, image_size))
+
+        if args.turn_on_spectrogram:
+            image_function = 'optimized_makeOneSpectrogramImage'
+        elif args.turn_on_phase_spectrogram:
+            image_function = 'optimized_makeOnePhaseSpectrogramImage'
+        elif args.turn_on_hht:
+            image_function = 'optimized_makeOneHilbertHuangImage'
+        elif args.turn_on_cwt:
+            image_function = 'optimized_makeOneCWTImage'
+        else:
+            image_function = 'optimized_makeOneImage'
+        assert hasattr(utils, image_function), f"Streaming inference needs {image_function} in the utils module of {args.dataset}."
+        self.make_one_image = getattr(utils, image_function)
+        if args.turn_on_rms:
+            assert window_length % args.rms_input_windowsize == 0, f"RMS windows of {window_length} samples need a multiple of rms_input_windowsize={args.rms_input_windowsize}."
+
+        self.buffer = np.zeros((num_channels, window_length), dtype=np.float32)
+        self.samples_seen = 0
+        self.next_window_end = window_length
+        self.pending = collections.deque(maxlen=max_pending)
+
+        self.latencies = []
+        self.num_dropped = 0
+
+    def make_image(self, window):
+        """Preprocesses one window (CHANNEL, TIME) like utils.getImages does for the training windows and returns the model input (1, 3, H, W)."""
+
+        length, width = window.shape
+        emg = window.reshape(-1).astype(np.float64)
+        if self.scaler_mean is not None:
+            emg = (emg - self.scaler_mean) / self.scaler_scale
+
+        if self.args.turn_on_rms:
+            emg = np.sqrt(np.mean(emg.reshape(length, self.args.rms_input_windowsize, width // self.args.rms_input_windowsize) ** 2, axis=-1)).reshape(-1)
+            width = self.args.rms_input_windowsize
+
+        if self.make_one_image is self.utils.optimized_makeOneImage:
+            image = self.make_one_image(emg, self.utils.cmap, length, width, 1, 224)
+        else:
+            image = self.make_one_image(emg, length, width, 1, 224)
+
+        return self.resize(torch.from_numpy(np.asarray(image, dtype=np.float32))).unsqueeze(0)
+
+    def classify(self, window):
+        """Returns the predicted class of one window."""
+
+        with torch.inference_mode():
+            outputs = ml_utils.get_logits(self.model(self.make_image(window).to(self.device)))
+        return int(outputs.argmax(dim=1).item())
+
+    def warm_up(self):
+        """Classifies one empty window so that lazy initialization (cuDNN, allocator) is not counted as decision latency."""
+
+        self.classify(np.zeros_like(self.buffer))
+
+    def write(self, samples):
+        """Writes at most one window of samples (CHANNEL, TIME) into the ring buffer."""
+
+        start = self.samples_seen % self.window_length
+        first = min(samples.shape[1], self.window_length - start)
+        self.buffer[:, start:start + first] = samples[:, :first]
+        self.buffer[:, :samples.shape[1] - first] = samples[:, first:]
+        self.samples_seen += samples.shape[1]
+
+    def read_window(self):
+        """Returns a copy of the last window_length samples in time order."""
+
+        start = self.samples_seen % self.window_length
+        return np.concatenate((self.buffer[:, start:], self.buffer[:, :start]), axis=1)
+
+    def push(self, chunk, arrival_time):
+        """
+        Writes a chunk (CHANNEL, TIME) of samples and classifies the windows it completes.
+
+        Args:
+            chunk: new samples
+            arrival_time: time.perf_counter() time the last sample of the chunk arrived, from which decision latency is measured
+
+        Returns:
+            decisions: list of (window index, predicted class) for the classified windows
+        """
+
+        if self.stream_filter is not None:
+            chunk = self.stream_filter(chunk)
+
+        position = 0
+        while position < chunk.shape[1]:
+            num_samples = min(chunk.shape[1] - position, self.next_window_end - self.samples_seen)
+            self.write(chunk[:, position:position + num_samples])
+            position += num_samples
+
+            if self.samples_seen == self.next_window_end:
+                if len(self.pending) == self.pending.maxlen:
+                    self.num_dropped += 1
+                self.pending.append(((self.next_window_end - self.window_length) // self.step, self.read_window()))
+                self.next_window_end += self.step
+
+        decisions = []
+        while self.pending:
+            window_index, window = self.pending.popleft()
+            decisions.append((window_index, self.classify(window)))
+            self.latencies.append(time.perf_counter() - arrival_time)
+
+        return decisions
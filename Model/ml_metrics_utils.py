@@ -1,237 +1,391 @@
 import torchmetrics
 import torch
-from sklearn.metrics import roc_curve, auc
+from sklearn.metrics import auc
 from sklearn.preprocessing import label_binarize
 import numpy as np
+import time
 import wandb
 
-def calculate_tpr_at_fpr(y_true, y_scores, fpr_target):
-    """Calculate the TPR at a given FPR target using ROC curve data."""
-    fpr, tpr, thresholds = roc_curve(y_true, y_scores)
-    if fpr_target in fpr:
-        return tpr[np.where(fpr == fpr_target)[0][0]]
-    else:
-        return np.interp(fpr_target, fpr, tpr)
-
-def evaluate_model_tpr_at_fpr(model, loader, device, num_classes, fpr_targets=[0.01, 0.1, 0.5]):
-    """Evaluate model to find TPR at given FPR targets for each class in multiclass classification."""
+class ScoreBuffer():
+    """
+    Preallocated buffer of detached model outputs and labels for one epoch.
+
+    Feeds metrics that need every output of the epoch (Macro_AUROC, Macro_AUPRC) without keeping each batch's autograd graph alive until the end of the epoch.
+    """
+
+    def __init__(self, num_samples, num_classes, device, dtype=torch.float32, label_shape=(), label_dtype=torch.int64):
+        self.outputs = torch.empty((num_samples, num_classes), dtype=dtype, device=device)
+        self.labels = torch.empty((num_samples, *label_shape), dtype=label_dtype, device=device)
+        self.size = 0
+
+    def reset(self):
+        self.size = 0
+
+    def append(self, outputs, labels):
+        num_new = len(outputs)
+
+        # Grow if the loader yields more samples than expected (ex: sampler with replacement)
+        if self.size + num_new > len(self.outputs):
+            extra = max(num_new, len(self.outputs))
+            self.outputs = torch.cat((self.outputs, torch.empty((extra, self.outputs.shape[1]), dtype=self.outputs.dtype, device=self.outputs.device)))
+            self.labels = torch.cat((self.labels, torch.empty((extra, *self.labels.shape[1:]), dtype=self.labels.dtype, device=self.labels.device)))
+
+        self.outputs[self.size:self.size + num_new] = outputs.detach()
+        self.labels[self.size:self.size + num_new] = labels.detach()
+        self.size += num_new
+
+    def get(self):
+        """Returns the outputs (as float32) and labels appended since the last reset."""
+        return self.outputs[:self.size].to(torch.float32), self.labels[:self.size]
+
+class TrainingMetricTracker():
+    """
+    Applies the training metric policy (args.train_metrics) to the training metrics of one train loop.
+
+    full: every metric is updated on every batch. every_k: metrics are only updated on every k-th batch (args.train_metrics_every_k).
+    epoch: outputs are cached and every metric is updated once at the end of the epoch. off: training metrics are skipped.
+    Macro_AUROC and Macro_AUPRC need all outputs of the epoch, so under full and every_k they are computed from the cache as well, to which every
+    batch is appended (also the ones every_k skips), so they always cover the whole epoch.
+    If args.profile_train_metrics is set, the time spent in each metric is accumulated and printed by print_cost_report.
+    """
+
+    EPOCH_METRICS = ("Macro_AUROC", "Macro_AUPRC")
+
+    def __init__(self, metrics, args, num_samples, num_outputs, device):
+        self.metrics = metrics
+        self.policy = args.train_metrics
+        self.every_k = max(1, args.train_metrics_every_k)
+        self.profile = args.profile_train_metrics
+        self.synchronize = torch.device(device).type == "cuda"
+
+        if self.policy == "off":
+            self.batch_metrics, self.cached_metrics = [], []
+        elif self.policy == "epoch":
+            self.batch_metrics, self.cached_metrics = [], list(metrics)
+        else:
+            self.batch_metrics = [metric for metric in metrics if metric.name not in self.EPOCH_METRICS]
+            self.cached_metrics = [metric for metric in metrics if metric.name in self.EPOCH_METRICS]
+
+        self.scores = None
+        if self.cached_metrics:
+            if args.force_regression:
+                self.scores = ScoreBuffer(num_samples, num_outputs, device, label_shape=(num_outputs,), label_dtype=torch.float32)
+            else:
+                self.scores = ScoreBuffer(num_samples, num_outputs, device)
+
+        self.micro_accuracy_metric = next((metric for metric in self.batch_metrics if metric.name == "Micro_Accuracy"), None)
+        self.reset()
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+        if self.scores is not None:
+            self.scores.reset()
+        self.num_batches = 0
+        self.costs = {metric.name: 0.0 for metric in self.metrics}
+
+    def _timed(self, metric, fn, *fn_args):
+        if not self.profile:
+            return fn(*fn_args)
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fn(*fn_args)
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.costs[metric.name] += time.perf_counter() - start
+        return result
+
+    def update(self, outputs, labels):
+        """Caches one batch of outputs and labels (class indices for classification) and updates the batch metrics if the policy samples this batch."""
+        sampled = self.policy in ("full", "epoch") or (self.policy == "every_k" and self.num_batches % self.every_k == 0)
+        self.num_batches += 1
+        if self.policy == "off":
+            return
+
+        with torch.no_grad():
+            if sampled:
+                for metric in self.batch_metrics:
+                    self._timed(metric, metric.update, outputs, labels)
+            if self.scores is not None:
+                self.scores.append(outputs, labels)
+
+    def batch_accuracy(self):
+        """Running Micro_Accuracy for the progress bar, or None if it is not updated per batch."""
+        if self.micro_accuracy_metric is None:
+            return None
+        return self._timed(self.micro_accuracy_metric, self.micro_accuracy_metric.compute).item()
+
+    def compute(self):
+        """Returns {metric name: value} for the metrics the policy keeps, in the order of the metrics list."""
+        if self.scores is not None:
+            outputs, labels = self.scores.get()
+            for metric in self.cached_metrics:
+                self._timed(metric, metric.update, outputs, labels)
+
+        active = {id(metric) for metric in self.batch_metrics + self.cached_metrics}
+        return {metric.name: self._timed(metric, metric.compute) for metric in self.metrics if id(metric) in active}
+
+    def print_cost_report(self):
+        if not self.profile:
+            return
+        total = sum(self.costs.values())
+        costs_str = " | ".join(f"{name}: {cost*1000:.1f}ms" for name, cost in self.costs.items())
+        print(f"Train Metric Cost ({self.policy}): {costs_str} | Total: {total*1000:.1f}ms")
+
+def get_logits(outputs):
+    """Unwraps model outputs to logits. Models may return (logits, features) tuples or semilearn style dicts."""
+    if isinstance(outputs, tuple):
+        outputs = outputs[0]
+    if isinstance(outputs, dict):
+        outputs = outputs['logits']
+    return outputs
+
+def bincount_confusion_matrix(labels, predictions, num_classes):
+    """Confusion matrix (rows: true class, columns: predicted class) of class index tensors, computed with a bincount on their device."""
+    flat_index = labels.to(torch.int64) * num_classes + predictions.to(torch.int64)
+    return torch.bincount(flat_index, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+def run_inference(model, loader, device, criterion=None):
+    """Runs the model over the loader once without gradients and caches the logits and targets.
+
+    Args:
+        model: model to evaluate
+        loader: loader yielding (X_batch, Y_batch)
+        device: device to run on
+        criterion (optional): loss applied to (logits, Y_batch) for each batch
+
+    Returns:
+        outputs: concatenated logits (N, C) on device
+        labels: concatenated targets (N, C) on device, as stored in the dataset (one hot for classification)
+        loss: criterion summed over batches divided by len(loader) (same convention as the training loops), None if no criterion
+    """
     model.eval()
-    softmax = torch.nn.Softmax(dim=1)
-    predictions = []
-    true_labels = []
+    outputs_all = []
+    labels_all = []
+    loss = 0.0
 
     with torch.no_grad():
         for X_batch, Y_batch in loader:
-            X_batch = X_batch.to(device)
+            X_batch = X_batch.to(device).to(torch.float32)
+            Y_batch = Y_batch.to(device).to(torch.float32)
 
-            outputs = model(X_batch)
-            if len(outputs) == 2:
-                outputs, features = outputs
-            if isinstance(outputs, dict):
-                outputs = outputs['logits']
+            outputs = get_logits(model(X_batch))
             if len(outputs.shape) == 1:
-                # outputs = outputs.unsqueeze(dim=0)
                 continue
-            probs = softmax(outputs).cpu().numpy()  # Get class probabilities
-            predictions.append(probs)
-            true_labels.append(Y_batch.cpu().numpy())
-
-    predictions = np.concatenate(predictions, axis=0)
-    true_labels = np.concatenate(true_labels, axis=0)
-
-    # Calculate TPR at specified FPRs for each class
-    tprs_at_fixed_fprs = {f"FPR {int(fpr*100)}%": [] for fpr in fpr_targets}
-
-    # Iterate over each class
-    for class_index in range(true_labels.shape[1]):
-        y_true_class = true_labels[:, class_index]
-        y_scores_class = predictions[:, class_index]
-        
-        # For each FPR target, calculate the TPR
-        for fpr_target in fpr_targets:
-            tpr = calculate_tpr_at_fpr(y_true_class, y_scores_class, fpr_target)
-            tprs_at_fixed_fprs[f"FPR {int(fpr_target*100)}%"].append(tpr)
-
-    return tprs_at_fixed_fprs
-
-def calculate_fpr_at_tpr(y_true, y_scores, tpr_target):
-    """Calculate the FPR at a given TPR target using ROC curve data."""
-    fpr, tpr, thresholds = roc_curve(y_true, y_scores)
-    if tpr_target in tpr:
-        return fpr[np.where(tpr == tpr_target)[0][0]]
-    else:
-        return np.interp(tpr_target, tpr, fpr)
-    
-def evaluate_model_fpr_at_tpr(model, loader, device, num_classes, tpr_targets=[0.9, 0.95, 0.99]):
-    """Evaluate model to find FPR at given TPR targets for each class in multiclass classification."""
-    model.eval()
-    softmax = torch.nn.Softmax(dim=1)
-    predictions = []
-    true_labels = []
 
-    with torch.no_grad():
-        for X_batch, Y_batch in loader:
-            X_batch = X_batch.to(device)
-            outputs = model(X_batch)
-            if len(outputs) == 2:
-                outputs, features = outputs
-            if isinstance(outputs, dict):
-                outputs = outputs['logits']
-            if len(outputs.shape) == 1:
-                # outputs = outputs.unsqueeze(dim=0)
-                continue
-            probs = softmax(outputs).cpu().numpy()  # Get class probabilities
-            predictions.append(probs)
-            true_labels.append(Y_batch.cpu().numpy())
+            if criterion is not None:
+                loss += criterion(outputs, Y_batch).item()
 
-    predictions = np.concatenate(predictions, axis=0)
-    true_labels = np.concatenate(true_labels, axis=0)
+            outputs_all.append(outputs)
+            labels_all.append(Y_batch)
 
-    # Calculate FPR at specified TPRs for each class
-    fprs_at_fixed_tprs = {f"TPR {int(tpr*100)}%": [] for tpr in tpr_targets}
+    outputs_all = torch.cat(outputs_all, dim=0)
+    labels_all = torch.cat(labels_all, dim=0)
 
-    # Iterate over each class
-    for class_index in range(true_labels.shape[1]):
-        y_true_class = true_labels[:, class_index]
-        y_scores_class = predictions[:, class_index]
-        
-        # For each TPR target, calculate the FPR
-        for tpr_target in tpr_targets:
-            fpr = calculate_fpr_at_tpr(y_true_class, y_scores_class, tpr_target)
-            fprs_at_fixed_tprs[f"TPR {int(tpr_target*100)}%"].append(fpr)
+    if criterion is None:
+        return outputs_all, labels_all, None
+    return outputs_all, labels_all, loss / len(loader)
 
-    return fprs_at_fixed_tprs
+def roc_curves(predictions, true_labels):
+    """Per class ROC curves for all classes at once.
 
-def evaluate_confidence_thresholding(model, loader, device, thresholds=[0.5, 0.9, 0.95, 0.99]):
-    model.eval()
-    softmax = torch.nn.Softmax(dim=1)
-    correct_counts = {thresh: 0 for thresh in thresholds}
-    total_counts = {thresh: 0 for thresh in thresholds}
-    total_above_threshold_counts = {thresh: 0 for thresh in thresholds}
+    Scores are sorted once per class in a single batched sort and the curves come from one cumulative TP/FP sweep. Tied scores collapse onto the last point of their run, matching sklearn.metrics.roc_curve (which only keeps distinct thresholds).
 
-    with torch.no_grad():
-        for X_batch, Y_batch in loader:
-            X_batch = X_batch.to(device)
-            Y_batch = Y_batch.to(device)
-            outputs = model(X_batch)
-            if len(outputs) == 2:
-                outputs, features = outputs
-            if isinstance(outputs, dict):
-                outputs = outputs['logits']
-            if len(outputs.shape) == 1:
-                # outputs = outputs.unsqueeze(dim=0)
-                continue
-            probs = softmax(outputs)
-            max_probs, preds = torch.max(probs, dim=1)
+    Args:
+        predictions (tensor): class probabilities (N, C)
+        true_labels (tensor): one hot labels (N, C)
 
-            for thresh in thresholds:
-                above_thresh = max_probs > thresh
-                total_counts[thresh] += above_thresh.sum().item()
-                correct_counts[thresh] += (preds[above_thresh] == torch.argmax(Y_batch[above_thresh], axis=1)).sum().item()
-                total_above_threshold_counts[thresh] += len(max_probs[max_probs > thresh])
+    Returns:
+        fpr, tpr: (C, N+1) float64 tensors, non-decreasing along the last dim and starting at 0
+    """
+    predictions = torch.as_tensor(predictions)
+    true_labels = torch.as_tensor(true_labels, device=predictions.device).to(torch.float64)
+    num_samples = predictions.shape[0]
 
-    confidence_accuracy = {thresh: (correct_counts[thresh] / total_counts[thresh]) if total_counts[thresh] > 0 else 0 for thresh in thresholds}
-    proportion_above_threshold = {thresh: (total_above_threshold_counts[thresh] / len(loader.dataset)) for thresh in thresholds}
+    sorted_scores, order = torch.sort(predictions, dim=0, descending=True, stable=True)
+    sorted_labels = true_labels.gather(0, order)
 
-    return confidence_accuracy, proportion_above_threshold
+    tps = torch.cumsum(sorted_labels, dim=0)
+    fps = torch.cumsum(1 - sorted_labels, dim=0)
 
-def evaluate_model_on_test_set(model, test_loader, device, numGestures, criterion, args, testing_metrics):
+    # Index of the last element of each run of tied scores
+    positions = torch.arange(num_samples, device=predictions.device).unsqueeze(1).expand_as(sorted_scores)
+    run_end = torch.ones_like(sorted_scores, dtype=torch.bool)
+    run_end[:-1] = sorted_scores[1:] != sorted_scores[:-1]
+    last_of_run = torch.where(run_end, positions, torch.full_like(positions, num_samples - 1))
+    last_of_run = torch.flip(torch.cummin(torch.flip(last_of_run, dims=[0]), dim=0).values, dims=[0])
 
-    # Assuming model, criterion, device, and test_loader are defined
-    model.eval()
-    test_loss = 0.0
+    tps = tps.gather(0, last_of_run)
+    fps = fps.gather(0, last_of_run)
 
-    # Reset test metrics
-    for test_metric in testing_metrics:
-        test_metric.reset()
+    # Start every curve at (0, 0)
+    zeros = torch.zeros((1, tps.shape[1]), dtype=tps.dtype, device=tps.device)
+    tps = torch.cat((zeros, tps), dim=0)
+    fps = torch.cat((zeros, fps), dim=0)
 
-    pred = []
-    true = []
-    outputs_all = []
-    Y_test = []
+    fpr = (fps / fps[-1]).t().contiguous()
+    tpr = (tps / tps[-1]).t().contiguous()
 
-    with torch.no_grad():
-        for X_batch, Y_batch in test_loader:
-            X_batch = X_batch.to(device).to(torch.float32)
-            Y_batch = Y_batch.to(device).to(torch.float32)
-            Y_test.append(Y_batch)
+    return fpr, tpr
 
-            if args.force_regression:
-                Y_batch_long = Y_batch
-            else: 
-                Y_batch_long = torch.argmax(Y_batch, dim=1) 
-
-            output = model(X_batch)
-            if len(output) == 2:
-                output, features = output
-            if isinstance(output, dict):
-                output = output['logits']
-            if len(output.shape) == 1:
-                # output = output.unsqueeze(dim=0)
-                continue
-            pred.extend(torch.argmax(output, dim=1).cpu().detach().numpy())
-            true.extend(Y_batch_long.cpu().detach().numpy())
+def interpolate_operating_points(x, y, targets):
+    """Reads y at x == target off every curve in one searchsorted call.
 
-            if not args.force_regression:
-                outputs_all.append(output)
+    Uses the first point where x reaches the target, or linear interpolation between the two points around it (same as the previous np.interp on the sklearn curve).
 
-            test_loss += criterion(output, Y_batch).item()
+    Args:
+        x, y (tensor): (C, M) curves, x non-decreasing along the last dim
+        targets (list): operating points on x
 
-        outputs_all = torch.cat(outputs_all, dim=0).to(device)
-        Y_test = torch.cat(Y_test, dim=0).to(device)
-        Y_test = torch.argmax(Y_test, dim=1)
+    Returns:
+        tensor: (C, len(targets))
+    """
+    targets = torch.tensor(targets, dtype=x.dtype, device=x.device).expand(x.shape[0], -1).contiguous()
 
-        # truncate the outputs to the length of the true labels
-        outputs_all = outputs_all[:len(true)]
-        Y_test = Y_test[:len(true)]
+    upper = torch.searchsorted(x, targets).clamp(max=x.shape[1] - 1)
+    lower = (upper - 1).clamp(min=0)
 
-        for test_metric in testing_metrics:
-            if test_metric.name != "Macro_AUROC" and test_metric.name != "Macro_AUPRC":
-                test_metric(outputs_all, Y_test)
+    x_upper, y_upper = x.gather(1, upper), y.gather(1, upper)
+    x_lower, y_lower = x.gather(1, lower), y.gather(1, lower)
 
-            
+    interpolated = y_lower + (targets - x_lower) * (y_upper - y_lower) / (x_upper - x_lower)
+    return torch.where(x_upper == targets, y_upper, interpolated)
 
-    if not args.force_regression: 
-        true_torch = torch.tensor(true).to(device)
+def compute_tpr_at_fpr(predictions, true_labels, fpr_targets=[0.01, 0.1, 0.5], curves=None):
+    """Find TPR at given FPR targets for each class from cached class probabilities (N, C) and one hot labels (N, C)."""
+    fpr, tpr = curves if curves is not None else roc_curves(predictions, true_labels)
+    tprs = interpolate_operating_points(fpr, tpr, fpr_targets).t().cpu().numpy()
 
-        test_macro_auroc = next(metric for metric in testing_metrics if metric.name == "Macro_AUROC")
-        test_macro_auprc = next(metric for metric in testing_metrics if metric.name == "Macro_AUPRC")
+    return {f"FPR {int(fpr_target*100)}%": list(tprs[i]) for i, fpr_target in enumerate(fpr_targets)}
 
-        test_macro_auroc(outputs_all, true_torch)
-        test_macro_auprc(outputs_all, true_torch)
+def evaluate_model_tpr_at_fpr(model, loader, device, num_classes, fpr_targets=[0.01, 0.1, 0.5]):
+    """Evaluate model to find TPR at given FPR targets for each class in multiclass classification."""
+    outputs, labels, _ = run_inference(model, loader, device)
+    predictions = torch.softmax(outputs, dim=1)  # Get class probabilities
 
-    # Calculate average loss and metrics
-    test_loss /= len(test_loader)
+    return compute_tpr_at_fpr(predictions, labels, fpr_targets)
 
-    testing_metrics_values = {metric.name: metric.compute() for metric in testing_metrics}
+def compute_fpr_at_tpr(predictions, true_labels, tpr_targets=[0.9, 0.95, 0.99], curves=None):
+    """Find FPR at given TPR targets for each class from cached class probabilities (N, C) and one hot labels (N, C)."""
+    fpr, tpr = curves if curves is not None else roc_curves(predictions, true_labels)
+    fprs = interpolate_operating_points(tpr, fpr, tpr_targets).t().cpu().numpy()
 
-    if not args.force_regression: 
-        tpr_results = evaluate_model_tpr_at_fpr(model, test_loader, device, numGestures)
-        fpr_results = evaluate_model_fpr_at_tpr(model, test_loader, device, numGestures)
-        confidence_levels, proportions_above_confidence_threshold = evaluate_confidence_thresholding(model, test_loader, device)
+    return {f"TPR {int(tpr_target*100)}%": list(fprs[i]) for i, tpr_target in enumerate(tpr_targets)}
+    
+def evaluate_model_fpr_at_tpr(model, loader, device, num_classes, tpr_targets=[0.9, 0.95, 0.99]):
+    """Evaluate model to find FPR at given TPR targets for each class in multiclass classification."""
+    outputs, labels, _ = run_inference(model, loader, device)
+    predictions = torch.softmax(outputs, dim=1)  # Get class probabilities
+
+    return compute_fpr_at_tpr(predictions, labels, tpr_targets)
+
+def compute_confidence_thresholding(outputs, labels_long, thresholds=[0.5, 0.9, 0.95, 0.99]):
+    """Accuracy and proportion of samples whose max softmax probability is above each threshold, from cached logits (N, C) and class indices (N,)."""
+    probs = torch.softmax(outputs, dim=1)
+    max_probs, preds = torch.max(probs, dim=1)
+    correct = preds == labels_long
+
+    confidence_accuracy = {}
+    proportion_above_threshold = {}
+    for thresh in thresholds:
+        above_thresh = max_probs > thresh
+        total_count = above_thresh.sum().item()
+        confidence_accuracy[thresh] = (correct[above_thresh].sum().item() / total_count) if total_count > 0 else 0
+        proportion_above_threshold[thresh] = total_count / len(max_probs)
+
+    return confidence_accuracy, proportion_above_threshold
+
+def evaluate_confidence_thresholding(model, loader, device, thresholds=[0.5, 0.9, 0.95, 0.99]):
+    outputs, labels, _ = run_inference(model, loader, device)
+    return compute_confidence_thresholding(outputs, torch.argmax(labels, dim=1), thresholds)
+
+def evaluate_loader(model, loader, device, criterion, args, metrics, fpr_at_tpr=True):
+    """Fused evaluation. Runs inference over the loader once and computes the loss, torchmetrics, TPR at FPR, FPR at TPR and confidence thresholding stats from the cached logits.
 
+    Args:
+        model: model to evaluate
+        loader: validation or test loader
+        device: device to run on
+        criterion: loss applied to (logits, Y_batch)
+        args: run arguments (uses force_regression)
+        metrics: torchmetrics from get_metrics(). Reset and updated once with the whole buffer.
+        fpr_at_tpr (bool, optional): whether to also compute FPR at fixed TPR. Defaults to True.
+
+    Returns:
+        dict: loss, metrics_values, outputs (logits), labels (class indices or regression targets) and, for classification, tpr_results, fpr_results (if requested), confidence_levels and proportions_above_confidence_threshold.
+    """
+
+    outputs, labels, loss = run_inference(model, loader, device, criterion)
+
+    if args.force_regression:
+        labels_long = labels
+    else:
+        labels_long = torch.argmax(labels, dim=1)
+
+    for metric in metrics:
+        metric.reset()
+        metric.update(outputs, labels_long)
+
+    results = {
+        "loss": loss,
+        "outputs": outputs,
+        "labels": labels_long,
+        # Compute the metrics and store them in dictionaries (to prevent multiple calls to compute)
+        "metrics_values": {metric.name: metric.compute() for metric in metrics},
+    }
+
+    if not args.force_regression:
+        # One sort and cumulative sweep shared by every TPR@FPR and FPR@TPR operating point
+        curves = roc_curves(torch.softmax(outputs, dim=1), labels)
+
+        results["tpr_results"] = compute_tpr_at_fpr(None, None, curves=curves)
+        if fpr_at_tpr:
+            results["fpr_results"] = compute_fpr_at_tpr(None, None, curves=curves)
+        results["confidence_levels"], results["proportions_above_confidence_threshold"] = compute_confidence_thresholding(outputs, labels_long)
+
+    return results
+
+def evaluate_model_on_test_set(model, test_loader, device, numGestures, criterion, args, testing_metrics, log_prefix=""):
+    """Evaluates the model on the test set with a single inference pass, prints and logs the test metrics (wandb keys prefixed with log_prefix).
+
+    Returns:
+        dict: results of evaluate_loader (cached test logits and labels included)
+    """
+
+    results = evaluate_loader(model, test_loader, device, criterion, args, testing_metrics)
+
+    test_loss = results["loss"]
+    testing_metrics_values = results["metrics_values"]
+
+    if not args.force_regression: 
+        tpr_results = results["tpr_results"]
+        fpr_results = results["fpr_results"]
+        confidence_levels = results["confidence_levels"]
+        proportions_above_confidence_threshold = results["proportions_above_confidence_threshold"]
 
     testing_metrics_str = " | ".join(f"{name}: {value.item():.4f}" if name != 'R2Score_RawValues' else f"{name}: ({', '.join(f'{v.item():.4f}' for v in value)})" for name, value in testing_metrics_values.items())
 
     print(f"Test Metrics: {testing_metrics_str}")
 
     wandb.log({
-        "test/Loss": test_loss,
+        f"{log_prefix}test/Loss": test_loss,
         **{
-            f"test/{name}": value.item() 
+            f"{log_prefix}test/{name}": value.item() 
             for name, value in testing_metrics_values.items() 
             if name != 'R2Score_RawValues'
         },
         **{
-            f"test/R2Score_RawValues_{i+1}": v.item() 
+            f"{log_prefix}test/R2Score_RawValues_{i+1}": v.item() 
             for name, value in testing_metrics_values.items() 
             if name == 'R2Score_RawValues'
             for i, v in enumerate(value)
         },
         # **{f"tpr_at_fixed_fpr/Test TPR at {fpr} FPR - Gesture {idx}": tpr for fpr, tprs in tpr_results.items() for idx, tpr in enumerate(tprs)},
-        **({f"tpr_at_fixed_fpr/Average Test TPR at {fpr} FPR": np.mean(tprs) for fpr, tprs in tpr_results.items()} if not args.force_regression else {}),
-        **({f"fpr_at_fixed_tpr/Average Test FPR at {tpr} TPR": np.mean(fprs) for tpr, fprs in fpr_results.items()} if not args.force_regression else {}),
-        **({f"confidence_level_accuracies/Test Accuracy at {int(confidence_level*100)}% confidence": acc for confidence_level, acc in confidence_levels.items()} if not args.force_regression else {}),
-        **({f"proportion_above_confidence_threshold/Test Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not args.force_regression else {})
+        **({f"{log_prefix}tpr_at_fixed_fpr/Average Test TPR at {fpr} FPR": np.mean(tprs) for fpr, tprs in tpr_results.items()} if not args.force_regression else {}),
+        **({f"{log_prefix}fpr_at_fixed_tpr/Average Test FPR at {tpr} TPR": np.mean(fprs) for tpr, fprs in fpr_results.items()} if not args.force_regression else {}),
+        **({f"{log_prefix}confidence_level_accuracies/Test Accuracy at {int(confidence_level*100)}% confidence": acc for confidence_level, acc in confidence_levels.items()} if not args.force_regression else {}),
+        **({f"{log_prefix}proportion_above_confidence_threshold/Test Proportion above {int(confidence_level*100)}% confidence": prop for confidence_level, prop in proportions_above_confidence_threshold.items()} if not args.force_regression else {})
     })
 
+    return results
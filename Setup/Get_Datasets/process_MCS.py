@@ -1,17 +1,33 @@
 #!/usr/bin/env python
+"""
+Segments the raw MCS_EMG .mat recordings into per participant HDF5 files.
 
-import numpy as np
-import scipy
-import scipy.io as sio
-from tqdm import tqdm
-import pandas as pd
-import h5py
+For every participant two files are written to DatasetsProcessed_hdf5/MCS_EMG[_include_transitions|_transition_classifier]/p[N]/:
+    participant_[N].hdf5: groups 'Cycle[R]/Gesture[NAME]' holding an 'sEMG' dataset of shape (CHANNEL, TIME)
+    flattened_participant_[N].hdf5: datasets 'Gesture[NAME]' of shape (CYCLE, CHANNEL, TIME), read by utils_MCS_EMG
+
+Participants are converted in parallel worker processes. Each file is written under a temporary name and renamed once complete, and a
+participant is marked done only after both of its files are in place, so an interrupted run resumes from the participants it did not finish.
+"""
+
+import argparse
+import multiprocessing
 import os
 from glob import glob
-import torch
 
+import h5py
+import numpy as np
+import scipy.io
+from tqdm import tqdm
+
+# Sampling rate "Hz"
+fs = 2000
+gesture_names = ['Rest', 'Extension', 'Flexion', 'Ulnar_Deviation', 'Radial_Deviation', 'Grip', 'Abduction', 'Adduction', 'Supination', 'Pronation']
+rep_coeffs = [4, 138, 272, 406, 540] # start of each of the 5 repetitions in seconds
+
+# Written in a participant folder once both of its files are complete, and in the dataset folder once every participant is
+COMPLETE_MARKER = '.complete'
 
-# Argparse for including transitions and transition classifier
 def str2bool(v):
     if isinstance(v, bool):
         return v
@@ -21,238 +37,124 @@ def str2bool(v):
         return False
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
-    
-import argparse
-parser = argparse.ArgumentParser(description="Include arguments for loading different data files")
-parser.add_argument("--include_transitions", type=str2bool, help="Start labeling gestures as soon as cue begins. Defaults to False.", default=False)
-parser.add_argument("--transition_classifier", type=str2bool, help="Classify windows as transtions or non transitions. Shortens observed window. Defaults to False.", default=False)
-args = parser.parse_args()
-
-
-# Sampling rate "Hz"
-fs = 2000
-gesture_names = ['Rest', 'Extension', 'Flexion', 'Ulnar_Deviation', 'Radial_Deviation', 'Grip', 'Abduction', 'Adduction', 'Supination', 'Pronation']
-
-# Desired sEMG Segments Length in seconds
-# Erase old files to write new hdf5 files if you want to change this
-
 
-# Set time delay after cue
-if args.include_transitions or args.transition_classifier:
-    signal_segment_starting = 0 # start labeling as soon as the cue starts
-else:
-    signal_segment_starting = 1 
-
-# Set second to stop observing after cue
-if args.transition_classifier:
-    signal_segment_ending = 2 # one second of each to balance transition/non-transition windows
-else:
-    signal_segment_ending = 6 # amount of time after signal. 6 seconds is the end of the cue, so 5 or 6 are good numbers
-
-
-# Get sEMG Records directory
-current_folder = './MCS_EMG/'  # Change with current folder
-Base = os.path.join(current_folder, 'sEMG-dataset/raw/mat')  # Change raw or filtered as needed
-Files = glob(os.path.join(Base, '**/*.mat'), recursive=True)
-# Files.sort()  # Sort files if needed
-
-                    
-# Automated segmentation and saving of all participant sEMG data to sEMG gesture segment in HDF5
-for file_path in Files:
-    
+def create_argparse():
+    parser = argparse.ArgumentParser(description="Segment the raw MCS_EMG recordings into per participant HDF5 files")
+    parser.add_argument("--include_transitions", type=str2bool, help="Start labeling gestures as soon as cue begins. Defaults to False.", default=False)
+    parser.add_argument("--transition_classifier", type=str2bool, help="Classify windows as transtions or non transitions. Shortens observed window. Defaults to False.", default=False)
+    parser.add_argument("--raw_folder", type=str, help="Folder searched recursively for the raw .mat files. Defaults to ./MCS_EMG/sEMG-dataset/raw/mat.", default='./MCS_EMG/sEMG-dataset/raw/mat')
+    parser.add_argument("--workers", type=int, help="Number of participants converted in parallel. Defaults to the number of CPUs.", default=multiprocessing.cpu_count())
+    parser.add_argument("--compression_level", type=int, choices=range(10), help="gzip compression level of the written datasets (0 disables compression). The datasets are always read whole, so lower levels mainly trade disk space for load time. Defaults to 4.", default=4)
+    parser.add_argument("--overwrite", action="store_true", help="Reprocess participants that are already marked complete.")
+    return parser.parse_args()
+
+def get_output_folder(args):
     if args.transition_classifier:
-        foldername = 'DatasetsProcessed_hdf5/MCS_EMG_transition_classifier/'
+        return 'DatasetsProcessed_hdf5/MCS_EMG_transition_classifier/'
     elif args.include_transitions:
-        foldername = 'DatasetsProcessed_hdf5/MCS_EMG_include_transitions/'
+        return 'DatasetsProcessed_hdf5/MCS_EMG_include_transitions/'
     else:
-        foldername = 'DatasetsProcessed_hdf5/MCS_EMG/'
-    mat_data = scipy.io.loadmat(file_path)
-    data = mat_data['data']
-    participant_id = mat_data['iD'][0][0]  # Modify based on where ID is stored in your .mat
-
-    # Create or open HDF5 file for each participant
-    foldername = os.path.join(foldername, 'p' + str(participant_id) + '/')
-    hdf5_filename = f'participant_{participant_id}.hdf5'
-    hdf5_filename = os.path.join(foldername, hdf5_filename)
-    # Make folders if they don't exist
-    os.makedirs(os.path.dirname(hdf5_filename), exist_ok=True)
-    # Open the file
-    try:
-        hdf_file = h5py.File(hdf5_filename, 'x')  # 'x' mode to fail if exists
-    except FileExistsError:
-        print(f"File {hdf5_filename} already exists. Skipping...")
-        continue
-    except OSError as e:
-        print(e)
-        print(f"Error creating file {hdf5_filename}. Skipping...")
-        continue
-    with h5py.File(hdf5_filename, 'a') as hdf_file:  # 'a' mode to append if already exists
-        
-        for rep in range(5):  # 5 repetitions
-            rep_coeff = [4, 138, 272, 406, 540][rep]
-
-            for gesture in range(10):  # Total of 10 hand gestures
-                start_idx = (signal_segment_starting + rep_coeff + (gesture * 10)) * fs
-                end_idx = ((rep_coeff + (gesture * 10)) + signal_segment_ending) * fs
-                
-                # Multi-channel sEMG data
-                multi_channel_sEMG_data = data[start_idx:end_idx, :].T
-
-                # Define a group for each gesture and cycle. Cycles act as hdf top-level keys 
-                # and gestures act as sub-keys. 'sEMG' is the sole sub-sub-key for the data
-                group_name = f'Cycle{rep + 1}/Gesture{gesture_names[gesture]}'
-                grp = hdf_file.require_group(group_name)
-
-                # Save the data in the group, formatted as (CHANNEL, TIME)
-                grp.create_dataset('sEMG', data=multi_channel_sEMG_data, compression="gzip")
-                
-              
-
-    print(f"Data for participant {participant_id} and all gestures saved in {hdf5_filename}.")
-
+        return 'DatasetsProcessed_hdf5/MCS_EMG/'
 
-import h5py
-import numpy as np
-import os
-import scipy.io  # For loading .mat files
-from glob import glob
-import matplotlib.pyplot as plt
-#Flattened dataset with gestures as groups and numpy arrays of shape (CYCLE, CHANNEL, TIME)
+def get_segment_bounds(args):
+    """Seconds after each cue at which the labeled segment starts and ends."""
 
-for i in range(1, 41):
+    # Set time delay after cue
+    if args.include_transitions or args.transition_classifier:
+        signal_segment_starting = 0 # start labeling as soon as the cue starts
+    else:
+        signal_segment_starting = 1
 
+    # Set second to stop observing after cue
     if args.transition_classifier:
-        foldername = 'DatasetsProcessed_hdf5/MCS_EMG_transition_classifier/'
-    elif args.include_transitions: 
-        foldername = 'DatasetsProcessed_hdf5/MCS_EMG_include_transitions/'
+        signal_segment_ending = 2 # one second of each to balance transition/non-transition windows
     else:
-        foldername = 'DatasetsProcessed_hdf5/MCS_EMG/'
-
-    foldername = os.path.join(foldername, 'p' + str(i) + '/')
-    hdf5_input_filename = f'participant_{i}.hdf5'
-    hdf5_input_filename = os.path.join(foldername, hdf5_input_filename)
-    hdf5_output_filename = f'flattened_participant_{i}.hdf5'
-    hdf5_output_filename = os.path.join(foldername, hdf5_output_filename)
-
-    try: 
-        hdf5_input_file = h5py.File(hdf5_input_filename, 'r')
-    except FileNotFoundError:
-        print(f"File {hdf5_input_filename} not found. Skipping...")
-        continue
-    # Open the existing HDF5 file to read
-    try:
-        hdf5_output_file = h5py.File(hdf5_output_filename, 'r')  
-        print(f"File {hdf5_output_filename} exists.")
-    except FileNotFoundError:
-        print(f"File {hdf5_output_filename} not found. Reprocessing data...")
-
-        with h5py.File(hdf5_input_filename, 'r') as hdf_read:
-            try: 
-                print(f"Attempting to create file {hdf5_output_filename}")
-                # Open a new HDF5 file to write reprocessed data
-                with h5py.File(hdf5_output_filename, 'w') as hdf_write:
-                    
-                    # Iterate through each gesture (assuming 10 gestures)
-                    for gesture in range(10):
-                        all_cycles_data = []  # List to hold data from all cycles for this gesture
-
-                        # Collect data from each cycle for this gesture
-                        for rep in range(1, 6):  # Assuming 5 cycles, named as 'Cycle1', 'Cycle2', ...
-                            cycle_group_name = f'Cycle{rep}/Gesture{gesture_names[gesture]}'
-                            if cycle_group_name in hdf_read:
-                                # Read and append the data
-                                cycle_data = hdf_read[cycle_group_name]['sEMG'][:]
-                                all_cycles_data.append(cycle_data)
-
-                        # Aggregate all cycles data into a single array (CYCLE, CHANNELS, TIME)
-                        # hdf5 keys are named as 'Gesture{gesture_name}'    
-                        if all_cycles_data:  # Ensure there is data to process
-                            aggregated_data = np.stack(all_cycles_data, axis=0)  # Stack along new axis for cycles
-
-                            # Write the aggregated data to the new file
-                            hdf_write.create_dataset(f'Gesture{gesture_names[gesture]}', data=aggregated_data, compression="gzip")
-            except FileExistsError as e:
-                print(f"File {hdf5_output_filename} already exists. Skipping...")
-                continue
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}")
-                continue
-
-        print(f"Reprocessed data saved in {hdf5_output_filename}.")
+        signal_segment_ending = 6 # amount of time after signal. 6 seconds is the end of the cue, so 5 or 6 are good numbers
 
+    return signal_segment_starting, signal_segment_ending
 
-gesture_names = ['Rest', 'Extension', 'Flexion', 'Ulnar_Deviation', 'Radial_Deviation', 'Grip', 'Abduction', 'Adduction', 'Supination', 'Pronation']
+def get_completed_sources(output_folder):
+    """Raw files whose participants are already marked complete. Markers store the path of the raw file they were made from."""
 
-if args.transition_classifier:
-    foldername = 'DatasetsProcessed_hdf5/MCS_EMG_transition_classifier/p40/'
-elif args.include_transitions:
-    foldername = 'DatasetsProcessed_hdf5/MCS_EMG_include_transitions/p40/'
-else:
-    foldername = 'DatasetsProcessed_hdf5/MCS_EMG/p40/'
+    completed = set()
+    for marker_path in glob(os.path.join(output_folder, 'p*', COMPLETE_MARKER)):
+        with open(marker_path) as marker:
+            completed.add(marker.read().strip())
+    return completed
 
-hdf5_filename = 'flattened_participant_40.hdf5'
-hdf5_filename = os.path.join(foldername, hdf5_filename)
-with h5py.File(hdf5_filename, 'r') as hdf_file:
-    # List all groups
-    print("Keys: %s" % hdf_file.keys())
-    a_group_key = list(hdf_file.keys())[0]
+def write_atomically(filename, write):
+    """Calls write on an HDF5 file opened under a temporary name and moves it to filename once it is closed."""
 
-    #print(hdf_file['GestureRest'].shape)
-    for name in gesture_names:
-        print(hdf_file["Gesture" + name].shape)
+    tmp_filename = filename + '.tmp'
+    with h5py.File(tmp_filename, 'w') as hdf_file:
+        write(hdf_file)
+    os.replace(tmp_filename, filename)
 
+def process_participant(file_path, args):
+    """Segments one raw recording and writes both HDF5 files of its participant. Returns the participant id."""
 
-from scipy.signal import butter, filtfilt, iirnotch
-gesture_names = ['Rest', 'Extension', 'Flexion', 'Ulnar_Deviation', 'Radial_Deviation', 'Grip', 'Abduction', 'Adduction', 'Supination', 'Pronation']
-numGestures = 10
-fs = 2000 #Hz
-wLen = 250 # ms
-wLenTimesteps = int(wLen / 1000 * fs)
-stepLen = 100 #50 ms
-def filter(emg):
-    # sixth-order Butterworth highpass filter
-    b, a = butter(N=3, Wn=[5.0, 500.0], btype='bandpass', analog=False, fs=2000.0)
-    emgButter = torch.from_numpy(np.flip(filtfilt(b, a, emg),axis=0).copy())
-
-    #second-order notch filter at 50 Hz
-    b, a = iirnotch(w0=50.0, Q=0.0001, fs=2000.0)
-    return torch.from_numpy(np.flip(filtfilt(b, a, emgButter),axis=0).copy())
-
-# Check flattened data
-def getEMG (n):
-    # NOTE: Not sure if this function is being used 
+    compression_kwargs = {'compression': 'gzip', 'compression_opts': args.compression_level} if args.compression_level > 0 else {}
+    signal_segment_starting, signal_segment_ending = get_segment_bounds(args)
 
-    if args.transition_classifier:
-        file = h5py.File('DatasetsProcessed_hdf5/MCS_EMG_transition_classifier/p40/flattened_participant_40.hdf5', 'r')
-    elif args.include_transitions:
-        file = h5py.File('DatasetsProcessed_hdf5/MCS_EMG_include_transitions/p40/flattened_participant_40.hdf5', 'r')
-    else:
-        file = h5py.File('DatasetsProcessed_hdf5/MCS_EMG/p40/flattened_participant_40.hdf5', 'r')
-    emg = []
-    for gesture in gesture_names:
-        data = filter(torch.from_numpy(np.array(file["Gesture" + gesture]))).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
-        emg.append(torch.cat([data[i] for i in range(len(data))], dim=-2).permute((1, 0, 2)))
-    return torch.cat(emg, dim=0)
-
-# size of 4800 assumes 250 ms window
-def getLabels (n):
-    labels = np.zeros((4800, numGestures))
-    for i in range(480):
-        for j in range(numGestures):
-            labels[j * 480 + i][j] = 1.0
-    return labels
-
-'''for i in range(40):
-    data = getEMG(i)
-    print(data.shape)'''
-
-labels = getLabels(20)
-numEach = [0 for i in range(10)]
-for i in range(len(labels)):
-    for j in range(len(labels[0])):
-        if (labels[i][j] != 0):
-            numEach[j] += 1
-
-print(labels.shape)
-print(numEach)
+    mat_data = scipy.io.loadmat(file_path)
+    data = mat_data['data']
+    participant_id = mat_data['iD'][0][0]  # Modify based on where ID is stored in your .mat
 
+    foldername = os.path.join(get_output_folder(args), 'p' + str(participant_id) + '/')
+    os.makedirs(foldername, exist_ok=True)
+    marker_path = os.path.join(foldername, COMPLETE_MARKER)
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
+
+    # segments[gesture][rep] is the multi-channel sEMG data of one cue, formatted as (CHANNEL, TIME)
+    segments = [[] for _ in gesture_names]
+    for rep_coeff in rep_coeffs:
+        for gesture in range(len(gesture_names)):
+            start_idx = (signal_segment_starting + rep_coeff + (gesture * 10)) * fs
+            end_idx = ((rep_coeff + (gesture * 10)) + signal_segment_ending) * fs
+            segments[gesture].append(data[start_idx:end_idx, :].T)
+
+    def write_cycles(hdf_file):
+        # Cycles act as hdf top-level keys and gestures act as sub-keys. 'sEMG' is the sole sub-sub-key for the data
+        for gesture, gesture_segments in enumerate(segments):
+            for rep, segment in enumerate(gesture_segments):
+                grp = hdf_file.require_group(f'Cycle{rep + 1}/Gesture{gesture_names[gesture]}')
+                grp.create_dataset('sEMG', data=segment, **compression_kwargs)
+
+    def write_flattened(hdf_file):
+        # hdf5 keys are named as 'Gesture{gesture_name}', stacked along a new axis for cycles (CYCLE, CHANNELS, TIME)
+        for gesture, gesture_segments in enumerate(segments):
+            hdf_file.create_dataset(f'Gesture{gesture_names[gesture]}', data=np.stack(gesture_segments, axis=0), **compression_kwargs)
+
+    write_atomically(os.path.join(foldername, f'participant_{participant_id}.hdf5'), write_cycles)
+    write_atomically(os.path.join(foldername, f'flattened_participant_{participant_id}.hdf5'), write_flattened)
+
+    with open(marker_path, 'w') as marker:
+        marker.write(file_path)
+
+    return participant_id
+
+def process_participant_star(job):
+    return process_participant(*job)
+
+def main():
+    args = create_argparse()
+    output_folder = get_output_folder(args)
+    os.makedirs(output_folder, exist_ok=True)
+
+    files = sorted(glob(os.path.join(args.raw_folder, '**/*.mat'), recursive=True))
+    if not files:
+        raise FileNotFoundError(f"No .mat files found in {args.raw_folder}. Run get_MCS_EMG.sh first.")
+    completed = set() if args.overwrite else get_completed_sources(output_folder)
+    jobs = [(file_path, args) for file_path in files if file_path not in completed]
+    print(f"Processing {len(jobs)} of {len(files)} MCS_EMG participants into {output_folder} ({len(files) - len(jobs)} already complete)")
+
+    with multiprocessing.Pool(max(1, min(args.workers, len(jobs)))) as pool:
+        for participant_id in tqdm(pool.imap_unordered(process_participant_star, jobs), total=len(jobs), desc="Participants"):
+            print(f"Data for participant {participant_id} and all gestures saved in {output_folder}p{participant_id}/.")
+
+    with open(os.path.join(output_folder, COMPLETE_MARKER), 'w') as marker:
+        marker.write(f"{len(files)} participants\n")
+
+if __name__ == "__main__":
+    main()
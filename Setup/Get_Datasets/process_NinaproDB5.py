@@ -1,114 +1,86 @@
-# %%
-# extract original and restimulus data from ./NinaproDB5/sX/sX_e2_A1.mat
+#!/usr/bin/env python
+"""
+Extracts the emg and restimulus data of ./NinaproDB5/sX/SX_EY_A1.mat into DatasetsProcessed_hdf5/NinaproDB5/sX/ as
+emgSX_EY.hdf5 and restimulusSX_EY.hdf5 (pandas DataFrames stored under key 'df'), read by utils_NinaproDB5.
+
+Subjects are converted in parallel worker processes. Each file is written under a temporary name and renamed once complete, and a
+subject is marked done only after all of its files are in place, so an interrupted run resumes from the subjects it did not finish.
+"""
+
+import argparse
+import multiprocessing
+import os
+
 import pandas as pd
-#from sklearn import preprocessing, model_selection
-#from scipy.signal import butter,filtfilt,iirnotch,hilbert
-#from PyEMD import EMD
-#import wandb
 import scipy.io as sio
 from tqdm import tqdm
-import os
-import argparse
 
-# %%
-# import ./NinaproDB5/sX/sX_e2_A1.mat for X from 1 to 10
-# extract original data and restimulus data
+num_subjects = 10
 
-# original data: emg, goniometer, acc, force
-# restimulus data: restimulus, restimulus_pos, restimulus_vel, restimulus_acc
+# Written in a subject folder once all of its files are complete, and in the dataset folder once every subject is
+COMPLETE_MARKER = '.complete'
 
-# TODO: turn into python script rather than keeping as python notebook
-# TODO: add optional arguments for which exercises to load, and other parrameters as needed
+def create_argparse():
+    parser = argparse.ArgumentParser(description="Extract the NinaproDB5 emg and restimulus data into per subject HDF5 files")
+    parser.add_argument('--exercises', type=int, nargs="+", help='List the exercises of the 3 to load. The most popular for benchmarking seem to be 2 and 3. Can format as \'--exercises 2 3\'. Defaults to 1 2 3.', default=[1, 2, 3])
+    parser.add_argument('--raw_folder', type=str, help='Folder holding the downloaded sX folders. Defaults to ./NinaproDB5.', default='./NinaproDB5')
+    parser.add_argument('--output_folder', type=str, help='Folder the sX output folders are written to. Defaults to DatasetsProcessed_hdf5/NinaproDB5.', default='DatasetsProcessed_hdf5/NinaproDB5')
+    parser.add_argument('--workers', type=int, help='Number of subjects converted in parallel. Defaults to the number of CPUs.', default=multiprocessing.cpu_count())
+    parser.add_argument('--compression_level', type=int, choices=range(10), help='zlib compression level of the written DataFrames (0 disables compression). The files are always read whole, so compression only trades load time for disk space. Defaults to 0.', default=0)
+    parser.add_argument('--overwrite', action='store_true', help='Reprocess subjects that are already marked complete.')
+    return parser.parse_args()
 
-# Add optional arguments for which exercises to load
-# Create the parser
-# parser = argparse.ArgumentParser(description="Include arguments for loading different data files")
+def write_atomically(df, filename, compression_level):
+    """Writes df to filename under a temporary name and moves it into place once it is closed."""
 
-# Add argument for exercises to load
-# parser.add_argument('--exercises', type=int, nargs="+", help='List the exercises of the 3 to load. The most popular for benchmarking seem to be 2 and 3. Can format as \'--exercises 2 3\'', default=2)
+    tmp_filename = filename + '.tmp'
+    df.to_hdf(tmp_filename, key='df', mode='w', complevel=compression_level)
+    os.replace(tmp_filename, filename)
 
-# args = parser.parse_args()
+def process_subject(subject, args):
+    """Writes the emg and restimulus files of every exercise of one subject (numbered from 1). Returns the subject."""
 
-# manually assgn args.exercises to a list of exercises to load for now to test python notebook
-class args():
-    exercises = [1,2,3]
+    foldername = os.path.join(args.output_folder, f's{subject}')
+    os.makedirs(foldername, exist_ok=True)
+    marker_path = os.path.join(foldername, COMPLETE_MARKER)
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
 
-# TODO: rechunk this so it's not just one big function. I just wasn't sure which ones
-def get():
-    data = {}
-    emg_microvolts = {}
-    emg_class = {}
+    for exercise in args.exercises:
+        mat_data = sio.loadmat(os.path.join(args.raw_folder, f's{subject}', f'S{subject}_E{exercise}_A1.mat'))
+        write_atomically(pd.DataFrame(mat_data['restimulus']), os.path.join(foldername, f'restimulusS{subject}_E{exercise}.hdf5'), args.compression_level)
+        write_atomically(pd.DataFrame(mat_data['emg']), os.path.join(foldername, f'emgS{subject}_E{exercise}.hdf5'), args.compression_level)
 
-    for subject in range(1,11):
-        for exercise in args.exercises:
-            # Load the .mat file
-            data[exercise] = sio.loadmat(f'./NinaproDB5/s{subject}/S{subject}_E' + str(exercise) + '_A1.mat')
+    with open(marker_path, 'w') as marker:
+        marker.write(' '.join(map(str, args.exercises)))
 
+    return subject
 
-            # Access specific variables from the loaded data
-            emg_microvolts[exercise] = data[exercise]['emg']
-            emg_class[exercise] = data[exercise]['restimulus']
+def is_complete(subject, args):
+    """Whether subject is marked complete for (at least) the requested exercises."""
 
+    marker_path = os.path.join(args.output_folder, f's{subject}', COMPLETE_MARKER)
+    if not os.path.exists(marker_path):
+        return False
+    with open(marker_path) as marker:
+        return set(args.exercises) <= set(map(int, marker.read().split()))
 
-    # %%
-    for exercise in args.exercises:
-        print("Exercise " + str(exercise))
-        print("Shape of emg_microvolts:", emg_microvolts[exercise].shape)
-        print("Shape of emg_class:", emg_class[exercise].shape)
-        print("Number of gestures:", max(emg_class[exercise])[0])
-        
-    print("Remember that the rest gesture includes another gesture")
-
-    # %%
-    # mat to tensor
-    wLen = 250 # Hz
-    def getEMG (subject: int, exercise: int):
-        sub = str(subject+1)
-        mat_data = sio.loadmat('./NinaproDB5/s' + sub + '/S' + sub + '_E' + str(exercise) + '_A1.mat')
-        mat_array = mat_data['emg']
-        return mat_array
-
-    def getRestimulus (subject: int, exercise: int):
-        sub = str(subject+1)
-        mat_data = sio.loadmat('./NinaproDB5/s' + sub + '/S' + sub + '_E' + str(exercise) + '_A1.mat')
-        mat_array = mat_data['restimulus']
-        return mat_array
-
-    # %%
-    for i in tqdm(range(0, 10), desc='subject'):
-        foldername = 'DatasetsProcessed_hdf5/NinaproDB5/s' + str(i+1) + '/'
-        if not os.path.exists(foldername):
-            os.makedirs(foldername)
-        for j in tqdm(args.exercises, desc='exercise'):
-            restimulus_file_path = foldername + 'restimulusS' + str(i+1) + '_E' + str(j) + '.hdf5'
-            emg_file_path = foldername + '/emgS' + str(i+1) + '_E' + str(j) + '.hdf5'
-            
-            restimulus_data = getRestimulus(i, j)
-            emg_data = getEMG(i, j)
-            
-            restimulus_df = pd.DataFrame(restimulus_data)
-            emg_df = pd.DataFrame(emg_data)
-            
-            # restimulus_df.to_csv(restimulus_file_path, index=False)
-            # emg_df.to_csv(emg_file_path, index=False)
-            # save as hdf5 files
-            restimulus_df.to_hdf(restimulus_file_path, key='df', mode='w')
-            emg_df.to_hdf(emg_file_path, key='df', mode='w')
-        # restimulus_file_path = foldername + 'restimulusS' + str(i+1) + '_E2.hdf5'
-        # emg_file_path = foldername + '/emgS' + str(i+1) + '_E2.hdf5'
-        
-        # restimulus_data = getRestimulus(i)
-        # emg_data = getEMG(i)
-        
-        # restimulus_df = pd.DataFrame(restimulus_data)
-        # emg_df = pd.DataFrame(emg_data)
-        
-        # # restimulus_df.to_csv(restimulus_file_path, index=False)
-        # # emg_df.to_csv(emg_file_path, index=False)
-        # # save as hdf5 files
-        # restimulus_df.to_hdf(restimulus_file_path, key='df', mode='w')
-        # emg_df.to_hdf(emg_file_path, key='df', mode='w')
+def process_subject_star(job):
+    return process_subject(*job)
+
+def main():
+    args = create_argparse()
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    jobs = [(subject, args) for subject in range(1, num_subjects + 1) if args.overwrite or not is_complete(subject, args)]
+    print(f"Processing {len(jobs)} of {num_subjects} NinaproDB5 subjects into {args.output_folder} ({num_subjects - len(jobs)} already complete)")
+
+    with multiprocessing.Pool(max(1, min(args.workers, len(jobs)))) as pool:
+        for _ in tqdm(pool.imap_unordered(process_subject_star, jobs), total=len(jobs), desc='subject'):
+            pass
 
+    with open(os.path.join(args.output_folder, COMPLETE_MARKER), 'w') as marker:
+        marker.write(' '.join(map(str, args.exercises)))
 
 if __name__ == "__main__":
-    get()
\ No newline at end of file
+    main()
@@ -61,6 +61,8 @@ class Setup():
         # Arguments for run_CNN_EMG/using config files
         parser.add_argument('--config', type=str, help="Path to the config file.")
         parser.add_argument('--table', type=str, help="Specify which table to replicate. (Ex: 1, 2, 3, 3_intersession)")
+        parser.add_argument('--table_workers', type=int, help="Number of table runs (subject folds and lines) to train in parallel worker processes. Set to 1 (sequential) by default.", default=1)
+        parser.add_argument('--table_threads_per_job', type=int, help="CPU cores/threads given to each parallel table run. Set to 0 (cores divided evenly between workers) by default.", default=0)
 
         
         parser.add_argument("--include_transitions", type=utils.str2bool, help="Whether or not to include transitions windows and label them as the final gesture. Set to False by default.", default=False)
@@ -70,14 +72,20 @@ class Setup():
 
         # Add argument for doing domain generalization algorithm
         parser.add_argument('--domain_generalization', type=str, help='domain generalization algorithm to use (e.g. \'IRM\',\'CORAL\'.', default=False)
+        # Add argument for the covariance compared by CORAL
+        parser.add_argument('--coral_feature_covariance', type=utils.str2bool, help='whether or not CORAL compares the (feature x feature) covariance of each domain, computed for all domain pairs at once, instead of the (sample x sample) covariance of the transposed features the CORAL results were tuned with. The penalty is not re-weighted for it. The default loss is only computed for all pairs at once when every domain has the same number of samples in the batch; otherwise it is still one (cheaper) computation per domain pair. Set to False by default.', default=False)
 
         parser.add_argument('--dataset', help='dataset to test. Set to MCS_EMG by default', default="MCS_EMG")
         # Add argument for doing leave-one-subject-out
         parser.add_argument('--leave_one_subject_out', type=utils.str2bool, help='whether or not to do leave one subject out. Set to False by default.', default=False)
         # Add argument for leftout subject (indexed from 1)
         parser.add_argument('--leftout_subject', type=int, help='number of subject that is left out for cross validation, starting from subject 1', default=0)
+        # Add argument for running every leave-one-subject-out fold in one process
+        parser.add_argument('--all_folds', type=utils.str2bool, help='whether or not to run every leave-one-subject-out fold (each subject left out in turn) in one process, loading the dataset only once. Set to False by default.', default=False)
         # Add parser for seed
         parser.add_argument('--seed', type=int, help='seed for reproducibility. Set to 0 by default.', default=0)
+        # Add argument for training several seeds of a small model side by side on the same data
+        parser.add_argument('--num_seeds', type=int, help='number of independently initialized copies (seeds seed, seed+1, ...) of the MLP or of the CNN head (with --freeze_backbone) to train side by side in one run. Set to 1 by default.', default=1)
         # Add number of epochs to train for
         parser.add_argument('--epochs', type=int, help='number of epochs to train for. Set to 25 by default.', default=25)
         # Add argument for whether or not to use RMS
@@ -106,6 +114,8 @@ class Setup():
         parser.add_argument('--save_images', type=utils.str2bool, help='whether or not to save images. Set to False by default.', default=False)
         # Add argument to turn off scaler normalization
         parser.add_argument('--turn_off_scaler_normalization', type=utils.str2bool, help='whether or not to turn off scaler normalization. Set to False by default.', default=False)
+        # Add argument to filter causally, as a stream can be
+        parser.add_argument('--causal_filter', type=utils.str2bool, help='whether or not to filter each recording once with a causal filter (sosfilt) before windowing instead of each window with a zero-phase filter (filtfilt), so that training windows match the ones filtered while streaming. Set to False by default.', default=False)
         # Add argument to change learning rate
         parser.add_argument('--learning_rate', type=float, help='learning rate. Set to 1e-4 by default.', default=1e-4)
         # Add argument to specify which gpu to use (if any gpu exists)
@@ -140,11 +150,27 @@ class Setup():
         parser.add_argument('--proportion_unlabeled_data_from_leftout_subject', type=float, help='proportion of data from left-out-subject to keep as unlabeled data. Set to 0.75 by default.', default=0.75) # TODO: fix, we note that this affects leave-one-session-out even when fully supervised
         # Add argument to specify batch size
         parser.add_argument('--batch_size', type=int, help='batch size. Set to 64 by default.', default=64)
+        # Add argument to specify batch size for inference after training (confusion matrices)
+        parser.add_argument('--eval_batch_size', type=int, help='batch size for no-grad inference after training. Set to 512 by default.', default=512)
+        # Add argument to split each training batch into micro-batches with gradient accumulation
+        parser.add_argument('--micro_batch_size', type=int, help='max number of samples per forward/backward pass; each batch of batch_size is accumulated over micro-batches before one optimizer step (0 disables). Set to 0 by default.', default=0)
         # Add argument for whether to use unlabeled data for subjects used for training as well
         parser.add_argument('--proportion_unlabeled_data_from_training_subjects', type=float, help='proportion of data from training subjects to use as unlabeled data. Set to 0.0 by default.', default=0.0)
         # Add argument for cutting down amount of total data for training subjects
         parser.add_argument('--proportion_data_from_training_subjects', type=float, help='proportion of data from training subjects to use. Set to 1.0 by default.', default=1.0)
         parser.add_argument('--target_normalize_subject', type=int, help='number of subject that is left out for target normalization, starting from subject 1', default=0)
+        # Add argument for how often training metrics are updated
+        parser.add_argument('--train_metrics', type=str, choices=['full', 'every_k', 'epoch', 'off'], help='training metric policy: update on every batch (full), on every k-th batch (every_k), once per epoch from cached outputs (epoch) or not at all (off). Set to "full" by default.', default='full')
+        parser.add_argument('--train_metrics_every_k', type=int, help='batch interval for the every_k training metric policy. Set to 10 by default.', default=10)
+        # Add argument to train only the head of CNN models on cached features of a frozen backbone
+        parser.add_argument('--freeze_backbone', type=utils.str2bool, help='whether or not to freeze a backbone prefix of the CNN model, cache its features to disk once and train only the remaining layers on them. Set to False by default.', default=False)
+        parser.add_argument('--frozen_backbone_children', type=int, help='number of top level child modules of the model that make up the frozen backbone. Set to -1 (all but the last) by default.', default=-1)
+        # Add argument to report time spent in each training metric
+        parser.add_argument('--profile_train_metrics', type=utils.str2bool, help='whether or not to print the time spent updating and computing each training metric every epoch. Set to False by default.', default=False)
+        parser.add_argument('--profile_startup', type=utils.str2bool, help='whether or not to print the time spent importing modules and setting up the run before training. Set to False by default.', default=False)
+        # Add argument to periodically checkpoint training and resume from the last checkpoint of the same run
+        parser.add_argument('--checkpoint_every', type=int, help='save a checkpoint (model, optimizer, RNG states, epoch) every this many epochs and resume from it when a run with the same wandb run name and training arguments is restarted (0 disables). Set to 0 by default.', default=0)
+        parser.add_argument('--checkpoint_dir', type=str, help='directory for training checkpoints. Set to checkpoints by default.', default='checkpoints')
 
         args = parser.parse_args()
         self.args = args
@@ -164,11 +190,11 @@ class Setup():
 
         def process_dataset(dataset, params=''):
             """
-            Downloads dataset in the root rather than in Setup directory.
+            Processes dataset in the root rather than in Setup directory. The processing scripts skip participants they already completed, so an interrupted run resumes where it stopped.
             """
             setup_dir = os.path.dirname(__file__)
             script_path = os.path.abspath(os.path.join(setup_dir, f"Get_Datasets/{dataset}.py"))
-            subprocess.run(['python', script_path, params])
+            subprocess.run(['python', script_path, *params.split()], check=True)
 
         """ Conducts safety checks on the self.args, downloads needed datasets, and imports the correct self.utils file. """
         
@@ -219,7 +245,7 @@ class Setup():
                 get_dataset("get_NinaproDB5")
                 process_dataset("process_NinaproDB5")
 
-            if (not os.path.exists("./DatasetsProcessed_hdf5/NinaproDB5/")):
+            if (not os.path.exists("./DatasetsProcessed_hdf5/NinaproDB5/.complete")):
                 print("NinaproDB5 dataset not yet processed. Processing now")
                 process_dataset("process_NinaproDB5")
 
@@ -307,7 +333,7 @@ class Setup():
                 get_dataset("get_MCS_EMG")
 
             if self.args.transition_classifier:
-                if (not os.path.exists("./DatasetsProcessed_hdf5/MCS_EMG_transition_classifer/")):
+                if (not os.path.exists("./DatasetsProcessed_hdf5/MCS_EMG_transition_classifier/.complete")):
                     print("MCS dataset not yet processed. Processing now")
                     process_dataset("process_MCS", "--transition_classifier=True")
 
@@ -316,7 +342,7 @@ class Setup():
                 utils.transition_classifier = True
 
             elif self.args.include_transitions: 
-                if (not os.path.exists("./DatasetsProcessed_hdf5/MCS_EMG_include_transitions/")):
+                if (not os.path.exists("./DatasetsProcessed_hdf5/MCS_EMG_include_transitions/.complete")):
                     print("MCS dataset not yet processed for include transitions. Processing now")
                     process_dataset("process_MCS", "--include_transitions=True")
 
@@ -324,7 +350,7 @@ class Setup():
                 utils.transition_classifier = self.args.transition_classifier
 
             else: 
-                if (not os.path.exists("./DatasetsProcessed_hdf5/MCS_EMG/")):
+                if (not os.path.exists("./DatasetsProcessed_hdf5/MCS_EMG/.complete")):
                     print("MCS dataset not yet processed. Processing now")
                     process_dataset("process_MCS", "--include_transitions=False")      
                 utils.include_transitions = False      
@@ -352,6 +378,12 @@ class Setup():
                 raise ValueError("Dataset not recognized. Please choose from 'uciemg', 'ninapro-db2', 'ninapro-db5', 'myoarmbanddataset', 'hyser'," + "'capgmyo', 'flexwear-hd', 'sci', or 'mcs'")
             
         # Safety Checks
+        if self.args.causal_filter:
+            assert hasattr(utils, 'filter_mode'), f"Causal filtering is not implemented for {self.args.dataset}."
+        if hasattr(utils, 'filter_mode'):
+            # set every run, since the module (and a previous run's filter_mode) is shared by the runs of one process
+            utils.filter_mode = 'causal' if self.args.causal_filter else 'zero_phase'
+
         if self.args.turn_off_scaler_normalization:
             assert self.args.target_normalize == 0.0, "Cannot turn off scaler normalization and turn on target normalize at the same time"
 
@@ -375,6 +407,11 @@ class Setup():
 
             assert self.args.model in {"MLP", "resnet18"}, "Domain generalization can only be used with MLP or resnet18 currently."
 
+        if self.args.num_seeds > 1:
+            assert self.args.model == "MLP" or self.args.freeze_backbone, "Multiple seeds are only trained side by side for MLP or for CNN heads with --freeze_backbone."
+            assert self.args.domain_generalization not in {"IRM", "CORAL"} and not self.args.turn_on_unlabeled_domain_adaptation, "Multiple seeds cannot be used with domain generalization or unlabeled domain adaptation currently."
+            assert not self.args.pretrain_and_finetune, "Multiple seeds cannot be used with pretrain and finetune currently."
+
 
         # Set Final Values
         # Add date and time to filename
@@ -1,8 +1,6 @@
 import numpy as np
 import struct
 import datetime
-from numpy import distutils
-import mne
 
 # from Poly5_Reader_MNE by Rudnik-Ilia
 # Helper for utils_UCI
@@ -94,9 +92,8 @@ class Poly5Reader:
     def _readSignalBlock(self, f, buffer_size, myfmt):
         f.read(86)
         sampleData = f.read(buffer_size * 4)
-        DataBlock = struct.unpack(myfmt, sampleData)
-        SignalBlock = np.asarray(DataBlock)
-        return SignalBlock
+        # little-endian float32 samples, as struct.unpack(myfmt) read them
+        return np.frombuffer(sampleData, dtype='<f4', count=buffer_size)
 
     def close(self):
         self.file_obj.close()
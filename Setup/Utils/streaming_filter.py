@@ -0,0 +1,48 @@
+"""
+Causal filtering shared by the utils_* modules (when filter_mode is 'causal') and streaming consumers (Model.Streaming_Inference).
+
+The utils_* modules that support --causal_filter have a filter_mode, set by Setup.py: 'zero_phase' filters each window with filtfilt (filter()),
+'causal' filters each recording once with the sections of their filter_sos() before windowing (causal_filter()) and 'none' leaves the EMG
+unfiltered (ex: to filter it while streaming).
+
+filter() in the utils_* modules runs filtfilt, which is zero-phase but needs the whole signal, so it is applied to each (overlapping) window
+separately and can not run on a live stream. Causal_Filter runs the same filter forwards only with sosfilt and carries its state across calls,
+so a recording is filtered once before windowing and a stream filtered chunk by chunk gives the same samples as the whole recording filtered at once.
+"""
+import numpy as np
+import torch
+from scipy.signal import sosfilt, sosfilt_zi, tf2sos
+
+
+def to_sos(*filters):
+    """Concatenates the second order sections of filters given as (b, a) or sos arrays into one cascade."""
+
+    return np.concatenate([np.asarray(f) if isinstance(f, np.ndarray) else tf2sos(*f) for f in filters], axis=0)
+
+class Causal_Filter():
+    """
+    Filters signals (..., TIME) along time with the sections sos, carrying the filter state (zi) from one call to the next.
+
+    The state starts in steady state for the first sample of each signal, so a DC offset does not ring at the start.
+    """
+
+    def __init__(self, sos):
+        self.sos = sos
+        self.zi = None
+
+    def reset(self):
+        self.zi = None
+
+    def __call__(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        if self.zi is None:
+            # (SECTION, ..., 2)
+            self.zi = sosfilt_zi(self.sos).reshape(len(self.sos), *([1] * (data.ndim - 1)), 2) * data[np.newaxis, ..., :1]
+        filtered, self.zi = sosfilt(self.sos, data, axis=-1, zi=self.zi)
+        return filtered
+
+def causal_filter(emg, sos, mode):
+    """Filters whole recordings [..., # timesteps] once with the sections sos run forwards only, or leaves them unfiltered if mode is 'none'."""
+    if mode == 'none':
+        return torch.as_tensor(emg)
+    return torch.from_numpy(Causal_Filter(sos)(emg))
@@ -12,14 +12,12 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from scipy.signal import spectrogram, stft
-import pywt
 from tqdm.contrib.concurrent import process_map  # Use process_map from tqdm.contrib
 from tqdm import tqdm
-import fcwt
-import emd
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 numGestures = 8
 fs = 1000 #Hz
@@ -114,46 +112,48 @@ def fft_plot(signal):
     plt.grid(True)
     plt.show()
 
-def getData (subject, gesture, trial): 
-
-    if (isinstance(subject, int)):  
-        sub = str(subject)
-        if subject < 10:
-            sub = '0' + sub
-    else:
-        sub = str(subject[0])
-        if subject[0] < 10:
-            sub = '0' + sub
-        target_min = subject[1]
-        target_max = subject[2]
-        leftout = subject[3]
-
-    name = '0' + sub + '-00' + str(gesture) + '-00' +str(trial)
-    if trial == 10:
-        name = '0' + sub + '-00' + str(gesture) + '-010'
-    mat_data = io.loadmat('./CapgMyo_B/dbb-preprocessed-0' + sub + '/' + name + '.mat')
-    # [# timesteps, # channels]
-    mat_array = mat_data['data']
-
-    if (not isinstance(subject, int) and leftout != subject[0]):
-        mat_array = target_normalize(mat_array, target_min, target_max, gesture - 1)
-
-    # stacks data per gesture for all trials
-    tensor_data = torch.from_numpy(mat_array)
-    if trial < 10:
-        return torch.cat((window(tensor_data), getData(subject, gesture, trial + 1)), dim=0)
-    elif gesture < 8:
-        return torch.cat((window(tensor_data), getData(subject, gesture + 1, 1)), dim=0)
+def trialPaths (data_index):
+    """Paths of the .mat files of every trial of a session index, ordered by gesture then trial."""
+    sub = f'{data_index:02d}'
+    return [f'./CapgMyo_B/dbb-preprocessed-0{sub}/0{sub}-{gesture:03d}-{trial:03d}.mat' for gesture in range(1, numGestures + 1) for trial in range(1, 11)]
+
+def loadTrials (data_index):
+    """Loads every trial of a session index with a thread pool. Returns a list of [# timesteps, # channels] arrays, ordered by gesture then trial."""
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        return list(executor.map(lambda path: io.loadmat(path)['data'], trialPaths(data_index)))
+
+@lru_cache(maxsize=None)
+def getWindowCounts (data_index):
+    """Number of windows of each gesture of a session index, from the trial shapes only (io.whosmat does not read the data)."""
+    def num_timesteps(path):
+        return dict((name, shape) for name, shape, _ in io.whosmat(path))['data'][0]
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        lengths = np.array(list(executor.map(num_timesteps, trialPaths(data_index)))).reshape(numGestures, 10)
+    return np.maximum(0, (lengths - wLenTimesteps) // stepLen + 1).sum(axis=1)
+
+def getData (subject):
+    """Returns the windows of every trial of a session index, ordered by gesture then trial, as (WINDOW, CHANNEL, TIME STEP).
+
+    subject is the session index, or (session index, target_min, target_max, leftout) to target normalize it.
+    """
+    if (isinstance(subject, int)):
+        data_index = subject
     else:
-        return window(tensor_data)
+        data_index, target_min, target_max, leftout = subject
+
+    trials = loadTrials(data_index)
+    if (not isinstance(subject, int) and leftout != data_index):
+        trials = [target_normalize(trial, target_min, target_max, i // 10) for i, trial in enumerate(trials)]
+
+    # windows each trial separately, so no window spans two trials
+    return torch.cat([window(torch.from_numpy(trial)) for trial in trials], dim=0)
 
 def getEMG (x, session_number=1):
-    #return torch.cat((getData(x-1,1,1), getData(x,1,1)), dim=0)
     subject_number = x[0] if isinstance(x, tuple) else x
     data_index = participants_first_session_index[subject_number-1] if session_number == 1 else participants_second_session_index[subject_number-1]
     if isinstance(x, tuple):
-        return filter(getData((data_index, x[1], x[2], x[3]), 1, 1))
-    return filter(getData(data_index, 1, 1))
+        return filter(getData((data_index, x[1], x[2], x[3])))
+    return filter(getData(data_index))
 
 def getEMG_separateSessions(args):
     if (len(args) == 2):
@@ -165,9 +165,9 @@ def getEMG_separateSessions(args):
         subject_number, session_number, mins, maxes, leftout = args
     data_index = participants_first_session_index[subject_number-1] if session_number == 1 else participants_second_session_index[subject_number-1]
     if (len(args) == 2):
-        return filter(getData(data_index, 1, 1))
+        return filter(getData(data_index))
     else:
-        return filter(getData((data_index, mins, maxes, leftout), 1, 1))
+        return filter(getData((data_index, mins, maxes, leftout)))
 
 def getExtrema (n, proportion, lastSessionOnly=False):
     """Returns the min/max EMG values for each electrode per gesture over a proportion of the windows of data. 
@@ -182,7 +182,6 @@ def getExtrema (n, proportion, lastSessionOnly=False):
     Returns:
         mins, maxes: mins[electrode][gesture] is min value of electrode for gesture across proportion of windows
     """
-
     mins = np.zeros((numElectrodes, numGestures))
     maxes = np.zeros((numElectrodes, numGestures))
 
@@ -190,55 +189,26 @@ def getExtrema (n, proportion, lastSessionOnly=False):
         n = participants_second_session_index[n-1]
     else:
         n = participants_first_session_index[n-1]
-    
-    sub = str(n)
-    if (n < 10):
-        sub = '0' + sub
 
+    trials = loadTrials(n)
     for i in range(numGestures):
-        data = []
-
-        for trial in range(10):
-            name = '0' + sub + '-00' + str(i+1) + '-00' +str(trial+1)
-            if trial == 9:
-                name = '0' + sub + '-00' + str(i+1) + '-010'
-            mat_data = io.loadmat('./CapgMyo_B/dbb-preprocessed-0' + sub + '/' + name + '.mat')
-            # data.append(mat_data['data'].transpose()) 
-
-            data.append(mat_data['data']) # (TRIAL, TIME STEP, CHANNEL)
-
-        tensor_data = torch.from_numpy(np.concatenate(data, axis=0)) # 
-        # (TIME STEP, CHANNEL)
+        tensor_data = torch.from_numpy(np.concatenate(trials[i * 10:(i + 1) * 10], axis=0)) # (TIME STEP, CHANNEL)
         windowed_data = window(tensor_data) # (WINDOW, CHANNEL, TIME STEP)
+
         num_windows = np.round(len(windowed_data) * proportion).astype(int)
         selected_windows = windowed_data[:num_windows]
 
-        for j in range(numElectrodes):
-            mins[j][i] = torch.min(selected_windows[:, j, :])
-            maxes[j][i] = torch.max(selected_windows[:, j, :])
-            
+        mins[:, i] = torch.amin(selected_windows, dim=(0, 2)).numpy()
+        maxes[:, i] = torch.amax(selected_windows, dim=(0, 2)).numpy()
     return mins, maxes
 
-
 def getLabels (n):
-    emg_len = len(getEMG(n))
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(emg_len, 8))
-    for x in range (8):
-        for y in range (int(emg_len / 8)):
-            labels[int(x * (emg_len / 8) + y)][x] = 1.0
-    return labels
+    return getLabels_separateSessions((n, 1))
 
 def getLabels_separateSessions(args):
     subject_number, session_number = args
     data_index = participants_first_session_index[subject_number-1] if session_number == 1 else participants_second_session_index[subject_number-1]
-    emg_len = len(getData(data_index, 1, 1))
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(emg_len, 8))
-    for x in range (8):
-        for y in range (int(emg_len / 8)):
-            labels[int(x * (emg_len / 8) + y)][x] = 1.0
-    return labels
+    return torch.repeat_interleave(torch.eye(numGestures), torch.from_numpy(getWindowCounts(data_index)), dim=0)
 
 def closest_factors(num):
     # Find factors of the number
@@ -248,6 +218,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -366,6 +337,7 @@ def optimized_makeOneSpectrogramImage(data, length, width, resize_length_factor,
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data # (wLenTimesteps * numElectrodes)
     max_imfs = 6
 
@@ -646,6 +618,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
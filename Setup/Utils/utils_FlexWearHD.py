@@ -4,6 +4,7 @@ import pandas as pd
 import random
 import h5py
 from scipy.signal import butter, filtfilt, iirnotch
+from Setup.Utils.streaming_filter import causal_filter
 import torchvision.transforms as transforms
 import multiprocessing
 from torch.utils.data import DataLoader, Dataset
@@ -12,21 +13,19 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from scipy.signal import spectrogram, stft
-import pywt
 from tqdm.contrib.concurrent import process_map  # Use process_map from tqdm.contrib
 import glob
 from tqdm import tqdm
-import fcwt
-import emd
+from concurrent.futures import ThreadPoolExecutor
 
 numGestures = 10
 fs = 4000 #Hz
 wLen = 250 # ms
 wLenTimesteps = int(wLen / 1000 * fs)
 stepLen = int(50.0 / 1000.0 * fs) #50 ms
+filter_mode = 'zero_phase' # 'zero_phase', 'causal' or 'none', see Setup.Utils.streaming_filter. Set in Setup.py.
 numElectrodes = 64
 num_subjects = 13
 cmap = mpl.colormaps['viridis']
@@ -67,10 +66,6 @@ def seed_worker(worker_id):
     np.random.seed(worker_seed)
     random.seed(worker_seed)
 
-def highpassFilter (emg):
-    b, a = butter(N=1, Wn=120.0, btype='highpass', analog=False, fs=fs)
-    return torch.from_numpy(np.flip(filtfilt(b, a, emg),axis=-1).copy())
-
 # NOTE: modified version of target_normalize where data is [# channels, # timesteps]
 # target min/max is [# channels, # gestures]
 def target_normalize (data, target_min, target_max, gesture):
@@ -85,36 +80,66 @@ def target_normalize (data, target_min, target_max, gesture):
         - source_min[i])) * (target_max[i][gesture] - target_min[i][gesture]) + target_min[i][gesture]
     return data
 
-# returns array with dimensions [# samples, # channels, # timesteps]
-def getData(n, gesture, target_min=None, target_max=None, leftout=None, session_number=1):
+def filterThenUnfold (data):
+    """High-pass filters whole recordings [..., # channels, # timesteps] and unfolds them into [..., # channels, # windows, wLenTimesteps].
+
+    Filtering before unfolding filters each timestep once rather than once per overlapping window. Each window is flipped in time, as filtering each window separately used to leave them.
+    If filter_mode is not 'zero_phase', the recordings go through causal_filter() instead and windows stay in time order, as a stream filtered sample by sample produces them.
+    """
+    if filter_mode != 'zero_phase':
+        return causal_filter(data, filter_sos(), filter_mode).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
+    b, a = butter(N=1, Wn=120.0, btype='highpass', analog=False, fs=fs)
+    return torch.from_numpy(filtfilt(b, a, data).copy()).unfold(dimension=-1, size=wLenTimesteps, step=stepLen).flip(-1)
+
+def filter_sos():
+    """Second order sections of the filter in filterThenUnfold(), for causal_filter() and streaming."""
+    return butter(N=1, Wn=120.0, btype='highpass', analog=False, fs=fs, output='sos')
+
+def sessionFilename (n, session_number=1):
     session_number_mapping = {1: 'initial', 2: 'recalibration'}
-    if (n<10):
-        file = h5py.File('./FlexWear-HD/FlexWear-HD_Dataset/p00' + str(n) + f'/data_allchannels_{session_number_mapping[session_number]}.h5', 'r')
-    else:
-        file = h5py.File('./FlexWear-HD/FlexWear-HD_Dataset/p0' + str(n) + f'/data_allchannels_{session_number_mapping[session_number]}.h5', 'r')
-    # initially [# repetitions, # channels, # timesteps]
-    data = np.array(file[gesture])
-    
-    if (leftout != None and n != leftout):
-        for i in range(len(data)):
-            data[i] = target_normalize(data[i], target_min, target_max, gesture_labels.index(gesture))
+    return f'./FlexWear-HD/FlexWear-HD_Dataset/p{n:03}/data_allchannels_{session_number_mapping[session_number]}.h5'
+
+def windowsPerRepetition (timesteps):
+    """Number of windows unfold(size=wLenTimesteps, step=stepLen) makes of one repetition."""
+    return max(0, (timesteps - wLenTimesteps) // stepLen + 1)
+
+def getGestureCounts (file):
+    """Number of windows of each gesture in an open session file, from the dataset shapes only."""
+    return [file[gesture].shape[0] * windowsPerRepetition(file[gesture].shape[2]) for gesture in gesture_labels]
 
-    data = highpassFilter(torch.from_numpy(data).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)) 
+# returns array with dimensions [# samples, # channels, # timesteps] holding the windows of every gesture, in gesture_labels order
+def getData(n, target_min=None, target_max=None, leftout=None, session_number=1):
+    with h5py.File(sessionFilename(n, session_number), 'r') as file:
+        gesture_count = getGestureCounts(file)
+        emg = torch.empty((sum(gesture_count), numElectrodes, wLenTimesteps), dtype=torch.float64)
 
-    return torch.cat([data[i] for i in range(len(data))], axis=1).permute([1, 0, 2])
+        curr = 0
+        for i, gesture in enumerate(gesture_labels):
+            # initially [# repetitions, # channels, # timesteps]
+            data = file[gesture][()]
+
+            if (leftout != None and n != leftout):
+                for j in range(len(data)):
+                    data[j] = target_normalize(data[j], target_min, target_max, i)
+
+            # (REPETITION, CHANNEL, WINDOW, TIME) -> (REPETITION * WINDOW, CHANNEL, TIME)
+            emg[curr:curr + gesture_count[i]] = filterThenUnfold(data).permute([0, 2, 1, 3]).reshape(gesture_count[i], numElectrodes, wLenTimesteps)
+            curr += gesture_count[i]
+    return emg
+
+def getOnlineFileData(file_path):
+    with h5py.File(file_path, 'r') as file:
+        data = file['realtime_emgdata'][()] # shape: (num_channels, num_samples)
+    return filterThenUnfold(data)
 
 def getOnlineUnlabeledData(subject_number):
     subject_number = participants[subject_number-1]
     assert subject_number in participants_with_online_data, "Subject number does not have online data."
     folder_paths = glob.glob(f"./Jehan_Unlabeled_Dataset/p{subject_number:03}_online_part-*/")
-    data_all = []
-    for folder_path in folder_paths:
-        file_paths = glob.glob(f"{folder_path}/*.h5")
-        for file_path in file_paths:
-            file = h5py.File(file_path, 'r')
-            data = np.array(file['realtime_emgdata']) # shape: (num_channels, num_samples)
-            data = highpassFilter(torch.from_numpy(data).unfold(dimension=-1, size=wLenTimesteps, step=stepLen))
-            data_all.append(data)
+    file_paths = [file_path for folder_path in folder_paths for file_path in glob.glob(f"{folder_path}/*.h5")]
+    # filtfilt releases the GIL for most of its work, so threads overlap the filtering of one file with reading the next
+    with ThreadPoolExecutor(max_workers=min(len(file_paths), multiprocessing.cpu_count())) as executor:
+        data_all = list(executor.map(getOnlineFileData, file_paths))
     return torch.cat(data_all, axis=1).permute([1, 0, 2])
 
 def getEMG(args):
@@ -129,7 +154,7 @@ def getEMG(args):
         target_max = args[2]
         leftout = args[3]
 
-    return torch.cat([getData(n, name, target_min=target_min, target_max=target_max, leftout=leftout) for name in gesture_labels], axis=0)
+    return getData(n, target_min=target_min, target_max=target_max, leftout=leftout)
 
 def getEMG_separateSessions(args):
     if (len(args) == 2):
@@ -145,7 +170,7 @@ def getEMG_separateSessions(args):
         target_max = args[3]
         leftout = args[4]
         
-    return torch.cat([getData(subject_number, name, target_min=target_min, target_max=target_max, leftout=leftout, session_number=session_number) for name in gesture_labels], axis=0)
+    return getData(subject_number, target_min=target_min, target_max=target_max, leftout=leftout, session_number=session_number)
 
 def getExtrema (n, proportion, lastSessionOnly=False):
     """Returns the min max of the electrode per gesture for a proportion of its windows. 
@@ -165,81 +190,39 @@ def getExtrema (n, proportion, lastSessionOnly=False):
     maxes = np.zeros((numElectrodes, numGestures))
     n = participants[n - 1]
 
-    if lastSessionOnly:
-        if (n < 10):
-            file = h5py.File('./FlexWear-HD/FlexWear-HD_Dataset/p00' + str(n) +'/data_allchannels_recalibration.h5', 'r')
-        else:
-            file = h5py.File('./FlexWear-HD/FlexWear-HD_Dataset/p0' + str(n) +'/data_allchannels_recalibration.h5', 'r')
-    else:
-        if (n < 10):
-            file = h5py.File('./FlexWear-HD/FlexWear-HD_Dataset/p00' + str(n) +'/data_allchannels_initial.h5', 'r')
-        else:
-            file = h5py.File('./FlexWear-HD/FlexWear-HD_Dataset/p0' + str(n) +'/data_allchannels_initial.h5', 'r')
-    
-    for i in range(numGestures):
-    
-        data = np.array(file[gesture_labels[i]])
-        data = np.concatenate([data[i] for i in range(len(data))], axis=-1) # concat across trials 
-
-        data = data.transpose() # (TOTAL TIME STEPS, ELECTRODE)
+    with h5py.File(sessionFilename(n, 2 if lastSessionOnly else 1), 'r') as file:
+        for i, gesture in enumerate(gesture_labels):
+            dataset = file[gesture]
+            num_repetitions, _, timesteps = dataset.shape
 
-        windowed_data = torch.from_numpy(data).unfold(dimension=0, size=wLenTimesteps, step=stepLen) # (WINDOW, ELECTRODE, TIME STEP)
+            # The first proportion of windows of the trials concatenated in time only covers their first selected_timesteps, so only those are read
+            num_windows = int(windowsPerRepetition(num_repetitions * timesteps) * proportion)
+            selected_timesteps = (num_windows - 1) * stepLen + wLenTimesteps
+            data = np.concatenate([dataset[j, :, :min(timesteps, selected_timesteps - j * timesteps)] for j in range(ceil(selected_timesteps / timesteps))], axis=-1)
 
-        num_windows = int(len(windowed_data)* proportion)
-        selected_windows = windowed_data[:num_windows]
-
-        for j in range(numElectrodes):
-            mins[j][i] = torch.min(selected_windows[:, j, :])
-            maxes[j][i] = torch.max(selected_windows[:, j, :])
+            mins[:, i] = data.min(axis=-1)
+            maxes[:, i] = data.max(axis=-1)
     
     return mins, maxes
 
 def getGestures(n):
-    gesture_count = []
-    for gesture in gesture_labels: 
-        data = getData(n, gesture)
-        gesture_count.append(len(data))
-    return gesture_count
+    with h5py.File(sessionFilename(n), 'r') as file:
+        return getGestureCounts(file)
 
 def getLabels (n):
     n = participants[n-1]
-    gesture_count = getGestures(n)
-    emg_len = sum(gesture_count)
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(emg_len, numGestures))
-    curr = 0
-    for x in range (numGestures):
-        #labels[curr:curr+gesture_count[x]][x] = 1.0
-        for y in range(gesture_count[x]):
-            labels[curr + y][x] = 1.0
-        curr += gesture_count[x]
-    return labels
+    return torch.repeat_interleave(torch.eye(numGestures), torch.tensor(getGestures(n)), dim=0)
 
 def getGestures_separateSessions(args):
     subject_number, session_number = args
     subject_number = participants[int(subject_number)-1]
-    session_number_mapping = {1: 'initial', 2: 'recalibration'}
-    file = h5py.File(f'./FlexWear-HD/FlexWear-HD_Dataset/p{subject_number:03}/data_allchannels_{session_number_mapping[session_number]}.h5', 'r')
-    gesture_count = []
-    for gesture in gesture_labels: 
-        data = np.array(file[gesture])
-        data = torch.from_numpy(data).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
-        data = data.reshape(data.shape[0]*data.shape[2], numElectrodes, wLenTimesteps)
-        gesture_count.append(len(data))
-    return gesture_count
+    with h5py.File(sessionFilename(subject_number, session_number), 'r') as file:
+        return getGestureCounts(file)
 
 def getLabels_separateSessions(args):
     subject_number, session_number = args
     gesture_count = getGestures_separateSessions((subject_number, session_number))
-    emg_len = sum(gesture_count)
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(emg_len, numGestures))
-    curr = 0
-    for x in range (numGestures):
-        for y in range(gesture_count[x]):
-            labels[curr + y][x] = 1.0
-        curr += gesture_count[x]
-    return labels
+    return torch.repeat_interleave(torch.eye(numGestures), torch.tensor(gesture_count), dim=0)
 
 def closest_factors(num):
     # Find factors of the number
@@ -249,6 +232,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -429,6 +413,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     # Pre-allocate the array for the CWT coefficients
     number_of_frequencies = wLenTimesteps
     grid_width, grid_length = closest_factors(numElectrodes)
@@ -657,6 +642,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
@@ -11,14 +11,12 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm.contrib.concurrent import process_map  # Use process_map from tqdm.contrib
 import os
 from scipy.signal import spectrogram, stft
-import pywt
-import fcwt
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 numGestures = 10
 fs = 2048.0 # Hz 
@@ -99,6 +97,21 @@ def target_normalize (data, target_min, target_max, gesture):
         - source_min[i])) * (target_max[i][gesture] - target_min[i][gesture]) + target_min[i][gesture]
     return data
 
+def read_calibration (header_path):
+    """Parses a .hea header into per-channel gain and baseline arrays of shape [# channels, 1]."""
+    with open(header_path, 'r') as file:
+        # skip the record line; the third field of each signal line is 'gain(baseline)/units'
+        fields = [line.split(" ")[2] for line in file.readlines()[1:]]
+    gain = np.array([float(field.split("(")[0]) for field in fields], dtype=np.float32)
+    baseline = np.array([float(field.split("(")[1].split(")")[0]) for field in fields], dtype=np.float32)
+    return gain[:, None], baseline[:, None]
+
+def read_calibrated_sample (sample_path):
+    """Memory-maps the int16 payload of a dynamic_raw_sample .dat file and calibrates it to [# channels, # samples] float32 in one broadcast."""
+    gain, baseline = read_calibration(sample_path[:-len('.dat')] + '.hea')
+    raw = np.memmap(sample_path, dtype=np.int16, mode='r').reshape((numElectrodes, -1))
+    return (raw.astype(np.float32) - baseline) / gain
+
 def getEMG_help (sub, session, target_min=None, target_max=None, leftout=None, unfold=True):
     emg = []
 
@@ -113,27 +126,18 @@ def getEMG_help (sub, session, target_min=None, target_max=None, leftout=None, u
                 curr_gestures.append(gesture_nums[v])
             currFile += 1
 
+    sample_paths = []
     currFile = 1
     while (os.path.isfile(f'hyser/subject{sub}_session{session}/dynamic_raw_sample{currFile}.dat')):
-        if (currFile not in select_gestures):
-            currFile += 1
-            continue
-
-        data = np.fromfile(f'hyser/subject{sub}_session{session}/dynamic_raw_sample{currFile}.dat', dtype=np.int16).reshape((256, -1)).astype(np.float32)
-
-        adjustment = []
-        with open(f'hyser/subject{sub}_session{session}/dynamic_raw_sample{currFile}.hea', 'r') as file:
-            ignoreFirst = True
-            for line in file:
-                if (ignoreFirst):
-                    ignoreFirst = False
-                else:
-                    values = line.split(" ")[2].split("(")
-                    adjustment.append((float(values[0]), float(values[1].split(")")[0])))
+        if (currFile in select_gestures):
+            sample_paths.append(f'hyser/subject{sub}_session{session}/dynamic_raw_sample{currFile}.dat')
+        currFile += 1
 
-        for col in range(len(data)):
-            data[col] = (data[col] - adjustment[col][1]) / (adjustment[col][0])
+    # reading and calibrating release the GIL, so the files are read concurrently
+    with ThreadPoolExecutor(max_workers=max(1, min(len(sample_paths), multiprocessing.cpu_count()))) as executor:
+        samples = list(executor.map(read_calibrated_sample, sample_paths))
 
+    for data in samples:
         # converts data to form [# samples, # channels]
         data = data.transpose((1, 0))
         if (leftout != None and sub != leftout):
@@ -143,8 +147,6 @@ def getEMG_help (sub, session, target_min=None, target_max=None, leftout=None, u
             emg.append(torch.from_numpy(data).unfold(dimension=0, size=wLenTimesteps, step=stepLen))
         else:
             emg.append(torch.from_numpy(data))
-
-        currFile += 1
         
     return emg
 
@@ -349,6 +351,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -632,6 +635,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred, labels=range(numGestures))
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
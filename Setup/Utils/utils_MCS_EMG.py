@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import random
 from scipy.signal import butter, filtfilt, iirnotch
+from Setup.Utils.streaming_filter import causal_filter, to_sos
 import torchvision.transforms as transforms
 import multiprocessing
 from torch.utils.data import DataLoader, Dataset
@@ -11,15 +12,11 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import h5py
 from scipy.signal import spectrogram, stft
-import pywt
 import scipy
-import emd
-import fcwt
 
 
 
@@ -30,6 +27,7 @@ wLen = 250 # ms
 wLenTimesteps = int(wLen / 1000 * fs)
 stepLen = 250 # 250 ms increased from 50 ms to reduce data size for large dataset
 stepLen = int(stepLen / 1000 * fs)
+filter_mode = 'zero_phase' # 'zero_phase', 'causal' or 'none', see Setup.Utils.streaming_filter. Set in Setup.py.
 numElectrodes = 4
 num_subjects = 40
 normalize_for_colormap_benchmark = mpl.colors.Normalize(vmin=-60, vmax=-20)
@@ -90,6 +88,10 @@ def filter(emg):
     b, a = iirnotch(w0=50.0, Q=0.0001, fs=2000.0)
     return torch.from_numpy(np.flip(filtfilt(b, a, emgButter),axis=0).copy())
 
+def filter_sos():
+    """Second order sections of the filters in filter(), for causal_filter() and streaming."""
+    return to_sos(butter(N=3, Wn=[5.0, 500.0], btype='bandpass', analog=False, fs=2000.0, output='sos'), iirnotch(w0=50.0, Q=0.0001, fs=2000.0))
+
 # NOTE: modified version of target_normalize where data is [# channels, # timesteps]
 # target min/max is [# channels, # gestures]
 def target_normalize (data, target_min, target_max, gesture):
@@ -133,7 +135,7 @@ def getEMG (args):
             for j in range(len(data)):
                 data[j] = target_normalize(data[j], target_min, target_max, i)
 
-        data = filter(torch.from_numpy(data)).unfold(dimension=-1, size=wLenTimesteps, step=stepLen) # 
+        data = (filter(torch.from_numpy(data)) if filter_mode == 'zero_phase' else causal_filter(data, filter_sos(), filter_mode)).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
         emg.append(torch.cat([data[i] for i in range(len(data))], dim=-2).permute((1, 0, 2)).to(torch.float16)) 
     
     return torch.cat(emg, dim=0) # (Number of Gestures * 20 * Number of Seconds Per Window, Number of Electrodes, Time Steps)
@@ -239,6 +241,7 @@ def getLabels(n):
         return getLabels_gesture_classificatier(n)
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
+    import emd
     normalize_for_colormap_benchmark_hht = mpl.colors.Normalize(vmin=0, vmax=1)   
 
     emg_sample = data
@@ -309,6 +312,7 @@ def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor
     return final_image
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     normalize_for_colormap_benchmark_cwt = mpl.colors.Normalize(vmin=-50, vmax=5)
     emg_sample = data
     data = data.reshape(length, width)
@@ -684,6 +688,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
@@ -11,15 +11,11 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import h5py
 import os
 from scipy.signal import spectrogram, stft
-import pywt
-import fcwt
-import emd 
 
 numGestures = 7
 fs = 200.0 #Hz
@@ -67,10 +63,8 @@ def seed_worker(worker_id):
     random.seed(worker_seed)
 
 def contract(R):
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(len(R), numGestures))
-    for x in range(len(R)):
-        labels[x][int(R[x]) - 1] = 1.0
+    labels = torch.zeros((len(R), numGestures))
+    labels[torch.arange(len(R)), R.long() - 1] = 1.0
     return labels
 
 def filter(emg):
@@ -92,11 +86,8 @@ def format_emg (data):
     Returns:
         emg: (SAMPLES, CHANNELS)
     """
-    emg = np.zeros((len(data) // numElectrodes, numElectrodes))
-    for i in range(len(data) // numElectrodes):
-        for j in range(numElectrodes):
-            emg[i][j] = data[i * numElectrodes + j]
-    return emg
+    num_samples = len(data) // numElectrodes
+    return data[:num_samples * numElectrodes].reshape(num_samples, numElectrodes).astype(np.float64)
 
 # data is [# samples, # channels]
 # target min/max is [# channels, # gestures]
@@ -112,7 +103,23 @@ def normalize (data, target_min, target_max, gesture):
         - source_min[i])) * (target_max[i][gesture] - target_min[i][gesture]) + target_min[i][gesture]
     return data
 
-def getEMG (args):
+def recordingPath (n, i):
+    if (n < 3):
+        return f'myoarmbanddataset/Female{n-1}/Test1/classe_{i}.dat'
+    return f'myoarmbanddataset/Male{n-3}/Test1/classe_{i}.dat'
+
+def getRecordings (n):
+    """Reads every classe_{i}.dat file of subject n.
+
+    Returns:
+        recordings: recordings[repetition][gesture] is a (SAMPLES, CHANNELS) array, from which getEMG and getExtrema are derived
+    """
+    recordings = [[None] * numGestures for _ in range(4)]
+    for i in range(numGestures * 4):
+        recordings[i // numGestures][i % numGestures] = format_emg(np.fromfile(recordingPath(n, i), dtype=np.int16))
+    return recordings
+
+def getEMG (args, recordings=None):
     if (type(args) == int):
         n = args
     else:
@@ -121,20 +128,18 @@ def getEMG (args):
         target_max = args[2]
         leftout = args[3]
 
+    if recordings is None:
+        recordings = getRecordings(n)
     emg = []
     for i in range(numGestures * 4):
-        if (n < 3):
-            data = np.fromfile(f'myoarmbanddataset/Female{n-1}/Test1/classe_{i}.dat', dtype=np.int16)
-        else:
-            data = np.fromfile(f'myoarmbanddataset/Male{n-3}/Test1/classe_{i}.dat', dtype=np.int16)
-        data = format_emg(np.array(data, dtype=np.float32))
+        data = recordings[i // numGestures][i % numGestures]
         if (type(args) != int and leftout != n):
             data = normalize(data, target_min, target_max, i % numGestures)
         emg.append(torch.from_numpy(data).unfold(dimension=0, size=wLenTimesteps, step=stepLen))
     emg = filter(torch.cat(emg, dim=0))
     return emg
 
-def getExtrema (n, proportion):
+def getExtrema (n, proportion, recordings=None):
     """Returns the min/max EMG values for each electrode per gesture over a proportion of the windows of data. 
 
     Per gesture, accumulates data across each of its repetitions and windows this data. Then takes a proportion of the windows and calculates the min/max values for each electrode over these windows across all trials and time steps. 
@@ -142,52 +147,44 @@ def getExtrema (n, proportion):
     Args:
         n (int): subject number
         proportion: proportion of the windows to consider
+        recordings (optional): getRecordings(n), if already read
 
     Returns:
         mins, maxes: mins[electrode][gesture] is min value of electrode for gesture across proportion of windows
     """
     mins = np.zeros((numElectrodes, numGestures))
     maxes = np.zeros((numElectrodes, numGestures))
+    if recordings is None:
+        recordings = getRecordings(n)
 
     for i in range(numGestures):
         
-        emg = []
-
-        for j in range(4):
-            if (n < 3):
-                data = np.fromfile(f'myoarmbanddataset/Female{n-1}/Test1/classe_{i + j*numGestures}.dat', dtype=np.int16)
-            else:
-                data = np.fromfile(f'myoarmbanddataset/Male{n-3}/Test1/classe_{i + j*numGestures}.dat', dtype=np.int16)
-
-            data = format_emg(np.array(data, dtype=np.float32))
-            # windowed per repetition (needs to match the windowing in getEMG)
-            emg.append(torch.from_numpy(data).unfold(dimension=0, size=wLenTimesteps, step=stepLen)) # (REPETITION, WINDOW, ELECTRODE, TIME STEP) 
-
-
-        # concatenate across repetitions 
-        emg = torch.cat(emg, dim=0) # (WINDOW, ELECTRODE, TIME STEP)
+        # windowed per repetition (needs to match the windowing in getEMG), then concatenated across repetitions
+        emg = torch.cat([torch.from_numpy(recordings[j][i]).unfold(dimension=0, size=wLenTimesteps, step=stepLen) for j in range(4)], dim=0) # (WINDOW, ELECTRODE, TIME STEP)
 
         num_windows = np.round(len(emg)*proportion).astype(int)
         selected_windows = emg[:num_windows]
 
-        for j in range(numElectrodes):
-            mins[j][i] = torch.min(selected_windows[:, j, :])
-            maxes[j][i] = torch.max(selected_windows[:, j, :])
+        mins[:, i] = torch.amin(selected_windows, dim=(0, 2)).numpy()
+        maxes[:, i] = torch.amax(selected_windows, dim=(0, 2)).numpy()
 
     return mins, maxes
 
+def getTargetEMGAndExtrema (n, proportion):
+    """Returns getEMG(n) and getExtrema(n, proportion) of the target normalize subject n, which is not normalized itself, from one read of its recordings."""
+    recordings = getRecordings(n)
+    mins, maxes = getExtrema(n, proportion, recordings)
+    return getEMG(n, recordings), mins, maxes
+
 def getLabels (n):
-    labels = []
-    for i in range(numGestures * 4):
-        if (n < 3):
-            data = np.fromfile(f'myoarmbanddataset/Female{n-1}/Test1/classe_{i}.dat', dtype=np.int16)
-        else:
-            data = np.fromfile(f'myoarmbanddataset/Male{n-3}/Test1/classe_{i}.dat', dtype=np.int16)
-        labels.append(torch.from_numpy((i % numGestures) + np.zeros(torch.from_numpy(format_emg(np.array(data, dtype=np.float32))).unfold(dimension=0, size=wLenTimesteps, step=stepLen).shape[0])))
-    labels = contract(torch.cat(labels, dim=0))
+    # number of windows unfold makes of each recording, in getEMG order, from the file sizes (int16 samples of numElectrodes channels) without reading them
+    windows_per_recording = [max(0, (os.path.getsize(recordingPath(n, i)) // (2 * numElectrodes) - wLenTimesteps) // stepLen + 1) for i in range(numGestures * 4)]
+    gestures = torch.arange(numGestures * 4) % numGestures
+    labels = contract(torch.repeat_interleave(gestures, torch.tensor(windows_per_recording)))
     return labels
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     emg_sample = data
     data = data.reshape(length, width)
     # Convert EMG sample to numpy array for CWT computation
@@ -248,6 +245,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -458,6 +456,7 @@ def optimized_makeOneImage(data, cmap, length, width, resize_length_factor, nati
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -660,6 +659,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(i, data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -738,6 +738,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
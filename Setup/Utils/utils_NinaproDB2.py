@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import random
 from scipy.signal import butter, filtfilt, iirnotch
+from Setup.Utils.streaming_filter import causal_filter
 import torchvision.transforms as transforms
 import multiprocessing
 from torch.utils.data import DataLoader, Dataset
@@ -11,20 +12,18 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from scipy import io
 from tqdm.contrib.concurrent import process_map  # Use process_map from tqdm.contrib
 from scipy.signal import spectrogram, stft
-import fcwt
-import emd
 
 fs = 2000 #Hz
 wLen = 250 # ms
 wLenTimesteps = int(wLen / 1000 * fs)
 stepLen = 250 # 250 ms increased from 50 ms in order to decrease compute time for large dataset
 stepLen = int(stepLen / 1000 * fs)
+filter_mode = 'zero_phase' # 'zero_phase', 'causal' or 'none', see Setup.Utils.streaming_filter. Set in Setup.py.
 numElectrodes = 12
 num_subjects = 40
 cmap = mpl.colormaps['viridis']
@@ -307,6 +306,10 @@ def filter(emg):
     b, a = butter(N=1, Wn=999.0, btype='lowpass', analog=False, fs=2000.0)
     return torch.from_numpy(np.flip(filtfilt(b, a, emg),axis=0).copy())
 
+def filter_sos():
+    """Second order sections of the filter in filter(), for causal_filter() and streaming."""
+    return butter(N=1, Wn=999.0, btype='lowpass', analog=False, fs=2000.0, output='sos')
+
 def getRestim (n: int, exercise: int, unfold=True):
     """
     Returns a restiumulus (label) tensor for participant n and exercise exercise and if unfold, unfolded across time. 
@@ -381,15 +384,19 @@ def getEMG (input):
     if (is_target_normalize and n != leftout):
         emg = target_normalize(emg, target_min, target_max, np.array(getRestim(n, exercise, unfold=False)))
 
-    emg = torch.from_numpy(emg).to(torch.float16)
-    emg = emg.unfold(dimension=0, size=wLenTimesteps, step=stepLen) # (WINDOWS, ELECTRODE, TIME STEP)
+    if filter_mode != 'zero_phase':
+        # Filter the whole recording once, then unfold (ELECTRODE, WINDOWS, TIME STEP) -> (WINDOWS, ELECTRODE, TIME STEP)
+        emg = causal_filter(emg.T, filter_sos(), filter_mode).to(torch.float16).unfold(dimension=-1, size=wLenTimesteps, step=stepLen).permute((1, 0, 2))
+    else:
+        emg = torch.from_numpy(emg).to(torch.float16)
+        emg = emg.unfold(dimension=0, size=wLenTimesteps, step=stepLen) # (WINDOWS, ELECTRODE, TIME STEP)
     
     restim = getRestim(n, exercise)
     balanced_indices = balance(restimulus=restim, args=args)
 
     emg = emg[balanced_indices]
     
-    return filter(emg)
+    return filter(emg) if filter_mode == 'zero_phase' else emg
 
 
 def get_decrements(args):
@@ -535,7 +542,7 @@ def optimized_makeOneMagnitudeImage(data, length, width, resize_length_factor, n
     
     return image.numpy().astype(np.float32)
 
-def optimized_makeOneImage(data, cmap, length, width, resize_length_factor, native_resnet_size, index, display_interval=1000):
+def optimized_makeOneImage(data, cmap, length, width, resize_length_factor, native_resnet_size, index=0, display_interval=1000):
     # Normalize and convert data to a usable color map
     # Can't normalize if all one value
     if not len(np.unique(data)) == 1:
@@ -571,6 +578,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -752,6 +760,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -942,6 +951,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import random
 from scipy.signal import butter, filtfilt, iirnotch
+from Setup.Utils.streaming_filter import causal_filter, to_sos
 import torchvision.transforms as transforms
 import multiprocessing
 from torch.utils.data import DataLoader, Dataset
@@ -11,20 +12,17 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from tqdm.contrib.concurrent import process_map  # Use process_map from tqdm.contrib
 from scipy.signal import spectrogram, stft
-import pywt
-import fcwt
-import emd
 
 fs = 200 #Hz
 wLen = 250 # ms
 wLenTimesteps = int(wLen / 1000 * fs)
 stepLen = 50 #50 ms
 stepLen = int(stepLen / 1000 * fs)
+filter_mode = 'zero_phase' # 'zero_phase', 'causal' or 'none', see Setup.Utils.streaming_filter. Set in Setup.py.
 numElectrodes = 16
 num_subjects = 10
 cmap = mpl.colormaps['viridis']
@@ -279,6 +277,10 @@ def filter(emg):
     b, a = iirnotch(w0=50.0, Q=0.0001, fs=200.0)
     return torch.from_numpy(np.flip(filtfilt(b, a, emgButter),axis=0).copy())
 
+def filter_sos():
+    """Second order sections of the filters in filter(), for causal_filter() and streaming."""
+    return to_sos(butter(N=3, Wn=5, btype='highpass', analog=False, fs=200.0, output='sos'), iirnotch(w0=50.0, Q=0.0001, fs=200.0))
+
 def getRestim (n: int, exercise: int, unfold=True):
     """
     Returns a restiumulus (label) tensor for participant n and exercise exercise and if unfold, unfolded across time. 
@@ -366,6 +368,9 @@ def getEMG(input):
         emg = torch.tensor(emg.values)
 
     restim = getRestim(n, exercise, unfold=True)
+    if filter_mode != 'zero_phase':
+        # Filter the whole recording once, then unfold (ELECTRODE, WINDOW, TIME STEP) -> (WINDOW, ELECTRODE, TIME STEP)
+        return causal_filter(emg.T, filter_sos(), filter_mode).unfold(dimension=-1, size=wLenTimesteps, step=stepLen).permute((1, 0, 2))[balance(restim, args)]
     return filter(emg.unfold(dimension=0, size=wLenTimesteps, step=stepLen)[balance(restim, args)])
     
 def get_decrements(args):
@@ -556,6 +561,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -739,6 +745,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -913,6 +920,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
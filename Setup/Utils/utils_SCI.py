@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import random
 from scipy.signal import butter, filtfilt, iirnotch
+from Setup.Utils.streaming_filter import causal_filter, to_sos
 import torchvision.transforms as transforms
 import multiprocessing
 from torch.utils.data import DataLoader, Dataset
@@ -11,22 +12,19 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm.contrib.concurrent import process_map  # Use process_map from tqdm.contrib
 import os
 from Setup.Utils.poly5_reader import Poly5Reader
-import mne
-import fcwt
 from scipy.signal import stft
 from tqdm import tqdm
-import emd
 
 numGestures = 12
 fs = 2000.0 # Hz 
 wLen = 250.0 # ms
 wLenTimesteps = int(wLen / 1000 * fs)
 stepLen = int(50.0 / 1000 * fs) # 50 ms
+filter_mode = 'zero_phase' # 'zero_phase', 'causal' or 'none', see Setup.Utils.streaming_filter. Set in Setup.py.
 numElectrodes = 256
 num_subjects = 1
 cmap = mpl.colormaps['viridis']
@@ -202,59 +200,75 @@ def filter(emg):
     b, a = iirnotch(w0=50.0, Q=0.0001, fs=fs)
     return torch.from_numpy(np.flip(filtfilt(b, a, emgButter),axis=0).copy())
 
+def filter_sos():
+    """Second order sections of the filters in filter(), for causal_filter() and streaming."""
+    return to_sos(butter(N=3, Wn=[5.0, 500.0], btype='bandpass', analog=False, fs=fs, output='sos'), iirnotch(w0=50.0, Q=0.0001, fs=fs))
+
+def getSessionFiles (session):
+    """Returns the folder of a session, its 4 electrode grid file groups and how much each group is subsampled to 2 kHz."""
+    if (session == 1):
+        return "SCI/02-20/", [feb_1, feb_2, feb_3, feb_4], [1, 1, 1, 1]
+    else:
+        # subsample APRIL 1 and 2
+        return "SCI/04-12/", [april_1, april_2, april_3, april_4], [2, 2, 1, 1]
+
+def readPoly5 (path, subsample=1):
+    """Returns the samples of a Poly5 file as (CHANNEL, TIME), keeping every subsample-th time step."""
+    return Poly5Reader(path).samples[:, ::subsample]
+
+def findRepetitions (trigger):
+    """Finds the 10 repetitions marked on a trigger channel.
+
+    A repetition starts at the next sample at the trigger's maximum and ends at the next sample at its minimum after that. The first repetition shorter than 1000 samples marks the start of the recorded ones and is skipped.
+
+    Returns:
+        (REPETITION, 2): onset and duration of each repetition in samples
+    """
+    high = np.flatnonzero(trigger == np.max(trigger))
+    low = np.flatnonzero(trigger == np.min(trigger))
+
+    segments = []
+    skipped = False
+    end = 0
+    while (len(segments) < 10):
+        start = high[np.searchsorted(high, end)]
+        end = low[np.searchsorted(low, start)]
+
+        if (skipped):
+            segments.append((start, end - start))
+        elif (end - start < 1000):
+            skipped = True
+    return np.array(segments)
+
+def getRepetitionSegments (path, subsample=1, samples=None):
+    """Returns findRepetitions of the trigger channel of a Poly5 file (read unless samples is given), cached as a .npy file next to it."""
+    cache_path = f"{path}.segments_{subsample}.npy"
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    if samples is None:
+        samples = readPoly5(path, subsample)
+    segments = findRepetitions(samples[len(samples) - 3])
+
+    tmp_path = f"{path}.segments_{subsample}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, segments)
+    os.replace(tmp_path, cache_path)
+    return segments
+
 def getEMG (n):
-    return torch.cat((getEMG_separateSessions((1, 1)), getEMG_separateSessions((1, 2))), dim=0)
+    return torch.cat((getEMG_separateSessions((n, 1)), getEMG_separateSessions((n, 2))), dim=0)
 
 def getEMG_separateSessions(args):
     subject_number, session = args
-    if (session == 1):
-        numFiles = 12
-        path_start = "SCI/02-20/"
-        fileGroups = [feb_1, feb_2, feb_3, feb_4]
-    else:
-        numFiles = 12
-        path_start = "SCI/04-12/"
-        fileGroups = [april_1, april_2, april_3, april_4]
+    assert subject_number >= 1 and subject_number <= num_subjects
+    path_start, fileGroups, subsamples = getSessionFiles(session)
 
     cummulative_emg = []
-    for i in range(numFiles):
-        data = [Poly5Reader(path_start + file[i]) for file in fileGroups]
-        emg = []
-        # print("Subject number, session number:", args)
-        for d in data:
-            info = mne.create_info(d.num_channels, sfreq=d.sample_rate)
-            mne_raw = mne.io.RawArray(d.samples, info)
-            emg.append(np.array(mne_raw.get_data()))
-        
-        # subsample APRIL 1 and 2
-        if (session == 2):
-            emg[0] = emg[0][:, ::2]
-            emg[1] = emg[1][:, ::2]
-
-        rep_inits = [[], [], [], []]
-        rep_durations = []
-
-        for group in range(4):
-            subseq = emg[group][len(emg[group]) - 3]
-            total_elapsed = 0
-            skipped = False
-
-            while(len(rep_inits[group]) < 10):
-                start = np.argmax(subseq)
-                subseq = subseq[start:]
-                total_elapsed += start
-
-                end = np.argmin(subseq)
-                subseq = subseq[end:]
-
-                if (skipped):
-                    rep_inits[group].append(total_elapsed)
-                    if (group == 0):
-                        rep_durations.append(end)
-                elif (end < 1000):
-                    skipped = True
-                
-                total_elapsed += end
+    for i in range(len(fileGroups[0])):
+        emg = [readPoly5(path_start + group[i], subsample) for group, subsample in zip(fileGroups, subsamples)]
+        segments = [getRepetitionSegments(path_start + group[i], subsample, samples) for group, subsample, samples in zip(fileGroups, subsamples, emg)]
+        rep_inits = [group_segments[:, 0] for group_segments in segments]
+        rep_durations = segments[0][:, 1]
         
         for j in range(len(rep_durations)):
             # feb 1 and 2 have 1-63 as electrodes (missing last electrode)
@@ -269,64 +283,26 @@ def getEMG_separateSessions(args):
             else:
                 combined = np.concatenate([emg[n][1:65, rep_inits[n][j]:rep_inits[n][j]+rep_durations[j]] for n in range(len(emg))], axis=0)
 
-            combined = filter(torch.from_numpy(combined)).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
-            print("Combined shape:", combined.shape)
-
+            combined = (filter(torch.from_numpy(combined)) if filter_mode == 'zero_phase' else causal_filter(combined, filter_sos(), filter_mode)).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
             cummulative_emg.append(combined.permute((1, 0, 2)))
 
     print("Cummulative EMG shape:", torch.cat(cummulative_emg, dim=0).shape)
     return torch.cat(cummulative_emg, dim=0)
 
 def getLabels (n):
-    return torch.cat((getLabels_separateSessions((1, 1)), getLabels_separateSessions((1, 2))), dim=0)
+    return torch.cat((getLabels_separateSessions((n, 1)), getLabels_separateSessions((n, 2))), dim=0)
 
 def getLabels_separateSessions(args):
     subject_number, session = args
-    if (session == 1):
-        numFiles = 12
-        path_start = "SCI/02-20/"
-        fileGroups = [feb_1, feb_2, feb_3, feb_4]
-    else:
-        numFiles = 12
-        path_start = "SCI/04-12/"
-        fileGroups = [april_1, april_2, april_3, april_4]
-
-    gesture_reps = [0 for i in range(numFiles)]
-    for i in range(numFiles):
-        data = [Poly5Reader(path_start + file[i]) for file in fileGroups]
-        emg = []
-        for d in data:
-            info = mne.create_info(d.num_channels, sfreq=d.sample_rate)
-            mne_raw = mne.io.RawArray(d.samples, info)
-            emg.append(np.array(mne_raw.get_data()))
-        
-        # subsample APRIL 1 and APRIL 2
-        if (session == 2):
-            emg[0] = emg[0][:, ::2]
-            emg[1] = emg[1][:, ::2]
-
-        rep_durations = []
-        subseq = emg[0][len(emg[0]) - 3]
-        global_min = np.min(subseq)
-        total_elapsed = 0
-        skipped = False
-
-        while (len(rep_durations) < 10):
-            start = np.argmax(subseq)
-            subseq = subseq[start:]
-
-            end = np.argmin(subseq)
-            subseq = subseq[end:]
-
-            if (skipped):
-                rep_durations.append(end)
-            elif (end < 1000):
-                skipped = True
-        
-        for j in range(len(rep_durations)):
-            gesture_reps[i] += (rep_durations[j] - wLenTimesteps) // stepLen + 1
+    assert subject_number >= 1 and subject_number <= num_subjects
+    path_start, fileGroups, subsamples = getSessionFiles(session)
 
-        print("Gesture reps:", gesture_reps)
+    # repetitions are timed by the first group, so only its segment index is needed
+    gesture_reps = []
+    for i in range(len(fileGroups[0])):
+        rep_durations = getRepetitionSegments(path_start + fileGroups[0][i], subsamples[0])[:, 1]
+        gesture_reps.append(int(np.sum((rep_durations - wLenTimesteps) // stepLen + 1)))
+    print("Gesture reps:", gesture_reps)
 
     curr = 0
     labels = torch.tensor(())
@@ -353,6 +329,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -535,6 +512,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -728,6 +706,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
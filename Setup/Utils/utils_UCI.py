@@ -11,15 +11,11 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import h5py
 import os
 from scipy.signal import spectrogram, stft
-import pywt
-import fcwt
-import emd 
 
 numGestures = 6 # 7 total, but not all subjects have 7
 fs = 1000 #Hz (device sampling frequency is 200Hz but raw data is collected at 1000Hz)
@@ -74,25 +70,14 @@ def seed_worker(worker_id):
 
 
 def balance_gesture_classifier (restimulus):
-    indices = []
-    for x in range (len(restimulus)):
-        unique_gestures = len(torch.unique(restimulus[x]))
-        if unique_gestures == 1: 
-            gesture = restimulus[x][0] - 1 # 0 is unmarked data, 1 rest, etc
-            if gesture >= 0 and gesture <= 6: 
-                indices.append(x)
-
-        else: 
-            if include_transitions:
-                start_gesture = restimulus[x][0] - 1
-                end_gesture = restimulus[x][-1] - 1 
-            
-                if end_gesture >= 0 and end_gesture <= 6:
-                    indices.append(x)
-
-                    # Uncertain what Unmarked represents. Will include windows that go from Unmarked -> Gesture but not windows that go from Gesture -> Unmarked. (Unmarked is -1)
-          
-    return indices
+    single_gesture = torch.all(restimulus == restimulus[:, :1], dim=1)
+    start_gesture = restimulus[:, 0] - 1 # 0 is unmarked data, 1 rest, etc
+    end_gesture = restimulus[:, -1] - 1
+    keep = single_gesture & (start_gesture >= 0) & (start_gesture <= 6)
+    if include_transitions:
+        # Uncertain what Unmarked represents. Will include windows that go from Unmarked -> Gesture but not windows that go from Gesture -> Unmarked. (Unmarked is -1)
+        keep |= ~single_gesture & (end_gesture >= 0) & (end_gesture <= 6)
+    return torch.nonzero(keep).flatten()
 
 
 
@@ -164,36 +149,23 @@ def balance(restimulus):
 
 
 def contract_gesture_classifer(R, unfold=True):
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(len(R), numGestures))
+    labels = torch.zeros((len(R), numGestures))
     if (unfold):
-        for x in range(len(R)):
-            if include_transitions: 
-                gesture = int(R[x][-1]) -1 # take the last gesture of the window, subtract by 1 because 0 is unmarked data
-            else: 
-                gesture = int(R[x][0]) - 1 # take the first gesture of the window, subtract by 1 because 0 is unmarked data
-            labels[x][gesture] = 1.0
+        if include_transitions: 
+            gesture = R[:, -1].long() - 1 # take the last gesture of the window, subtract by 1 because 0 is unmarked data
+        else: 
+            gesture = R[:, 0].long() - 1 # take the first gesture of the window, subtract by 1 because 0 is unmarked data
     else:
-        for x in range(len(R)):
-            labels[x][int(R[x]) - 1] = 1.0
+        gesture = R.long() - 1
+    labels[torch.arange(len(R)), gesture] = 1.0
     return labels
 
 
 def contract_transition_classifier(R):
 
-    labels = torch.tensor(())
-    labels = labels.new_zeros(size=(len(R), 2))
-    for x in range(len(R)):
-
-        start_gesture = int(R[x][0]) - 1
-        end_gesture = int(R[x][-1]) - 1
-
-        if start_gesture == end_gesture:
-            labels[x][0] = 1.0
-        else:
-            labels[x][1] = 1.0
-   
-    return labels
+    # [1, 0] for windows within one gesture, [0, 1] for transitions
+    is_transition = (R[:, 0].long() != R[:, -1].long()).long()
+    return torch.nn.functional.one_hot(is_transition, num_classes=2).float()
 
 def contract(R, unfold=True):
 
@@ -208,16 +180,8 @@ def label_transition(R, unfold=True):
     Should return a tensor of shape (N, 2) where per window we label [start_gesture, end_gesture] of a transition.
     '''
 
-    transition_labels = torch.zeros((len(R), 2), dtype=torch.float32)
-
-    # Populate the tensor with (start, end) pairs
-    for x in range(len(R)):
-        start_gesture = int(R[x][0]) - 1
-        end_gesture = int(R[x][-1]) - 1
-
-        transition_labels[x] = torch.tensor([start_gesture, end_gesture], dtype=torch.float32)
-    
-    return transition_labels
+    # (start, end) pair of each window
+    return torch.stack((R[:, 0].long() - 1, R[:, -1].long() - 1), dim=1).to(torch.float32)
 
 def filter(emg):
     # sixth-order Butterworth highpass filter
@@ -228,36 +192,61 @@ def filter(emg):
     b, a = iirnotch(w0=50.0, Q=0.0001, fs=fs)
     return torch.from_numpy(np.flip(filtfilt(b, a, emgButter),axis=0).copy())
 
-def getRestim (n, unfold=True, session_number=1):
-    restim = []
-    n = "{:02d}".format(n)
-    for file in os.listdir(f"uciEMG/{n}/"):
-        try:
-            if file[0] == str(session_number):
-                print("Reading file", file, "Subject", n)
-            else:
-                continue
+def getRecordingFiles (n, session_number):
+    """Text recordings of subject n (zero padded string) for session_number, in directory order."""
+    return [file for file in os.listdir(f"uciEMG/{n}/") if file[0] == str(session_number) and file.endswith(".txt")]
 
-            if (unfold):
+def readRecording (file_path):
+    """Returns a recording as float32 [# timesteps, # electrodes + restimulus], without the header row and time column.
+
+    The first parse of each text file is cached as a .npy file next to it, so later reads (other processes, other runs) only load the binary.
+    """
+    cache_path = file_path[:-len(".txt")] + ".npy"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+        return np.load(cache_path)
+
+    data = pd.read_csv(file_path, sep=r'\s+', skiprows=1, header=None, dtype=np.float32).to_numpy()[:, 1:]
+    tmp_path = f"{cache_path[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    np.save(tmp_path, data)
+    os.replace(tmp_path, cache_path)
+    return data
 
-                file_path = os.path.join(f"uciEMG/{n}/", file)
+def getSession (n, session_number=1, unfold=True, target_min=None, target_max=None, leftout=None):
+    """Reads every recording of subject n (zero padded string) for session_number once and returns its EMG and restimulus together.
 
-                data_numpy = np.loadtxt(file_path, dtype=np.float32, skiprows=1)[:, 1:] # ignore first row (header) and first column (time)
-                data_tensor = torch.from_numpy(data_numpy)
-                data_unfolded = data_tensor.unfold(dimension=0, size=wLenTimesteps, step=stepLen)
-                gesture_col = data_unfolded[:, -1] # take the gesture column
-                balanced_data = gesture_col[balance(gesture_col)]
-                restim.append(balanced_data)
+    Returns:
+        (emg, restim): [# windows, # electrodes, # timesteps] and [# windows, # timesteps] if unfold, else [# timesteps, # electrodes] and [# timesteps]
+    """
+    emg = []
+    restim = []
+    for file in getRecordingFiles(n, session_number):
+        try: 
+            data = readRecording(os.path.join(f"uciEMG/{n}/", file))
+
+            if (leftout != None and n != leftout):
+                data = target_normalize(data, target_min, target_max)
 
-            else:
-                data = torch.from_numpy(np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:])
-                restim.append(data[:, -1])
-        except:
+            data = torch.from_numpy(data)
+            if (unfold):
+                data = data.unfold(dimension=0, size=wLenTimesteps, step=stepLen)
+                data = data[balance(data[:, -1])]
+
+            emg.append(data[:, :-1])
+            restim.append(data[:, -1])
+        except Exception as e:
             print("Error reading file", file, "Subject", n)
+            print(e)
+
     if numGestures == 6 and unfold:
         for i in range(len(restim)):
-            restim[i] = restim[i][torch.all(restim[i] != 7, axis=1)]
-    return torch.cat(restim, dim=0)
+            kept = torch.all(restim[i] != 7, axis=1)
+            emg[i] = emg[i][kept]
+            restim[i] = restim[i][kept]
+
+    return torch.cat(emg, dim=0), torch.cat(restim, dim=0)
+
+def getRestim (n, unfold=True, session_number=1):
+    return getSession("{:02d}".format(n), session_number, unfold)[1]
 
 def target_normalize (data, target_min, target_max):
     source_min = np.zeros(numElectrodes, dtype=np.float32)
@@ -287,35 +276,7 @@ def getEMG (args, unfold=True, session_number=1):
         target_max = args[2]
         leftout = args[3]
 
-    emg = []
-    restim = []
-    n = "{:02d}".format(n)
-    for file in os.listdir(f"uciEMG/{n}/"):
-        try: 
-            # data = np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:]
-            
-            if file[0] == str(session_number):
-                data = np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:]
-
-                if (leftout != None and n != leftout):
-                    data = target_normalize(data, target_min, target_max)
-
-                data = torch.from_numpy(data)
-                if (unfold):
-                    data = data.unfold(dimension=0, size=wLenTimesteps, step=stepLen)
-                    data = data[balance(data[:, -1])]
-
-                emg.append(data[:, :-1])
-                restim.append(data[:, -1])
-        except Exception as e:
-            print("Error reading file", file, "Subject", n)
-            print(e)
-
-    if numGestures == 6 and unfold:
-        for i in range(len(restim)):
-            emg[i] = emg[i][torch.all(restim[i] != 7, axis=1)]
-
-    return torch.cat(emg, dim=0)
+    return getSession("{:02d}".format(n), session_number, unfold, target_min, target_max, leftout)[0]
 
 def getEMG_separateSessions(args, unfold=True):
     if (len(args) == 2):
@@ -326,32 +287,7 @@ def getEMG_separateSessions(args, unfold=True):
     else:
         subject_number, session_number, target_min, target_max, leftout = args
     
-    emg = [] 
-    restim = []  
-    n = "{:02d}".format(subject_number)
-    for file in os.listdir(f"uciEMG/{n}/"):
-        try: 
-            if file[0] == str(session_number):
-                data = np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:]
-                
-                if (leftout != None and n != leftout):
-                    data = target_normalize(data, target_min, target_max)
-
-                data = torch.from_numpy(data)
-                if (unfold):
-                    data = data.unfold(dimension=0, size=wLenTimesteps, step=stepLen)
-                    data = data[balance(data[:, -1])]
-                
-                emg.append(data[:, :-1])
-                restim.append(data[:, -1])
-        except Exception as e:
-            print("Error reading file", file, "Subject", n)
-            print(e)
-    if numGestures == 6 and unfold:
-        for i in range(len(restim)):
-            emg[i] = emg[i][torch.all(restim[i] != 7, axis=1)]
-        return torch.cat(emg, dim=0)
-    return torch.cat(emg, dim=0)
+    return getSession("{:02d}".format(subject_number), session_number, unfold, target_min, target_max, leftout)[0]
 
 def getExtrema (n, proportion, lastSessionOnly=False):
     mins = np.zeros((numElectrodes, numGestures))
@@ -388,24 +324,7 @@ def getExtrema (n, proportion, lastSessionOnly=False):
 
 def getRestim_separateSessions(args, unfold=True):
     subject_number, session_number = args
-    restim = []
-    n = "{:02d}".format(subject_number)
-    for file in os.listdir(f"uciEMG/{n}/"):
-        try:
-            if file[0] == str(session_number):
-                if unfold:
-                    data = torch.from_numpy(np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:]).unfold(dimension=0, size=wLenTimesteps, step=stepLen)
-                    restim.append(data[:, -1][balance(data[:, -1])])
-                else:
-                    data = torch.from_numpy(np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:])
-                    restim.append(data[:, -1])
-        except:
-            print("Error reading file", file, "Subject", n)
-    if numGestures == 6 and unfold:
-        for i in range(len(restim)):
-            restim[i] = restim[i][torch.all(restim[i] != 7, axis=1)]
-        return torch.cat(restim, dim=0)
-    return torch.cat(restim, dim=0)
+    return getSession("{:02d}".format(subject_number), session_number, unfold)[1]
 
 def getLabels (n, unfold=True):
 
@@ -429,6 +348,7 @@ def closest_factors(num):
     return factors[0]
 
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     # Reshape and preprocess EMG data
     data = data.reshape(length, width).astype(np.float16)
     highest_cwt_scale = wLenTimesteps
@@ -613,6 +533,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -816,6 +737,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
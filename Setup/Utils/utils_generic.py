@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import random
 from scipy.signal import butter, filtfilt, iirnotch
+from Setup.Utils.streaming_filter import causal_filter, to_sos
 import torchvision.transforms as transforms
 import multiprocessing
 from torch.utils.data import DataLoader, Dataset
@@ -11,17 +12,12 @@ from math import ceil
 import argparse
 import wandb
 from sklearn.metrics import confusion_matrix
-import seaborn as sn
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import h5py
 from scipy.signal import spectrogram
-import pywt
 import scipy
-import emd
-import fcwt
 import os
-import emd 
 # image mapping
 cmap = mpl.colormaps['jet']
 normalize_for_colormap_benchmark = mpl.colors.Normalize(vmin=-60, vmax=-20)
@@ -32,6 +28,7 @@ wLen = 250 # ms
 wLenTimesteps = int(wLen / 1000 * fs)
 stepLen = 50 # ms; increase to reduce data size for large dataset
 stepLen = int(stepLen / 1000 * fs)
+filter_mode = 'zero_phase' # 'zero_phase', 'causal' or 'none', see Setup.Utils.streaming_filter. Set in Setup.py.
 
 # dataset attributes
 dataset_name = ""
@@ -112,6 +109,14 @@ def filter(emg):
     b, a = iirnotch(w0=50.0, Q=0.0001, fs=fs)
     return torch.from_numpy(np.flip(filtfilt(b, a, emgButter),axis=0).copy())
 
+def filter_sos():
+    """Second order sections of the filters in filter(), for causal_filter() and streaming."""
+    if fs > 500.0:
+        sos = butter(N=3, Wn=[5.0, 500.0], btype='bandpass', analog=False, fs=fs, output='sos')
+    else:
+        sos = butter(N=3, Wn=5, btype='highpass', analog=False, fs=fs, output='sos')
+    return to_sos(sos, iirnotch(w0=50.0, Q=0.0001, fs=fs))
+
 # data is [# channels, # timesteps]
 # target min/max is [# channels, # gestures]
 def target_normalize (data, target_min, target_max, gesture):
@@ -129,6 +134,14 @@ def target_normalize (data, target_min, target_max, gesture):
         - source_min[i])) * (target_max[i][gesture] - target_min[i][gesture]) + target_min[i][gesture]
     return data
 
+def participant_filename(n):
+    assert n >= 1 and n <= num_subjects
+    return f'DatasetsProcessed_hdf5/{dataset_name}/p{n}/participant_{n}.hdf5'
+
+def windows_per_repetition(timesteps):
+    """Number of windows unfold(size=wLenTimesteps, step=stepLen) makes of one repetition."""
+    return max(0, (timesteps - wLenTimesteps) // stepLen + 1)
+
 def getEMG (args):
     if (type(args) == int):
         n = args
@@ -138,56 +151,63 @@ def getEMG (args):
         target_max = args[2]
         leftout = args[3]
 
-    assert n >= 1 and n <= num_subjects
-    file = h5py.File(f'DatasetsProcessed_hdf5/{dataset_name}/p{n}/participant_{n}.hdf5', 'r')
-    emg = []
-    for i, gesture in enumerate(gesture_labels):
-        assert gesture in file, f"Gesture {gesture} not found in file for participant {n}!"
-        # [# repetitions, # electrodes, # timesteps]
-        data = np.array(file[gesture])
-        
-        if (type(args) != int and n != leftout):
-            for j in range(len(data)):
-                data[j] = target_normalize(data[j], target_min, target_max, i)
-        
-        data = filter(torch.from_numpy(data)).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
-        emg.append(torch.cat([data[i] for i in range(len(data))], dim=-2).permute((1, 0, 2)).to(torch.float16))
-    return torch.cat(emg, dim=0)
+    with h5py.File(participant_filename(n), 'r') as file:
+        for gesture in gesture_labels:
+            assert gesture in file, f"Gesture {gesture} not found in file for participant {n}!"
+        # [# repetitions, # electrodes, # timesteps] of each gesture
+        shapes = [file[gesture].shape for gesture in gesture_labels]
+        emg = torch.empty((sum(shape[0] * windows_per_repetition(shape[2]) for shape in shapes), numElectrodes, wLenTimesteps), dtype=torch.float16)
+
+        offset = 0
+        for i, gesture in enumerate(gesture_labels):
+            dataset = file[gesture]
+            num_repetitions, _, timesteps = dataset.shape
+            # Read whole chunks of repetitions at a time into one reused buffer
+            block_size = dataset.chunks[0] if dataset.chunks else num_repetitions
+            buffer = np.empty((min(block_size, num_repetitions), numElectrodes, timesteps), dtype=dataset.dtype)
+            for start in range(0, num_repetitions, block_size):
+                stop = min(start + block_size, num_repetitions)
+                data = buffer[:stop - start]
+                dataset.read_direct(data, np.s_[start:stop])
+
+                if (type(args) != int and n != leftout):
+                    for j in range(len(data)):
+                        data[j] = target_normalize(data[j], target_min, target_max, i)
+
+                # (REPETITION, CHANNEL, WINDOW, TIME) -> (REPETITION * WINDOW, CHANNEL, TIME)
+                filtered = filter(torch.from_numpy(data)) if filter_mode == 'zero_phase' else causal_filter(data, filter_sos(), filter_mode)
+                windows = filtered.unfold(dimension=-1, size=wLenTimesteps, step=stepLen).permute((0, 2, 1, 3))
+                num_windows = windows.shape[0] * windows.shape[1]
+                emg[offset:offset + num_windows] = windows.reshape(num_windows, numElectrodes, wLenTimesteps)
+                offset += num_windows
+    return emg
 
 def getExtrema (n, proportion):
     mins = np.zeros((numElectrodes, numGestures))
     maxes = np.zeros((numElectrodes, numGestures))
 
-    assert n >= 1 and n <= num_subjects
-    file = h5py.File(f'DatasetsProcessed_hdf5/{dataset_name}/p{n}/participant_{n}.hdf5', 'r')
-    for i, gesture in enumerate(gesture_labels):
-        data = np.array(file[gesture])
-        data = np.concatenate([data[i] for i in range(len(data))], axis=-1)
-
-        data = data.transpose() # (TOTAL TIME STEPS, ELECTRODE)
-        tensor_data = torch.from_numpy(data)
-        windowed_data = tensor_data.unfold(dimension=0, size=wLenTimesteps, step=stepLen) # (WINDOW, CHANNEL, TIME STEP)
+    with h5py.File(participant_filename(n), 'r') as file:
+        for i, gesture in enumerate(gesture_labels):
+            dataset = file[gesture]
+            num_repetitions, _, timesteps = dataset.shape
 
-        num_windows = np.round(len(windowed_data)* proportion).astype(int)
-        selected_windows = windowed_data[:num_windows]
+            # The first proportion of windows of the repetitions concatenated in time only covers their first selected_timesteps, so only those are read
+            num_windows = np.round(windows_per_repetition(num_repetitions * timesteps) * proportion).astype(int)
+            selected_timesteps = (num_windows - 1) * stepLen + wLenTimesteps
+            data = np.concatenate([dataset[j, :, :min(timesteps, selected_timesteps - j * timesteps)] for j in range(ceil(selected_timesteps / timesteps))], axis=-1)
 
-        for j in range(numElectrodes):
-            mins[j][i] = torch.min(selected_windows[:, j, :])
-            maxes[j][i] = torch.max(selected_windows[:, j, :])
+            mins[:, i] = data.min(axis=-1)
+            maxes[:, i] = data.max(axis=-1)
     return mins, maxes
 
 def getLabels (n):
-    file = h5py.File(f'DatasetsProcessed_hdf5/{dataset_name}/p{n}/participant_{n}.hdf5', 'r')
-    data = torch.from_numpy(np.array(file[gesture_labels[0]])).unfold(dimension=-1, size=wLenTimesteps, step=stepLen)
-    timesteps_for_one_gesture = data.size(0) * data.size(2)
-    labels = np.zeros((timesteps_for_one_gesture*numGestures, numGestures))
-    for i in range(timesteps_for_one_gesture):
-        for j in range(numGestures):
-            labels[j * timesteps_for_one_gesture + i][j] = 1.0
-    return labels
+    with h5py.File(participant_filename(n), 'r') as file:
+        windows_per_gesture = [file[gesture].shape[0] * windows_per_repetition(file[gesture].shape[2]) for gesture in gesture_labels]
+    return np.repeat(np.eye(numGestures), windows_per_gesture, axis=0)
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
 
+    import emd
     emg_sample = data # (wLenTimesteps * numElectrodes)
     max_imfs = 6
 
@@ -247,6 +267,7 @@ def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor
     return final_image
  
 def optimized_makeOneCWTImage(data, length, width, resize_length_factor, native_resnet_size):
+    import fcwt
     normalize_for_colormap_benchmark_cwt = mpl.colors.Normalize(vmin=-50, vmax=5)
     emg_sample = data
     data = data.reshape(length, width)
@@ -403,6 +424,7 @@ def optimized_makeOnePhaseSpectrogramImage(data, length, width, resize_length_fa
 
 def optimized_makeOneHilbertHuangImage(data, length, width, resize_length_factor, native_resnet_size):
     
+    import emd
     emg_sample = data 
     max_imfs = 6
 
@@ -673,6 +695,7 @@ class Data(Dataset):
         return len(self.data)
 
 def plot_confusion_matrix(true, pred, gesture_labels, testrun_foldername, args, formatted_datetime, partition_name):
+    import seaborn as sn
     # Calculate confusion matrix
     cf_matrix = confusion_matrix(true, pred)
     df_cm_unnormalized = pd.DataFrame(cf_matrix, index=gesture_labels, columns=gesture_labels)
@@ -3,7 +3,15 @@ import argparse
 import yaml
 import CNN_EMG
 import copy
+import glob
+import hashlib
+import os
+import multiprocessing
+import multiprocessing.connection
+import torch
 from Setup.Setup import Setup # used to get
+from Data.Combined_Data import data_cache_key
+from Model.Model_Trainer import checkpoint_args
 
 def list_of_ints(arg):
         """Define a custom argument type for a list of integers"""
@@ -67,29 +75,29 @@ def run_command(args):
     delattr(args, "table")
     CNN_EMG.use_config(args) # special call to main that passes config args
 
-def replicate_table(args, table_args, table_name):
-    """Replicate a given table from the paper.
-
-    Each line in the interation is stored in a separate config file. The line config file is loaded and the parameters that change for each iteration are updated. CNN_EMG.py is then run with the updated args.
+def get_table_jobs(args, table_args, table_name):
+    """Builds the args of every (subject, line) run of a table, in the order they are run sequentially.
 
     Args:
         args (argparse): Default arguments with table{i}.yaml values overridden
         table_args (argparse): Fields for the table
         table_name (str): Table number to replicate
+
+    Returns:
+        list: (subject, line, line_args) for every run
     """
 
     starting_index = table_args.starting_index
     ending_index = table_args.ending_index
 
-    if table_name == "4":
-        NUM_LINES = 1
-    else:
-        NUM_LINES = 4
-    
+    # Number of line configs that exist for the table (table 3 has 3 lines, table 3_intersession 1)
+    num_lines = len(glob.glob(f'config/table{table_name}_line*.yaml'))
+
+    jobs = []
     for subj in range(starting_index, ending_index+1):
         args_copy = copy.deepcopy(args)
 
-        for line in range(1, NUM_LINES+1):
+        for line in range(1, num_lines+1):
             # Load in the config for the given line
             line_args = load_config(args_copy, f'config/table{table_name}_line{line}.yaml') # defaults + config values + line values
 
@@ -100,8 +108,104 @@ def replicate_table(args, table_args, table_name):
                 line_args.number_windows = table_args.number_windows
             if table_name == "3" or table_name == "3_intersession":
                 line_args.model = table_args.best_model
-            
+
+            jobs.append((subj, line, line_args))
+
+    return jobs
+
+def run_table_job(line_args, cpus, num_threads, gpu):
+    """Entry point of a worker process: restricts it to its CPU/thread budget and GPU, then runs one table line for one subject."""
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[var] = str(num_threads)
+    torch.set_num_threads(num_threads)
+    if gpu is not None:
+        line_args.gpu = gpu
+
+    run_command(line_args)
+
+def replicate_table(args, table_args, table_name):
+    """Replicate a given table from the paper.
+
+    Each line in the interation is stored in a separate config file. The line config file is loaded and the parameters that change for each iteration are updated. CNN_EMG.py is then run with the updated args.
+
+    With --table_workers > 1, runs are trained in parallel, each in a fresh process forked from this one with its own slice of CPU cores (--table_threads_per_job) and GPUs assigned round robin. The dataset is loaded once here beforehand and shared copy-on-write by the forked runs. Completed runs are recorded with a hash of their arguments so that restarting the same table skips them, while a line whose config or defaults changed since is run again.
+
+    Args:
+        args (argparse): Default arguments with table{i}.yaml values overridden
+        table_args (argparse): Fields for the table
+        table_name (str): Table number to replicate
+    """
+
+    jobs = get_table_jobs(args, table_args, table_name)
+
+    completed_filename = f'test/table{table_name}_{table_args.current_dataset}_completed.txt'
+    os.makedirs(os.path.dirname(completed_filename), exist_ok=True)
+    completed = set()
+    if os.path.exists(completed_filename):
+        with open(completed_filename, 'r') as file:
+            completed = set(file.read().split())
+
+    def job_id(subj, line, line_args):
+        args_hash = hashlib.sha1(repr(checkpoint_args(line_args)).encode()).hexdigest()[:16]
+        return f'subject{subj}_line{line}_{args_hash}'
+
+    def mark_completed(subj, line, line_args):
+        with open(completed_filename, 'a') as file:
+            file.write(job_id(subj, line, line_args) + '\n')
+
+    pending = [job for job in jobs if job_id(*job) not in completed]
+    if len(pending) < len(jobs):
+        print(f"Skipping {len(jobs) - len(pending)} completed runs listed in {completed_filename}")
+
+    if args.table_workers <= 1:
+        for subj, line, line_args in pending:
             run_command(line_args)
+            mark_completed(subj, line, line_args)
+        return
+
+    # Load every dataset once before forking so that the runs share it instead of each reading it again
+    preloaded = set()
+    for _, _, line_args in pending:
+        key = data_cache_key(line_args)
+        if key not in preloaded:
+            CNN_EMG.preload_data(line_args)
+            preloaded.add(key)
+
+    num_workers = args.table_workers
+    cpus = sorted(os.sched_getaffinity(0))
+    num_threads = args.table_threads_per_job or max(1, len(cpus) // num_workers)
+    pin_cpus = num_threads * num_workers <= len(cpus)
+    num_gpus = torch.cuda.device_count()
+
+    context = multiprocessing.get_context("fork")
+    free_slots = list(range(num_workers))
+    running = {}
+    failed = []
+    while pending or running:
+        while pending and free_slots:
+            slot = free_slots.pop(0)
+            subj, line, line_args = pending.pop(0)
+            slot_cpus = cpus[slot*num_threads:(slot+1)*num_threads] if pin_cpus else None
+            gpu = slot % num_gpus if num_gpus > 0 else None
+            process = context.Process(target=run_table_job, args=(line_args, slot_cpus, num_threads, gpu))
+            process.start()
+            running[process.sentinel] = (process, subj, line, line_args, slot)
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            process, subj, line, line_args, slot = running.pop(sentinel)
+            process.join()
+            free_slots.append(slot)
+            if process.exitcode == 0:
+                mark_completed(subj, line, line_args)
+            else:
+                print(f"Run for subject {subj}, line {line} failed with exit code {process.exitcode}")
+                failed.append(job_id(subj, line, line_args))
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} table runs failed: {', '.join(failed)}. Rerun the table to retry them.")
     
 def main():
     """
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Replays a subject of the dataset a CNN_EMG.py run was trained on as a continuous stream through its saved model, one window per hop, and reports
+the decision latency (p50/p99) and the accuracy of the streamed decisions.
+
+Example:
+    python stream_CNN_EMG.py --model_path test/[PROJECT]/[RUN]/[DATETIME]/model_[DATETIME].pth --realtime True
+"""
+import argparse
+import glob
+import os
+
+import torch
+
+from Model.Streaming_Inference import Replay_Source, Streaming_Classifier, latency_summary, load_inference_state, load_model, load_replay_windows, setup_utils
+from Setup.Utils.streaming_filter import Causal_Filter
+from Setup.Utils.utils_MCS_EMG import str2bool
+
+def create_argparse():
+    parser = argparse.ArgumentParser(description="Stream a subject through a model saved by CNN_EMG.py and report decision latency")
+    parser.add_argument('--model_path', type=str, help='model_[DATETIME].pth saved by CNN_EMG.py, or one of the model_[DATETIME]_seed[SEED].pth for runs with --num_seeds > 1.', required=True)
+    parser.add_argument('--inference_state', type=str, help='inference_state_[DATETIME].pt saved with the model. Defaults to the one in the folder of --model_path.', default=None)
+    parser.add_argument('--subject', type=int, help='subject to replay. Defaults to the left out subject of the run.', default=None)
+    parser.add_argument('--session', type=int, help='session to replay for leave one session out runs. Defaults to all sessions (getEMG).', default=None)
+    parser.add_argument('--chunk_size', type=int, help='number of samples pushed at once. Defaults to the hop between windows (stepLen).', default=None)
+    parser.add_argument('--max_pending', type=int, help='maximum number of windows classified per chunk; older completed windows are dropped. Set to 1 by default.', default=1)
+    parser.add_argument('--realtime', type=str2bool, help='whether or not to release samples at the sampling rate of the dataset instead of as fast as they are classified. Set to False by default.', default=False)
+    parser.add_argument('--max_windows', type=int, help='stop after this many windows (0 replays the whole subject). Set to 0 by default.', default=0)
+    parser.add_argument('--gpu', type=int, help='gpu to use. Defaults to the gpu of the run.', default=None)
+    return parser.parse_args()
+
+def main():
+    stream_args = create_argparse()
+
+    inference_state_filename = stream_args.inference_state
+    if inference_state_filename is None:
+        inference_state_filenames = glob.glob(os.path.join(os.path.dirname(stream_args.model_path), 'inference_state_*.pt'))
+        assert len(inference_state_filenames) == 1, f"Expected one inference_state_*.pt next to {stream_args.model_path}, found {len(inference_state_filenames)}. Set --inference_state."
+        inference_state_filename = inference_state_filenames[0]
+
+    inference_state, args = load_inference_state(inference_state_filename)
+    utils, exercises = setup_utils(args)
+
+    gpu = args.gpu if stream_args.gpu is None else stream_args.gpu
+    device = torch.device("cuda:" + str(gpu) if torch.cuda.is_available() else "cpu")
+    model = load_model(stream_args.model_path, inference_state, args, device)
+
+    stream_filter = None
+    if args.causal_filter:
+        # Replay the unfiltered windows and filter them while streaming, with the causal filter the model was trained with. The loaded windows are
+        # not always contiguous, so after a jump the carried filter state (and so the window) only approximately matches the offline one
+        utils.filter_mode = 'none'
+        stream_filter = Causal_Filter(utils.filter_sos())
+
+    subject = int(args.leftout_subject) if stream_args.subject is None else stream_args.subject
+    windows, labels = load_replay_windows(utils, args, exercises, subject, stream_args.session)
+    if stream_args.max_windows > 0:
+        windows, labels = windows[:stream_args.max_windows], labels[:stream_args.max_windows]
+
+    step = utils.stepLen
+    chunk_size = step if stream_args.chunk_size is None else stream_args.chunk_size
+    source = Replay_Source(windows, labels, step, chunk_size, fs=utils.fs if stream_args.realtime else None)
+    classifier = Streaming_Classifier(model, utils, inference_state, args, windows.shape[1], windows.shape[2], step, device, max_pending=stream_args.max_pending, stream_filter=stream_filter)
+    classifier.warm_up()
+
+    print(f"Streaming subject {subject} ({len(source)} samples, {len(windows)} windows of {windows.shape[1]}x{windows.shape[2]}, hop {step}, chunks of {chunk_size}) through {stream_args.model_path}")
+
+    correct = 0
+    num_decisions = 0
+    chunk = source.read()
+    while chunk is not None:
+        for window_index, prediction in classifier.push(*chunk):
+            correct += int(prediction == source.window_labels[window_index])
+            num_decisions += 1
+        chunk = source.read()
+
+    latency = latency_summary(classifier.latencies)
+    print(f"Decisions: {num_decisions} ({classifier.num_dropped} windows dropped)")
+    print(f"Accuracy of streamed decisions: {correct / max(num_decisions, 1):.4f}")
+    print(f"Decision latency: p50 {latency['p50_ms']:.2f} ms, p99 {latency['p99_ms']:.2f} ms, max {latency['max_ms']:.2f} ms (hop is {1000 * step / utils.fs:.2f} ms)")
+
+if __name__ == "__main__":
+    main()
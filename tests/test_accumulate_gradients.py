@@ -0,0 +1,48 @@
+"""Checks that Model_Trainer.accumulate_gradients gives the loss, outputs and parameter gradients of a single full-batch pass, for separable and coupled losses."""
+import argparse
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from Model.Model_Trainer import Model_Trainer
+
+
+def make_trainer(micro_batch_size):
+    torch.manual_seed(0)
+    trainer = Model_Trainer.__new__(Model_Trainer)
+    trainer.args = argparse.Namespace(micro_batch_size=micro_batch_size)
+    trainer.model = nn.Sequential(nn.Linear(6, 16), nn.ReLU(), nn.Linear(16, 4)).double()
+    return trainer
+
+def coupled_loss(outputs, Y_batch):
+    # cross entropy plus a penalty on the covariance of the outputs of the whole batch, which couples its samples
+    return F.cross_entropy(outputs, Y_batch) + torch.cov(outputs.t()).square().sum()
+
+def full_batch(X_batch, Y_batch, loss_fn):
+    trainer = make_trainer(0)
+    outputs = trainer.model(X_batch)
+    loss = loss_fn(outputs, Y_batch)
+    loss.backward()
+    return loss.detach(), outputs.detach(), [p.grad for p in trainer.model.parameters()]
+
+@pytest.mark.parametrize("separable, loss_fn", [(True, F.cross_entropy), (False, coupled_loss)], ids=["separable", "coupled"])
+@pytest.mark.parametrize("micro_batch_size", [3, 7, 29])
+def test_matches_full_batch(separable, loss_fn, micro_batch_size):
+    generator = torch.Generator().manual_seed(1)
+    X_batch = torch.randn(29, 6, generator=generator, dtype=torch.float64)
+    Y_batch = torch.randint(0, 4, (29,), generator=generator)
+    expected_loss, expected_outputs, expected_grads = full_batch(X_batch, Y_batch, loss_fn)
+
+    trainer = make_trainer(micro_batch_size)
+    loss, outputs = trainer.accumulate_gradients(X_batch, Y_batch, loss_fn, forward_fn=trainer.model, prop_per_domain=[10, 12, 7], separable=separable)
+    torch.testing.assert_close(loss, expected_loss)
+    torch.testing.assert_close(outputs, expected_outputs)
+    for param, expected_grad in zip(trainer.model.parameters(), expected_grads):
+        torch.testing.assert_close(param.grad, expected_grad)
+
+def test_micro_batches_spread_domains():
+    micro_batches = make_trainer(4).get_micro_batch_indices(10, prop_per_domain=[2, 5, 3])
+    assert max(len(idx) for idx in micro_batches) <= 4
+    assert sorted(torch.cat(micro_batches).tolist()) == list(range(10))
@@ -0,0 +1,112 @@
+"""Checks the CapgMyo loaders (trials loaded with a thread pool, labels from trial shapes) against the recursive per-trial implementation they replaced, on synthetic sessions."""
+import os
+
+import numpy as np
+import pytest
+import torch
+from scipy import io
+
+import Setup.Utils.utils_CapgMyo as utils
+
+
+def reference_getData(subject, gesture, trial):
+    if (isinstance(subject, int)):
+        sub = str(subject)
+        if subject < 10:
+            sub = '0' + sub
+    else:
+        sub = str(subject[0])
+        if subject[0] < 10:
+            sub = '0' + sub
+        target_min = subject[1]
+        target_max = subject[2]
+        leftout = subject[3]
+
+    name = '0' + sub + '-00' + str(gesture) + '-00' + str(trial)
+    if trial == 10:
+        name = '0' + sub + '-00' + str(gesture) + '-010'
+    mat_array = io.loadmat('./CapgMyo_B/dbb-preprocessed-0' + sub + '/' + name + '.mat')['data']
+
+    if (not isinstance(subject, int) and leftout != subject[0]):
+        mat_array = utils.target_normalize(mat_array, target_min, target_max, gesture - 1)
+
+    tensor_data = torch.from_numpy(mat_array)
+    if trial < 10:
+        return torch.cat((utils.window(tensor_data), reference_getData(subject, gesture, trial + 1)), dim=0)
+    elif gesture < 8:
+        return torch.cat((utils.window(tensor_data), reference_getData(subject, gesture + 1, 1)), dim=0)
+    else:
+        return utils.window(tensor_data)
+
+def reference_getExtrema(n, proportion, lastSessionOnly=False):
+    mins = np.zeros((utils.numElectrodes, utils.numGestures))
+    maxes = np.zeros((utils.numElectrodes, utils.numGestures))
+    n = utils.participants_second_session_index[n-1] if lastSessionOnly else utils.participants_first_session_index[n-1]
+    sub = '0' + str(n) if n < 10 else str(n)
+    for i in range(utils.numGestures):
+        data = []
+        for trial in range(10):
+            name = '0' + sub + '-00' + str(i+1) + '-00' + str(trial+1)
+            if trial == 9:
+                name = '0' + sub + '-00' + str(i+1) + '-010'
+            data.append(io.loadmat('./CapgMyo_B/dbb-preprocessed-0' + sub + '/' + name + '.mat')['data'])
+        windowed_data = utils.window(torch.from_numpy(np.concatenate(data, axis=0)))
+        selected_windows = windowed_data[:np.round(len(windowed_data) * proportion).astype(int)]
+        for j in range(utils.numElectrodes):
+            mins[j][i] = torch.min(selected_windows[:, j, :])
+            maxes[j][i] = torch.max(selected_windows[:, j, :])
+    return mins, maxes
+
+def reference_getLabels_separateSessions(args):
+    subject_number, session_number = args
+    data_index = utils.participants_first_session_index[subject_number-1] if session_number == 1 else utils.participants_second_session_index[subject_number-1]
+    emg_len = len(reference_getData(data_index, 1, 1))
+    labels = torch.zeros((emg_len, 8))
+    for x in range(8):
+        for y in range(int(emg_len / 8)):
+            labels[int(x * (emg_len / 8) + y)][x] = 1.0
+    return labels
+
+def write_session(data_index, lengths, rng):
+    os.makedirs(f'./CapgMyo_B/dbb-preprocessed-0{data_index:02d}')
+    for path, length in zip(utils.trialPaths(data_index), lengths):
+        io.savemat(path, {'data': rng.standard_normal((length, utils.numElectrodes))})
+
+@pytest.fixture
+def sessions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'numElectrodes', 4)
+    utils.getWindowCounts.cache_clear()
+    rng = np.random.default_rng(0)
+    # the first session has trials of varying length, the second has trials of one length
+    write_session(1, rng.integers(utils.wLenTimesteps, 3 * utils.wLenTimesteps, utils.numGestures * 10), rng)
+    write_session(2, np.full(utils.numGestures * 10, 2 * utils.wLenTimesteps + 17), rng)
+    yield
+    utils.getWindowCounts.cache_clear()
+
+@pytest.mark.parametrize("data_index", [1, 2])
+def test_getData(sessions, data_index):
+    torch.testing.assert_close(utils.getData(data_index), reference_getData(data_index, 1, 1))
+
+def test_getData_target_normalized(sessions):
+    target_min = np.full((utils.numElectrodes, utils.numGestures), -1.0)
+    target_max = np.full((utils.numElectrodes, utils.numGestures), 1.0)
+    torch.testing.assert_close(utils.getData((1, target_min, target_max, 3)), reference_getData((1, target_min, target_max, 3), 1, 1))
+
+@pytest.mark.parametrize("lastSessionOnly", [False, True])
+@pytest.mark.parametrize("proportion", [0.25, 1.0])
+def test_getExtrema(sessions, proportion, lastSessionOnly):
+    mins, maxes = utils.getExtrema(1, proportion, lastSessionOnly)
+    expected_mins, expected_maxes = reference_getExtrema(1, proportion, lastSessionOnly)
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxes, expected_maxes)
+
+def test_getLabels_equal_trial_lengths(sessions):
+    torch.testing.assert_close(utils.getLabels_separateSessions((1, 2)), reference_getLabels_separateSessions((1, 2)))
+
+def test_getLabels_match_windows(sessions):
+    # with trials of varying length each window is labelled with the gesture of its own trial
+    labels = utils.getLabels(1)
+    expected = torch.cat([torch.full((len(utils.window(torch.from_numpy(io.loadmat(path)['data']))),), i // 10) for i, path in enumerate(utils.trialPaths(1))])
+    assert len(labels) == len(utils.getData(1))
+    torch.testing.assert_close(labels.argmax(dim=1), expected)
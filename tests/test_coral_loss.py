@@ -0,0 +1,48 @@
+"""Checks PairwiseCorrelationAlignmentLoss against the per-pair CorrelationAlignmentLoss loop it replaced."""
+import pytest
+import torch
+
+from Model.CORAL_Trainer import CorrelationAlignmentLoss, PairwiseCorrelationAlignmentLoss
+
+
+def reference_loss(features, domain_sizes):
+    criterion = CorrelationAlignmentLoss()
+    features_per_domains = features.split(domain_sizes, dim=0)
+    loss = 0
+    for domain_i in range(len(domain_sizes)):
+        for domain_j in range(domain_i + 1, len(domain_sizes)):
+            loss += criterion(features_per_domains[domain_i].transpose(0, 1), features_per_domains[domain_j].transpose(0, 1))
+    return loss / (len(domain_sizes) * (len(domain_sizes) - 1) / 2)
+
+def feature_covariance_reference(features, domain_sizes):
+    features_per_domains = features.split(domain_sizes, dim=0)
+    d = features.shape[1]
+    loss = 0
+    for domain_i in range(len(domain_sizes)):
+        for domain_j in range(domain_i + 1, len(domain_sizes)):
+            f_i, f_j = features_per_domains[domain_i], features_per_domains[domain_j]
+            cov_i, cov_j = torch.cov(f_i.t()), torch.cov(f_j.t())
+            loss += (f_i.mean(0) - f_j.mean(0)).pow(2).sum() / d + (cov_i - cov_j).pow(2).sum() / (d * d)
+    return loss / (len(domain_sizes) * (len(domain_sizes) - 1) / 2)
+
+@pytest.mark.parametrize("domain_sizes", [[6, 6, 6, 6, 6], [7, 4, 9, 5], [3, 8]])
+def test_default_loss_matches_per_pair_loop(domain_sizes):
+    generator = torch.Generator().manual_seed(len(domain_sizes))
+    features = torch.randn(sum(domain_sizes), 16, generator=generator, dtype=torch.float64, requires_grad=True)
+
+    # both draw the same downsampling indices from the global generator
+    torch.manual_seed(0)
+    loss = PairwiseCorrelationAlignmentLoss()(features, domain_sizes)
+    torch.manual_seed(0)
+    expected = reference_loss(features, domain_sizes)
+    torch.testing.assert_close(loss, expected)
+
+    grad, = torch.autograd.grad(loss, features)
+    expected_grad, = torch.autograd.grad(expected, features)
+    torch.testing.assert_close(grad, expected_grad)
+
+def test_feature_covariance_loss():
+    domain_sizes = [7, 4, 9, 5]
+    features = torch.randn(sum(domain_sizes), 10, generator=torch.Generator().manual_seed(1), dtype=torch.float64)
+    loss = PairwiseCorrelationAlignmentLoss(feature_covariance=True)(features, domain_sizes)
+    torch.testing.assert_close(loss, feature_covariance_reference(features, domain_sizes))
@@ -0,0 +1,101 @@
+"""Checks the FlexWear-HD loaders (one open per session, filtering before unfolding, counts from dataset shapes) against the per-gesture implementation they replaced, on a synthetic session."""
+import os
+
+import h5py
+import numpy as np
+import pytest
+import torch
+from scipy.signal import butter, filtfilt
+
+import Setup.Utils.utils_FlexWearHD as utils
+
+
+def reference_highpassFilter(emg):
+    b, a = butter(N=1, Wn=120.0, btype='highpass', analog=False, fs=utils.fs)
+    return torch.from_numpy(np.flip(filtfilt(b, a, emg), axis=-1).copy())
+
+def reference_getData(n, gesture, target_min=None, target_max=None, leftout=None, session_number=1, highpassFilter=reference_highpassFilter):
+    session_number_mapping = {1: 'initial', 2: 'recalibration'}
+    with h5py.File(f'./FlexWear-HD/FlexWear-HD_Dataset/p{n:03}/data_allchannels_{session_number_mapping[session_number]}.h5', 'r') as file:
+        data = np.array(file[gesture])
+    if (leftout != None and n != leftout):
+        for i in range(len(data)):
+            data[i] = utils.target_normalize(data[i], target_min, target_max, utils.gesture_labels.index(gesture))
+    data = highpassFilter(torch.from_numpy(data).unfold(dimension=-1, size=utils.wLenTimesteps, step=utils.stepLen))
+    return torch.cat([data[i] for i in range(len(data))], axis=1).permute([1, 0, 2])
+
+def reference_getEMG(n, **kwargs):
+    return torch.cat([reference_getData(n, name, **kwargs) for name in utils.gesture_labels], axis=0)
+
+def reference_getExtrema(n, proportion, lastSessionOnly=False):
+    mins = np.zeros((utils.numElectrodes, utils.numGestures))
+    maxes = np.zeros((utils.numElectrodes, utils.numGestures))
+    session = 'recalibration' if lastSessionOnly else 'initial'
+    with h5py.File(f'./FlexWear-HD/FlexWear-HD_Dataset/p{n:03}/data_allchannels_{session}.h5', 'r') as file:
+        for i in range(utils.numGestures):
+            data = np.array(file[utils.gesture_labels[i]])
+            data = np.concatenate([data[i] for i in range(len(data))], axis=-1).transpose()
+            windowed_data = torch.from_numpy(data).unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen)
+            selected_windows = windowed_data[:int(len(windowed_data) * proportion)]
+            for j in range(utils.numElectrodes):
+                mins[j][i] = torch.min(selected_windows[:, j, :])
+                maxes[j][i] = torch.max(selected_windows[:, j, :])
+    return mins, maxes
+
+def reference_getLabels(n, session_number=1):
+    gesture_count = [len(reference_getData(n, gesture, session_number=session_number)) for gesture in utils.gesture_labels]
+    labels = torch.zeros((sum(gesture_count), utils.numGestures))
+    curr = 0
+    for x in range(utils.numGestures):
+        for y in range(gesture_count[x]):
+            labels[curr + y][x] = 1.0
+        curr += gesture_count[x]
+    return labels
+
+@pytest.fixture
+def subject(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'numElectrodes', 4)
+    rng = np.random.default_rng(0)
+    os.makedirs('./FlexWear-HD/FlexWear-HD_Dataset/p001')
+    for session_number in (1, 2):
+        with h5py.File(utils.sessionFilename(1, session_number), 'w') as file:
+            for gesture in utils.gesture_labels:
+                # repetitions of one gesture share a length, which need not be a whole number of steps, and every proportion selects a window
+                shape = (int(rng.integers(1, 4)), utils.numElectrodes, int(rng.integers(2 * utils.wLenTimesteps, 4 * utils.wLenTimesteps)))
+                file[gesture] = rng.standard_normal(shape)
+    return 1
+
+def test_getEMG_unfiltered_windows(subject, monkeypatch):
+    # with the filter left out, the preallocated single-open read must produce exactly the old windows in the old order
+    monkeypatch.setattr(utils, 'filter_mode', 'none')
+    torch.testing.assert_close(utils.getEMG(subject), reference_getEMG(subject, highpassFilter=lambda emg: emg))
+
+@pytest.mark.parametrize("session_number", [1, 2])
+def test_getEMG_filtered_windows(subject, session_number):
+    # filtfilt over the whole repetition only differs from the per-window filtfilt near the window edges
+    emg = utils.getEMG_separateSessions((subject, session_number))
+    expected = reference_getEMG(subject, session_number=session_number)
+    assert emg.shape == expected.shape
+    edge = utils.wLenTimesteps // 10
+    torch.testing.assert_close(emg[..., edge:-edge], expected[..., edge:-edge], rtol=0, atol=1e-3)
+
+def test_getEMG_target_normalized(subject, monkeypatch):
+    monkeypatch.setattr(utils, 'filter_mode', 'none')
+    target_min = np.full((utils.numElectrodes, utils.numGestures), -1.0)
+    target_max = np.full((utils.numElectrodes, utils.numGestures), 1.0)
+    torch.testing.assert_close(utils.getEMG((subject, target_min, target_max, 2)), reference_getEMG(subject, target_min=target_min, target_max=target_max, leftout=2, highpassFilter=lambda emg: emg))
+
+@pytest.mark.parametrize("lastSessionOnly", [False, True])
+@pytest.mark.parametrize("proportion", [0.25, 0.5, 1.0])
+def test_getExtrema(subject, proportion, lastSessionOnly):
+    mins, maxes = utils.getExtrema(subject, proportion, lastSessionOnly)
+    expected_mins, expected_maxes = reference_getExtrema(subject, proportion, lastSessionOnly)
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxes, expected_maxes)
+
+@pytest.mark.parametrize("session_number", [1, 2])
+def test_getLabels(subject, session_number):
+    labels = utils.getLabels_separateSessions((subject, session_number)) if session_number == 2 else utils.getLabels(subject)
+    torch.testing.assert_close(labels, reference_getLabels(subject, session_number))
+    assert len(labels) == len(utils.getEMG_separateSessions((subject, session_number)))
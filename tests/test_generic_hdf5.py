@@ -0,0 +1,84 @@
+"""Checks the chunked HDF5 getEMG/getExtrema/getLabels of utils_generic against the whole-array reads they replaced, on a synthetic participant file."""
+import h5py
+import numpy as np
+import pytest
+import torch
+
+import Setup.Utils.utils_generic as utils
+
+
+@pytest.fixture
+def participant(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'fs', 2000.0)
+    monkeypatch.setattr(utils, 'wLenTimesteps', 500)
+    monkeypatch.setattr(utils, 'stepLen', 100)
+    monkeypatch.setattr(utils, 'dataset_name', 'synthetic')
+    monkeypatch.setattr(utils, 'num_subjects', 1)
+    monkeypatch.setattr(utils, 'numElectrodes', 4)
+    monkeypatch.setattr(utils, 'numGestures', 3)
+    monkeypatch.setattr(utils, 'gesture_labels', ['rest', 'fist', 'open'])
+
+    path = tmp_path / 'DatasetsProcessed_hdf5' / 'synthetic' / 'p1'
+    path.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    with h5py.File(path / 'participant_1.hdf5', 'w') as file:
+        for gesture in utils.gesture_labels:
+            # [# repetitions, # electrodes, # timesteps], chunked so that getEMG reads several blocks
+            file.create_dataset(gesture, data=rng.standard_normal((5, 4, 1260)), chunks=(2, 4, 1260))
+    return 1
+
+def reference_getEMG(n, target=None):
+    with h5py.File(utils.participant_filename(n), 'r') as file:
+        emg = []
+        for i, gesture in enumerate(utils.gesture_labels):
+            data = np.array(file[gesture])
+            if target is not None:
+                for j in range(len(data)):
+                    data[j] = utils.target_normalize(data[j], target[0], target[1], i)
+            data = utils.filter(torch.from_numpy(data)).unfold(dimension=-1, size=utils.wLenTimesteps, step=utils.stepLen)
+            emg.append(torch.cat([data[i] for i in range(len(data))], dim=-2).permute((1, 0, 2)).to(torch.float16))
+    return torch.cat(emg, dim=0)
+
+def reference_getExtrema(n, proportion):
+    mins = np.zeros((utils.numElectrodes, utils.numGestures))
+    maxes = np.zeros((utils.numElectrodes, utils.numGestures))
+    with h5py.File(utils.participant_filename(n), 'r') as file:
+        for i, gesture in enumerate(utils.gesture_labels):
+            data = np.array(file[gesture])
+            data = np.concatenate([data[i] for i in range(len(data))], axis=-1).transpose()
+            windowed_data = torch.from_numpy(data).unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen)
+            selected_windows = windowed_data[:np.round(len(windowed_data) * proportion).astype(int)]
+            for j in range(utils.numElectrodes):
+                mins[j][i] = torch.min(selected_windows[:, j, :])
+                maxes[j][i] = torch.max(selected_windows[:, j, :])
+    return mins, maxes
+
+def reference_getLabels(n):
+    with h5py.File(utils.participant_filename(n), 'r') as file:
+        data = torch.from_numpy(np.array(file[utils.gesture_labels[0]])).unfold(dimension=-1, size=utils.wLenTimesteps, step=utils.stepLen)
+    timesteps_for_one_gesture = data.size(0) * data.size(2)
+    labels = np.zeros((timesteps_for_one_gesture * utils.numGestures, utils.numGestures))
+    for i in range(timesteps_for_one_gesture):
+        for j in range(utils.numGestures):
+            labels[j * timesteps_for_one_gesture + i][j] = 1.0
+    return labels
+
+def test_getEMG(participant):
+    torch.testing.assert_close(utils.getEMG(participant), reference_getEMG(participant))
+
+def test_getEMG_target_normalized(participant):
+    target = (np.full((4, 3), -1.0), np.full((4, 3), 1.0))
+    torch.testing.assert_close(utils.getEMG((participant, *target, 2)), reference_getEMG(participant, target))
+
+@pytest.mark.parametrize("proportion", [0.1, 0.25, 0.5, 1.0])
+def test_getExtrema(participant, proportion):
+    mins, maxes = utils.getExtrema(participant, proportion)
+    expected_mins, expected_maxes = reference_getExtrema(participant, proportion)
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxes, expected_maxes)
+
+def test_getLabels(participant):
+    labels = utils.getLabels(participant)
+    np.testing.assert_array_equal(labels, reference_getLabels(participant))
+    assert len(labels) == len(utils.getEMG(participant))
@@ -0,0 +1,34 @@
+"""Checks the batched IRM invariance penalty against the per-domain loop it replaced."""
+import pytest
+import torch
+import torch.nn.functional as F
+from torch import autograd
+
+from Model.IRM_CNN_Based_Trainer import InvariancePenaltyLoss
+
+
+def reference_penalty(y, labels):
+    scale = torch.tensor(1., dtype=y.dtype).requires_grad_()
+    loss_1 = F.cross_entropy(y[::2] * scale, labels[::2])
+    loss_2 = F.cross_entropy(y[1::2] * scale, labels[1::2])
+    grad_1 = autograd.grad(loss_1, [scale], create_graph=True)[0]
+    grad_2 = autograd.grad(loss_2, [scale], create_graph=True)[0]
+    return torch.sum(grad_1 * grad_2)
+
+@pytest.mark.parametrize("domain_sizes", [[40], [8, 8, 8, 8], [5, 9, 4, 12, 7]])
+@pytest.mark.parametrize("one_hot", [False, True])
+def test_batched_penalty_matches_per_domain_loop(domain_sizes, one_hot):
+    generator = torch.Generator().manual_seed(sum(domain_sizes))
+    num_classes = 6
+    logits = torch.randn(sum(domain_sizes), num_classes, generator=generator, dtype=torch.float64, requires_grad=True)
+    labels = torch.randint(num_classes, (sum(domain_sizes),), generator=generator)
+    if one_hot:
+        labels = F.one_hot(labels, num_classes).to(torch.float64)
+
+    penalty = InvariancePenaltyLoss()(logits, labels, domain_sizes)
+    expected = sum(reference_penalty(y, l) for y, l in zip(logits.split(domain_sizes), labels.split(domain_sizes))) / len(domain_sizes)
+    torch.testing.assert_close(penalty, expected)
+
+    grad, = autograd.grad(penalty, logits)
+    expected_grad, = autograd.grad(expected, logits)
+    torch.testing.assert_close(grad, expected_grad)
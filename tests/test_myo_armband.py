@@ -0,0 +1,87 @@
+"""Checks the Myo Armband loaders (recordings parsed once, labels from file sizes) against the per-file implementations they replaced, on synthetic recordings."""
+import numpy as np
+import pytest
+import torch
+
+import Setup.Utils.utils_MyoArmbandDataset as utils
+
+
+def reference_format_emg(data):
+    emg = np.zeros((len(data) // utils.numElectrodes, utils.numElectrodes))
+    for i in range(len(data) // utils.numElectrodes):
+        for j in range(utils.numElectrodes):
+            emg[i][j] = data[i * utils.numElectrodes + j]
+    return emg
+
+def reference_contract(R):
+    labels = torch.zeros((len(R), utils.numGestures))
+    for x in range(len(R)):
+        labels[x][int(R[x]) - 1] = 1.0
+    return labels
+
+def read(n, i):
+    return reference_format_emg(np.array(np.fromfile(utils.recordingPath(n, i), dtype=np.int16), dtype=np.float32))
+
+def reference_getEMG(n, target=None):
+    emg = []
+    for i in range(utils.numGestures * 4):
+        data = read(n, i)
+        if target is not None:
+            data = utils.normalize(data, target[0], target[1], i % utils.numGestures)
+        emg.append(torch.from_numpy(data).unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen))
+    return utils.filter(torch.cat(emg, dim=0))
+
+def reference_getExtrema(n, proportion):
+    mins = np.zeros((utils.numElectrodes, utils.numGestures))
+    maxes = np.zeros((utils.numElectrodes, utils.numGestures))
+    for i in range(utils.numGestures):
+        emg = torch.cat([torch.from_numpy(read(n, i + j * utils.numGestures)).unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen) for j in range(4)], dim=0)
+        selected_windows = emg[:np.round(len(emg) * proportion).astype(int)]
+        for j in range(utils.numElectrodes):
+            mins[j][i] = torch.min(selected_windows[:, j, :])
+            maxes[j][i] = torch.max(selected_windows[:, j, :])
+    return mins, maxes
+
+def reference_getLabels(n):
+    labels = []
+    for i in range(utils.numGestures * 4):
+        labels.append(torch.from_numpy((i % utils.numGestures) + np.zeros(torch.from_numpy(read(n, i)).unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen).shape[0])))
+    return reference_contract(torch.cat(labels, dim=0))
+
+@pytest.fixture
+def subject(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    n = 1
+    (tmp_path / 'myoarmbanddataset' / 'Female0' / 'Test1').mkdir(parents=True)
+    for i in range(utils.numGestures * 4):
+        # lengths that are not a multiple of the electrodes
+        num_values = int(rng.integers(8 * 60, 8 * 400)) + int(rng.integers(0, 8))
+        rng.integers(-128, 128, num_values).astype(np.int16).tofile(utils.recordingPath(n, i))
+    return n
+
+def test_getEMG(subject):
+    torch.testing.assert_close(utils.getEMG(subject), reference_getEMG(subject))
+
+def test_getEMG_target_normalized(subject):
+    target = (np.full((utils.numElectrodes, utils.numGestures), -1.0), np.full((utils.numElectrodes, utils.numGestures), 1.0))
+    torch.testing.assert_close(utils.getEMG((subject, *target, subject + 1)), reference_getEMG(subject, target))
+
+@pytest.mark.parametrize("proportion", [0.25, 1.0])
+def test_getExtrema(subject, proportion):
+    mins, maxes = utils.getExtrema(subject, proportion)
+    expected_mins, expected_maxes = reference_getExtrema(subject, proportion)
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxes, expected_maxes)
+
+def test_getLabels(subject):
+    labels = utils.getLabels(subject)
+    torch.testing.assert_close(labels, reference_getLabels(subject))
+    assert len(labels) == len(utils.getEMG(subject))
+
+def test_getTargetEMGAndExtrema(subject):
+    emg, mins, maxes = utils.getTargetEMGAndExtrema(subject, 0.25)
+    torch.testing.assert_close(emg, utils.getEMG(subject))
+    expected_mins, expected_maxes = reference_getExtrema(subject, 0.25)
+    np.testing.assert_array_equal(mins, expected_mins)
+    np.testing.assert_array_equal(maxes, expected_maxes)
@@ -0,0 +1,73 @@
+"""Checks RandomDomainSampler against the list based sampler it replaced: same epoch length and the same domain counts in every batch."""
+import bisect
+import copy
+import math
+import random
+
+import numpy as np
+import pytest
+
+from Model.Model_Trainer import RandomDomainSampler
+
+
+class ReferenceRandomDomainSampler():
+    def __init__(self, batch_size, cumulative_sizes, num_subjects):
+        self.n_domains_per_batch = num_subjects - 1
+        self.sample_idxes_per_domain = []
+        self.batch_size_per_domain = []
+        start = 0
+        for end in cumulative_sizes:
+            self.batch_size_per_domain.append(math.ceil((end-start) / cumulative_sizes[-1] * batch_size))
+            self.sample_idxes_per_domain.append(list(range(start, end)))
+            start = end
+        while sum(self.batch_size_per_domain) != batch_size:
+            self.batch_size_per_domain[self.batch_size_per_domain.index(max(self.batch_size_per_domain))] -= 1
+
+    def __iter__(self):
+        sample_idxes_per_domain = copy.deepcopy(self.sample_idxes_per_domain)
+        final_idxes = []
+        stop_flag = False
+        while not stop_flag:
+            for domain in random.sample(range(self.n_domains_per_batch), self.n_domains_per_batch):
+                sample_idxes = sample_idxes_per_domain[domain]
+                if len(sample_idxes) < self.batch_size_per_domain[domain]:
+                    selected_idxes = np.random.choice(sample_idxes, self.batch_size_per_domain[domain], replace=True)
+                else:
+                    selected_idxes = random.sample(sample_idxes, self.batch_size_per_domain[domain])
+                final_idxes.extend(selected_idxes)
+                for idx in selected_idxes:
+                    if idx in sample_idxes_per_domain[domain]:
+                        sample_idxes_per_domain[domain].remove(idx)
+                if len(sample_idxes_per_domain[domain]) < self.batch_size_per_domain[domain]:
+                    stop_flag = True
+        return iter(final_idxes)
+
+def domain_counts_per_batch(indices, cumulative_sizes, batch_size):
+    domains = [bisect.bisect_right(cumulative_sizes, idx) for idx in indices]
+    return [sorted(np.bincount(domains[i:i + batch_size], minlength=len(cumulative_sizes)).tolist()) for i in range(0, len(domains), batch_size)]
+
+@pytest.mark.parametrize("domain_sizes, batch_size", [([50, 50, 50, 50], 16), ([120, 35, 80, 61, 9], 32), ([7, 300, 40], 24)])
+def test_sampler_matches_reference(domain_sizes, batch_size):
+    cumulative_sizes = np.cumsum(domain_sizes).tolist()
+    random.seed(0)
+    np.random.seed(0)
+    sampler = RandomDomainSampler(batch_size, cumulative_sizes, len(domain_sizes) + 1)
+    reference = list(ReferenceRandomDomainSampler(batch_size, cumulative_sizes, len(domain_sizes) + 1))
+    indices = list(sampler)
+
+    assert len(sampler) == len(indices) == len(reference)
+    assert domain_counts_per_batch(indices, cumulative_sizes, batch_size) == domain_counts_per_batch(reference, cumulative_sizes, batch_size)
+
+    # every batch is laid out domain by domain as get_prop_per_domain() says
+    prop_per_domain = sampler.get_prop_per_domain()
+    for batch in np.asarray(indices).reshape(-1, batch_size):
+        for domain, chunk in enumerate(np.split(batch, np.cumsum(prop_per_domain)[:-1])):
+            start = cumulative_sizes[domain - 1] if domain > 0 else 0
+            assert np.all((chunk >= start) & (chunk < cumulative_sizes[domain]))
+
+    # domains with enough samples are drawn without replacement
+    for domain, size in enumerate(domain_sizes):
+        start = cumulative_sizes[domain] - size
+        drawn = [idx for idx in indices if start <= idx < cumulative_sizes[domain]]
+        if len(drawn) <= size:
+            assert len(set(drawn)) == len(drawn)
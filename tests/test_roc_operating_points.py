@@ -0,0 +1,45 @@
+"""Checks the batched ROC operating points of ml_metrics_utils against the per-class sklearn roc_curve implementation they replaced."""
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import roc_curve
+
+import Model.ml_metrics_utils as ml_utils
+
+
+def reference_value_at(y_true, y_scores, target, tpr_at_fpr):
+    fpr, tpr, _ = roc_curve(y_true, y_scores)
+    x, y = (fpr, tpr) if tpr_at_fpr else (tpr, fpr)
+    if target in x:
+        return y[np.where(x == target)[0][0]]
+    return np.interp(target, x, y)
+
+def random_scores(seed, num_samples=300, num_classes=5, ties=False):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(num_samples, num_classes, generator=generator)
+    if ties:
+        logits = torch.round(logits * 2) / 2
+    labels = torch.randint(num_classes, (num_samples,), generator=generator)
+    return torch.softmax(logits, dim=1).to(torch.float64), torch.nn.functional.one_hot(labels, num_classes)
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("ties", [False, True])
+def test_tpr_at_fpr_matches_sklearn(seed, ties):
+    predictions, labels = random_scores(seed, ties=ties)
+    fpr_targets = [0.01, 0.1, 0.5]
+    result = ml_utils.compute_tpr_at_fpr(predictions, labels, fpr_targets)
+
+    for fpr_target in fpr_targets:
+        expected = [reference_value_at(labels[:, c].numpy(), predictions[:, c].numpy(), fpr_target, True) for c in range(labels.shape[1])]
+        np.testing.assert_allclose(result[f"FPR {int(fpr_target*100)}%"], expected, atol=1e-12)
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("ties", [False, True])
+def test_fpr_at_tpr_matches_sklearn(seed, ties):
+    predictions, labels = random_scores(seed, ties=ties)
+    tpr_targets = [0.9, 0.95, 0.99]
+    result = ml_utils.compute_fpr_at_tpr(predictions, labels, tpr_targets)
+
+    for tpr_target in tpr_targets:
+        expected = [reference_value_at(labels[:, c].numpy(), predictions[:, c].numpy(), tpr_target, False) for c in range(labels.shape[1])]
+        np.testing.assert_allclose(result[f"TPR {int(tpr_target*100)}%"], expected, atol=1e-12)
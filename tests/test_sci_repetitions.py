@@ -0,0 +1,65 @@
+"""Checks findRepetitions (searchsorted over the trigger's extremum indices) and the Poly5 block decoding against the argmax/argmin scans and struct.unpack they replaced, on synthetic trigger channels."""
+import io
+import struct
+
+import numpy as np
+import pytest
+
+import Setup.Utils.utils_SCI as utils
+from Setup.Utils.poly5_reader import Poly5Reader
+
+
+def reference_findRepetitions(subseq):
+    rep_inits = []
+    rep_durations = []
+    total_elapsed = 0
+    skipped = False
+    while (len(rep_inits) < 10):
+        start = np.argmax(subseq)
+        subseq = subseq[start:]
+        total_elapsed += start
+
+        end = np.argmin(subseq)
+        subseq = subseq[end:]
+
+        if (skipped):
+            rep_inits.append(total_elapsed)
+            rep_durations.append(end)
+        elif (end < 1000):
+            skipped = True
+
+        total_elapsed += end
+    return np.stack((rep_inits, rep_durations), axis=1)
+
+def trigger_channel(rng, pulse_lengths):
+    """Pulses at the trigger maximum separated by gaps at its minimum, with intermediate values on the edges."""
+    parts = [np.full(int(rng.integers(200, 2000)), 0.0)]
+    for length in pulse_lengths:
+        parts += [rng.uniform(0.1, 0.9, int(rng.integers(0, 5))), np.full(length, 5.0), rng.uniform(0.1, 0.9, int(rng.integers(0, 5))), np.full(int(rng.integers(1, 2000)), 0.0)]
+    return np.concatenate(parts)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_findRepetitions(seed):
+    rng = np.random.default_rng(seed)
+    # long pulses before the short start marker are ignored, and pulses after the 10th repetition are never reached
+    pulse_lengths = list(rng.integers(1000, 4000, int(rng.integers(0, 3)))) + [int(rng.integers(1, 1000))] + list(rng.integers(1, 4000, 12))
+    trigger = trigger_channel(rng, pulse_lengths)
+    np.testing.assert_array_equal(utils.findRepetitions(trigger), reference_findRepetitions(trigger))
+
+def test_getRepetitionSegments_cached(tmp_path):
+    rng = np.random.default_rng(0)
+    trigger = trigger_channel(rng, [500] + list(rng.integers(1000, 4000, 10)))
+    samples = np.stack((rng.standard_normal(len(trigger)), trigger, rng.standard_normal(len(trigger)), rng.standard_normal(len(trigger))))
+    path = str(tmp_path / "recording.Poly5")
+    expected = reference_findRepetitions(trigger)
+    np.testing.assert_array_equal(utils.getRepetitionSegments(path, samples=samples), expected)
+    # the second call loads the cached index without reading the recording
+    np.testing.assert_array_equal(utils.getRepetitionSegments(path), expected)
+
+def test_readSignalBlock():
+    num_channels, num_samples_per_block = 3, 5
+    myfmt = 'f' * num_channels * num_samples_per_block
+    values = np.random.default_rng(0).standard_normal(num_channels * num_samples_per_block).astype(np.float32)
+    block = bytes(86) + struct.pack(myfmt, *values)
+    expected = np.asarray(struct.unpack(myfmt, block[86:]))
+    np.testing.assert_array_equal(Poly5Reader._readSignalBlock(None, io.BytesIO(block), len(values), myfmt), expected)
@@ -0,0 +1,54 @@
+"""Checks that Causal_Filter gives the same samples whether a recording is filtered whole or chunk by chunk, and that causal_filter and to_sos match filtering with scipy directly."""
+import numpy as np
+import pytest
+import torch
+from scipy.signal import butter, iirnotch, lfilter, sosfilt
+
+import Setup.Utils.utils_FlexWearHD as utils_FlexWearHD
+import Setup.Utils.utils_MCS_EMG as utils_MCS_EMG
+import Setup.Utils.utils_NinaproDB2 as utils_NinaproDB2
+import Setup.Utils.utils_NinaproDB3 as utils_NinaproDB3
+import Setup.Utils.utils_NinaproDB5 as utils_NinaproDB5
+import Setup.Utils.utils_SCI as utils_SCI
+from Setup.Utils.streaming_filter import Causal_Filter, causal_filter, to_sos
+
+
+@pytest.fixture(params=[utils_FlexWearHD, utils_MCS_EMG, utils_NinaproDB2, utils_NinaproDB3, utils_NinaproDB5, utils_SCI], ids=lambda utils: utils.__name__.split('.')[-1])
+def sos(request):
+    return request.param.filter_sos()
+
+@pytest.fixture
+def recording():
+    # (CHANNEL, TIME) with a DC offset per channel
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((4, 5000)) + rng.uniform(-100, 100, (4, 1))
+
+def test_chunks_match_whole_recording(sos, recording):
+    whole = Causal_Filter(sos)(recording)
+
+    stream_filter = Causal_Filter(sos)
+    bounds = np.sort(np.random.default_rng(1).choice(np.arange(1, recording.shape[-1]), 30, replace=False))
+    chunks = [stream_filter(chunk) for chunk in np.split(recording, bounds, axis=-1)]
+    np.testing.assert_allclose(np.concatenate(chunks, axis=-1), whole, rtol=0, atol=1e-9)
+
+    # one sample at a time, as a live stream may arrive
+    stream_filter.reset()
+    samples = [stream_filter(recording[:, t:t + 1]) for t in range(500)]
+    np.testing.assert_allclose(np.concatenate(samples, axis=-1), whole[:, :500], rtol=0, atol=1e-9)
+
+def test_steady_state_start(recording):
+    # a lowpass starting in steady state passes a constant signal unchanged, with no ringing at the start
+    constant = np.repeat(recording[:, :1], 1000, axis=-1)
+    np.testing.assert_allclose(Causal_Filter(utils_NinaproDB2.filter_sos())(constant), constant, rtol=1e-9)
+
+def test_causal_filter_modes(recording):
+    sos = utils_SCI.filter_sos()
+    torch.testing.assert_close(causal_filter(recording, sos, 'none'), torch.from_numpy(recording))
+    torch.testing.assert_close(causal_filter(recording, sos, 'causal'), torch.from_numpy(Causal_Filter(sos)(recording)))
+
+def test_to_sos_cascade(recording):
+    fs = 2000.0
+    bandpass = butter(N=3, Wn=[5.0, 500.0], btype='bandpass', analog=False, fs=fs, output='sos')
+    b, a = iirnotch(w0=50.0, Q=30.0, fs=fs)
+    expected = lfilter(b, a, sosfilt(bandpass, recording, axis=-1), axis=-1)
+    np.testing.assert_allclose(sosfilt(to_sos(bandpass, (b, a)), recording, axis=-1), expected, rtol=1e-7, atol=1e-9)
@@ -0,0 +1,153 @@
+"""Checks the UCI loaders (each recording parsed once and cached as .npy, labels built with tensor ops) against the per-file np.loadtxt and per-window loops they replaced, on synthetic recordings."""
+import argparse
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import Setup.Utils.utils_UCI as utils
+
+
+def reference_balance_gesture_classifier(restimulus):
+    indices = []
+    for x in range(len(restimulus)):
+        if len(torch.unique(restimulus[x])) == 1:
+            gesture = restimulus[x][0] - 1
+            if gesture >= 0 and gesture <= 6:
+                indices.append(x)
+        elif utils.include_transitions:
+            end_gesture = restimulus[x][-1] - 1
+            if end_gesture >= 0 and end_gesture <= 6:
+                indices.append(x)
+    return indices
+
+def reference_balance(restimulus):
+    if utils.args.transition_classifier:
+        return utils.balance_transition_classifier(restimulus)
+    return reference_balance_gesture_classifier(restimulus)
+
+def reference_contract(R, unfold=True):
+    if utils.args.transition_classifier:
+        labels = torch.zeros((len(R), 2))
+        for x in range(len(R)):
+            labels[x][0 if int(R[x][0]) == int(R[x][-1]) else 1] = 1.0
+        return labels
+    labels = torch.zeros((len(R), utils.numGestures))
+    for x in range(len(R)):
+        if not unfold:
+            labels[x][int(R[x]) - 1] = 1.0
+        elif utils.include_transitions:
+            labels[x][int(R[x][-1]) - 1] = 1.0
+        else:
+            labels[x][int(R[x][0]) - 1] = 1.0
+    return labels
+
+def reference_label_transition(R):
+    transition_labels = torch.zeros((len(R), 2), dtype=torch.float32)
+    for x in range(len(R)):
+        transition_labels[x] = torch.tensor([int(R[x][0]) - 1, int(R[x][-1]) - 1], dtype=torch.float32)
+    return transition_labels
+
+def reference_getEMG(n, unfold=True, session_number=1, target_min=None, target_max=None, leftout=None):
+    emg = []
+    restim = []
+    n = "{:02d}".format(n)
+    for file in os.listdir(f"uciEMG/{n}/"):
+        if file[0] == str(session_number) and file.endswith(".txt"): # only text recordings existed before the .npy cache
+            data = np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:]
+            if (leftout != None and n != leftout):
+                data = utils.target_normalize(data, target_min, target_max)
+            data = torch.from_numpy(data)
+            if (unfold):
+                data = data.unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen)
+                data = data[reference_balance(data[:, -1])]
+            emg.append(data[:, :-1])
+            restim.append(data[:, -1])
+    if utils.numGestures == 6 and unfold:
+        for i in range(len(restim)):
+            emg[i] = emg[i][torch.all(restim[i] != 7, axis=1)]
+    return torch.cat(emg, dim=0)
+
+def reference_getRestim(n, unfold=True, session_number=1):
+    restim = []
+    n = "{:02d}".format(n)
+    for file in os.listdir(f"uciEMG/{n}/"):
+        if file[0] == str(session_number) and file.endswith(".txt"):
+            data = torch.from_numpy(np.loadtxt(os.path.join(f"uciEMG/{n}/", file), dtype=np.float32, skiprows=1)[:, 1:])
+            if (unfold):
+                gesture_col = data.unfold(dimension=0, size=utils.wLenTimesteps, step=utils.stepLen)[:, -1]
+                restim.append(gesture_col[reference_balance(gesture_col)])
+            else:
+                restim.append(data[:, -1])
+    if utils.numGestures == 6 and unfold:
+        for i in range(len(restim)):
+            restim[i] = restim[i][torch.all(restim[i] != 7, axis=1)]
+    return torch.cat(restim, dim=0)
+
+def write_recording(path, rng):
+    # gesture segments of random length, with unmarked (0) and gesture 7 segments in between
+    restim = np.concatenate([np.full(rng.integers(100, 600), rng.integers(0, 8)) for _ in range(12)])
+    data = np.column_stack((np.arange(len(restim)), rng.standard_normal((len(restim), utils.numElectrodes)).round(5), restim))
+    np.savetxt(path, data, fmt='%.5f', delimiter='\t', header='time\t' + '\t'.join(f'ch{i + 1}' for i in range(utils.numElectrodes)) + '\tclass', comments='')
+
+@pytest.fixture
+def subject(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, 'args', argparse.Namespace(transition_classifier=False))
+    rng = np.random.default_rng(0)
+    os.makedirs("uciEMG/01")
+    for file in ["1_raw_data_13-12_22.03.16.txt", "1_raw_data_13-13_22.03.16.txt", "2_raw_data_14-19_22.03.16.txt"]:
+        write_recording(os.path.join("uciEMG/01", file), rng)
+    return 1
+
+@pytest.fixture(params=[(6, False), (6, True), (7, False), (7, True)], ids=lambda p: f"{p[0]}gestures-transitions{p[1]}")
+def label_setup(request, monkeypatch):
+    monkeypatch.setattr(utils, 'numGestures', request.param[0])
+    monkeypatch.setattr(utils, 'include_transitions', request.param[1])
+
+@pytest.mark.parametrize("session_number", [1, 2])
+def test_getEMG(subject, label_setup, session_number):
+    expected = reference_getEMG(subject, session_number=session_number)
+    torch.testing.assert_close(utils.getEMG(subject, session_number=session_number), expected)
+    # the second read loads the cached binary
+    torch.testing.assert_close(utils.getEMG(subject, session_number=session_number), expected)
+
+def test_getEMG_not_unfolded(subject):
+    torch.testing.assert_close(utils.getEMG(subject, unfold=False), reference_getEMG(subject, unfold=False))
+
+def test_getEMG_target_normalized(subject):
+    target_min = np.full((utils.numElectrodes, utils.numGestures), -1.0)
+    target_max = np.full((utils.numElectrodes, utils.numGestures), 1.0)
+    torch.testing.assert_close(utils.getEMG((subject, target_min, target_max, "02")), reference_getEMG(subject, True, 1, target_min, target_max, "02"))
+
+def test_recording_cache_ignored_when_stale(subject):
+    path = os.path.join("uciEMG/01", "1_raw_data_13-12_22.03.16.txt")
+    utils.readRecording(path)
+    cache_path = path[:-len(".txt")] + ".npy"
+    np.save(cache_path, np.zeros((1, 1), dtype=np.float32))
+    os.utime(cache_path, (0, 0))
+    np.testing.assert_array_equal(utils.readRecording(path), np.loadtxt(path, dtype=np.float32, skiprows=1)[:, 1:])
+
+def test_getLabels(subject, label_setup):
+    restim = reference_getRestim(subject)
+    torch.testing.assert_close(utils.getRestim(subject), restim)
+    torch.testing.assert_close(utils.getLabels(subject), reference_contract(restim))
+    assert len(utils.getLabels(subject)) == len(utils.getEMG(subject))
+
+def test_getLabels_not_unfolded(subject, monkeypatch):
+    # every timestep is labelled, so all 7 gestures need a column
+    monkeypatch.setattr(utils, 'numGestures', 7)
+    restim = reference_getRestim(subject, unfold=False)
+    torch.testing.assert_close(utils.getRestim(subject, unfold=False), restim)
+    torch.testing.assert_close(utils.getLabels(subject, unfold=False), reference_contract(restim, unfold=False))
+
+def test_getLabels_separateSessions(subject, label_setup):
+    torch.testing.assert_close(utils.getLabels_separateSessions((subject, 2)), reference_contract(reference_getRestim(subject, session_number=2)))
+
+def test_transition_labels(subject, monkeypatch):
+    monkeypatch.setattr(utils, 'args', argparse.Namespace(transition_classifier=True))
+    restim = reference_getRestim(subject)
+    torch.testing.assert_close(utils.getRestim(subject), restim)
+    torch.testing.assert_close(utils.contract(restim), reference_contract(restim))
+    torch.testing.assert_close(utils.getLabels(subject), reference_label_transition(restim))